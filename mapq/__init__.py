@@ -39,6 +39,11 @@ _url = "https://github.com/scipion-em/scipion-em-mapq"
 
 
 SCRATCHDIR = pwutils.getEnvVariable('SPOCSCRATCHDIR', default='/tmp/')
+CACHEDIR = pwutils.getEnvVariable('MAPQ_CACHE_DIR', default=os.path.join(SCRATCHDIR, 'mapq_cache'))
+CACHESIZE = float(pwutils.getEnvVariable('MAPQ_CACHE_SIZE', default=10)) * 1024 ** 3  # GB
+# The socket and its key live in a directory private to the user
+SERVER_SOCKET = pwutils.getEnvVariable('MAPQ_SERVER_SOCKET',
+                                       default=os.path.join(SCRATCHDIR, 'mapq-%d' % os.getuid(), 'server.sock'))
 
 
 class Plugin(pwem.Plugin):
@@ -125,9 +130,10 @@ class Plugin(pwem.Plugin):
                              % (version, version),
                              "chimera"))
 
-        chimera_cmds.append(('wget -c https://github.com/gregdp/mapq/raw/master/download/mapq_1_8_2.zip',
-                             'mapq_1_8_2.zip'))
-        chimera_cmds.append(('unzip mapq_1_8_2.zip', "mapq"))
+        mapq_zip = 'mapq_%s.zip' % mapqConst.MAPQ_VERSION
+        chimera_cmds.append(('wget -c https://github.com/gregdp/mapq/raw/master/download/%s' % mapq_zip,
+                             mapq_zip))
+        chimera_cmds.append(('unzip %s' % mapq_zip, "mapq"))
         chimera_cmds.append(("cd mapq && python install.py ../chimera &&"
                              "touch ../mapq_installed", "mapq_installed"))
         chimera_cmds.append(('wget -c https://github.com/gregdp/mapq/raw/master/data/QScore_Apoferritin_Tutorial.zip',
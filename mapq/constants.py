@@ -31,3 +31,27 @@ MAPQ_HOME = 'MAPQ_HOME'
 
 # Supported stable versions
 V1_16_1 = '1.16'
+
+# MapQ release installed into Chimera
+MAPQ_VERSION = '1_8_2'
+
+# Q-score engines
+CHIMERA_ENGINE = 0
+NATIVE_ENGINE = 1
+ENGINE_CHOICES = ['Chimera (mapq_cmd.py)', 'Native (NumPy)']
+
+# Rigid body fitting methods
+CHIMERA_FIT = 0
+NATIVE_FIT = 1
+FIT_CHOICES = ['Chimera (fitmap)', 'Native (NumPy)']
+
+# Pairing of structures and maps in batch runs
+PAIR_BY_ID = 0
+PAIR_ALL = 1
+PAIR_BY_ATTRIBUTE = 2
+PAIRING_CHOICES = ['By ID', 'All vs all', 'Matching attribute']
+
+# Floating point precision of the native scoring
+FLOAT32 = 0
+FLOAT64 = 1
+PRECISION_CHOICES = ['float32', 'float64']
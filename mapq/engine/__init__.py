@@ -0,0 +1,32 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from .volume import MapGrid, readMap
+from .structure import AtomTable, readPdbAtoms, writePdbBFactors
+from .qscore import PRECISION, SIGMA, computeQScores
+from .parallel import ScoringPool, parallelQScores, spatialShards
+from .pipeline import scoreStructure, streamScoreStructure
+from .summary import scoreSummary, scoreDeviation, residueScores, chainScores
@@ -0,0 +1,100 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import multiprocessing
+from collections import OrderedDict
+
+from .fitting import fitAtoms, fitStatistics
+from .pipeline import scoreAtoms
+from .qscore import PRECISION, SIGMA
+from .structure import readPdbAtoms
+from .volume import readMap
+
+
+# Maps kept open by every worker, enough for consecutive pairs to share them
+MAX_OPEN_MAPS = 4
+
+# Maps opened by the current process, in least recently used order
+_maps = OrderedDict()
+
+
+def _openMap(mapFile):
+    """ Memory mapped grid of mapFile, opened once per process """
+    if mapFile in _maps:
+        _maps.move_to_end(mapFile)
+    else:
+        _maps[mapFile] = readMap(mapFile, mmap=True)
+        while len(_maps) > MAX_OPEN_MAPS:
+            _maps.popitem(last=False)
+    return _maps[mapFile]
+
+
+def scorePair(mapFile, pdbFile, outFile, sigma=SIGMA, bFactor=None, bFactorFile=None, fit=False,
+              precision=PRECISION):
+    """
+    Score the atoms of pdbFile against mapFile with scoreAtoms, using a single process and the maps
+    already opened by it. With fit, the atoms are first fitted into the map and outFile holds the
+    fitted coordinates. The map is sampled in the given precision, the fit always in float64.
+    Returns the statistics of the fit or None.
+    """
+    grid = _openMap(mapFile)
+    atoms = readPdbAtoms(pdbFile)
+    fitStats = None
+    if fit:
+        coords, steps = fitAtoms(grid, atoms.coords)
+        fitStats = fitStatistics(grid, atoms.coords, coords)
+        fitStats['steps'] = steps
+        atoms.coords = coords
+    scoreAtoms(mapFile, atoms, outFile, sigma=sigma, bFactor=bFactor, bFactorFile=bFactorFile, precision=precision,
+               grid=grid, writeCoords=fit)
+    return fitStats
+
+
+def _scorePair(kwargs):
+    try:
+        return {'fitting': scorePair(**kwargs)}
+    except Exception as e:
+        return {'error': str(e)}
+
+
+def scorePairs(jobs, numberOfProcesses=1):
+    """
+    Run scorePair for every job, a dictionary with its arguments, in a pool of numberOfProcesses
+    workers that stays alive for all of them. Jobs are handed out grouped by map, so that every
+    worker opens each map only once. Returns one dictionary per job,
+    in order, holding the fit statistics under 'fitting' or the error under 'error'.
+    """
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i]['mapFile'])
+    results = [None] * len(jobs)
+    if numberOfProcesses <= 1 or len(jobs) <= 1:
+        for i in order:
+            results[i] = _scorePair(jobs[i])
+        return results
+    chunkSize = max(1, len(jobs) // (numberOfProcesses * 4))
+    with multiprocessing.Pool(min(numberOfProcesses, len(jobs))) as pool:
+        for i, result in zip(order, pool.imap(_scorePair, [jobs[i] for i in order], chunkSize)):
+            results[i] = result
+    return results
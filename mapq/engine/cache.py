@@ -0,0 +1,125 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .volume import readMap
+
+
+def mapDigest(mapFile, slabSize=16):
+    """ Hash of the voxel values and placement of a map, independent of its file name and header details """
+    grid = readMap(mapFile, mmap=True)
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(np.asarray(grid.data.shape, dtype=np.int64).tobytes())
+    digest.update(grid.voxelSize.tobytes())
+    digest.update(grid.origin.tobytes())
+    for z in range(0, grid.data.shape[0], slabSize):
+        digest.update(np.ascontiguousarray(grid.data[z:z + slabSize], dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def fileDigest(fileName):
+    """ Hash of the content of a file """
+    digest = hashlib.blake2b(digest_size=32)
+    with open(fileName, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fileIdentity(fileName):
+    """ Path, size and modification time of a file: a cheap stand-in for its digest, without reading it """
+    stat = os.stat(fileName)
+    return [os.path.realpath(fileName), stat.st_size, stat.st_mtime_ns]
+
+
+def atomsDigest(atoms):
+    """ Hash of the atoms of an AtomTable that take part in scoring: identifiers, elements and coordinates """
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(np.round(atoms.coords, 3).tobytes())
+    digest.update(atoms.serial.tobytes())
+    for column in (atoms.chain, atoms.element):
+        digest.update('\0'.join(column).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent store of per atom Q-scores, addressed by the hash of everything they depend on.
+    Entries are evicted in least recently used order when the store grows over maxSize bytes.
+    """
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(mapHash, atomsHash, **params):
+        content = json.dumps({'map': mapHash, 'atoms': atomsHash, 'params': params}, sort_keys=True)
+        return hashlib.blake2b(content.encode(), digest_size=32).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """ Scores stored under key or None. A hit refreshes the entry for eviction purposes. """
+        path = self._path(key)
+        try:
+            scores = np.load(path)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return scores
+
+    def put(self, key, scores):
+        # Write and rename so concurrent runs never read a partial entry
+        fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            np.save(fh, np.asarray(scores, dtype=np.float64))
+        os.replace(tmpPath, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the total size fits in maxSize """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+
+from .volume import MapGrid
+
+
+# Padding of the region of the map where atoms may move while fitting (Angstroms)
+FIT_MARGIN = 10.
+MAX_STEPS = 2000
+
+
+def rigidTransform(before, after):
+    """
+    Least squares rotation and translation taking the (N, 3) points before onto after (Kabsch),
+    so that after ~= before @ rotation.T + translation.
+    """
+    centerBefore, centerAfter = before.mean(axis=0), after.mean(axis=0)
+    u, _, vt = np.linalg.svd((before - centerBefore).T @ (after - centerAfter))
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1., 1., d]) @ u.T
+    return rotation, centerAfter - centerBefore @ rotation.T
+
+
+def fitStatistics(grid, before, after):
+    """
+    Summary of a rigid fit moving the atoms from before to after, in the terms reported by
+    Chimera's fitmap: shift of the atoms center and rotation angle, plus the average map value
+    at the fitted atom positions and the number of atoms falling outside the map.
+    """
+    rotation, _ = rigidTransform(before, after)
+    angle = np.degrees(np.arccos(np.clip((np.trace(rotation) - 1.) / 2., -1., 1.)))
+    indices = grid.toIndices(after)
+    outside = np.any((indices < 0) | (indices > np.array(grid.getShape()) - 1), axis=1)
+    return {'shift': float(np.linalg.norm(after.mean(axis=0) - before.mean(axis=0))),
+            'angle': float(angle),
+            'averageMapValue': float(np.mean(grid.interpolate(after))),
+            'atoms': int(len(after)),
+            'atomsOutsideMap': int(np.count_nonzero(outside))}
+
+
+def rotate(points, center, axis, angle):
+    """ Rotate (N, 3) points by angle radians around the unit axis going through center """
+    k = np.array([[0., -axis[2], axis[1]], [axis[2], 0., -axis[0]], [-axis[1], axis[0], 0.]])
+    rotation = np.eye(3) + np.sin(angle) * k + (1. - np.cos(angle)) * k @ k
+    return (points - center) @ rotation.T + center
+
+
+def fitAtoms(grid, coords, maxSteps=MAX_STEPS, margin=FIT_MARGIN):
+    """
+    Rigid body fit of the (N, 3) coords into a MapGrid maximizing the average map value at the atom
+    positions, as Chimera's fitmap does. Every step moves the atoms along the mean map gradient and
+    rotates them around their center following the torque of the gradients, both steps being halved
+    whenever the average value does not improve. Map values and gradients are precomputed once
+    over the region the atoms can reach. Returns the fitted coordinates and the number of steps.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    region = grid.crop(coords.min(axis=0) - margin, coords.max(axis=0) + margin)
+    data = np.asarray(region.data, dtype=np.float32)
+    values = MapGrid(data, region.voxelSize, region.origin)
+    gradient = [MapGrid(g, region.voxelSize, region.origin)
+                for g in reversed(np.gradient(data, *region.voxelSize[::-1]))]
+
+    translationStep = 0.5 * np.min(grid.voxelSize)
+    minStep = 0.01 * np.min(grid.voxelSize)
+    radius = np.sqrt(np.mean(np.sum((coords - coords.mean(axis=0)) ** 2, axis=1)))
+    rotationStep = translationStep / max(radius, translationStep)
+
+    current, value = coords, np.mean(values.interpolate(coords))
+    for step in range(maxSteps):
+        center = current.mean(axis=0)
+        g = np.stack([grad.interpolate(current) for grad in gradient], axis=1)
+        force = g.mean(axis=0)
+        torque = np.cross(current - center, g).mean(axis=0)
+        candidate = current
+        if np.any(force):
+            candidate = candidate + translationStep * force / np.linalg.norm(force)
+        if np.any(torque):
+            candidate = rotate(candidate, center, torque / np.linalg.norm(torque), rotationStep)
+        candidateValue = np.mean(values.interpolate(candidate))
+        if candidateValue > value:
+            current, value = candidate, candidateValue
+        else:
+            translationStep, rotationStep = translationStep / 2., rotationStep / 2.
+            if translationStep < minStep:
+                break
+    return current, step + 1
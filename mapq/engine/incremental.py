@@ -0,0 +1,83 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from collections import Counter
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .qscore import MAX_RADIUS
+
+
+# Coordinate differences below this are considered rounding (Angstroms)
+MOVE_TOLERANCE = 0.05
+# Atoms farther than this from a change cannot see it through the shell point rejection
+NEIGHBOURHOOD = 2 * MAX_RADIUS
+
+
+def reusableScores(atoms, previous, tolerance=MOVE_TOLERANCE, neighbourhood=NEIGHBOURHOOD, scored=None):
+    """
+    Compare the atoms of an AtomTable with a previously scored revision of the same structure,
+    given as the AtomTable of its __Q__ file, whose coordinates are in the frame of the map and
+    whose B-factors are the Q-scores. Atoms are matched by chain, residue number, insertion code and
+    atom name.
+    scored may be a boolean mask or the indices of the previous atoms that hold a Q-score, by default
+    its heavy atoms; the others, e.g. outside the selection of the previous run, are never reused.
+    Returns the previous score of every atom (0 when unmatched) and a mask of the atoms that must
+    be scored again: those that are new, moved more than tolerance, have a moved, new or removed
+    atom in their neighbourhood, or were not scored.
+    """
+    if scored is None:
+        scored = previous.heavyAtoms()
+    elif np.asarray(scored).dtype != bool:
+        scored = np.isin(np.arange(len(previous)), scored)
+    # Ambiguous keys (alternate locations, duplicated residues) are never matched
+    keys = list(zip(atoms.chain, atoms.resSeq.tolist(), atoms.iCode, atoms.name))
+    prevKeys = list(zip(previous.chain, previous.resSeq.tolist(), previous.iCode, previous.name))
+    counts, prevCounts = Counter(keys), Counter(prevKeys)
+    prevIndex = {key: i for i, key in enumerate(prevKeys) if prevCounts[key] == 1}
+    match = np.array([prevIndex.get(key, -1) if counts[key] == 1 else -1 for key in keys], dtype=np.int64)
+    matched = match >= 0
+
+    moved = ~matched
+    moved[matched] = np.linalg.norm(previous.coords[match[matched]] - atoms.coords[matched], axis=1) > tolerance
+
+    # Previous positions that are gone: atoms removed or moved away
+    stillThere = np.zeros(len(prevKeys), dtype=bool)
+    stillThere[match[matched & ~moved]] = True
+    changes = np.concatenate([atoms.coords[moved], previous.coords[~stillThere]])
+
+    rescore = moved.copy()
+    if len(changes):
+        near = cKDTree(changes).query(atoms.coords, distance_upper_bound=neighbourhood)[0]
+        rescore |= np.isfinite(near)
+    # Unscored atoms did not change the neighbourhood of the others but have no score to reuse
+    reused = matched.copy()
+    reused[matched] = scored[match[matched]]
+    rescore |= ~reused
+    scores = np.zeros(len(atoms))
+    scores[reused] = previous.bFactor[match[reused]]
+    return scores, rescore
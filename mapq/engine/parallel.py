@@ -0,0 +1,165 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import multiprocessing
+
+import numpy as np
+
+from .qscore import MAX_RADIUS, PRECISION, SIGMA, computeQScores, neighbourAtomIndex
+from .volume import readMap
+
+
+# Shards smaller than this are not worth the inter-process overhead
+MIN_SHARD_SIZE = 500
+# Shards per process, so that slow shards do not leave the pool idle at the end
+SHARDS_PER_PROCESS = 4
+
+# Per worker state, set once by _initWorker
+_worker = {}
+
+
+def spatialShards(coords, chains, maxShardSize):
+    """
+    Split atom indices into spatially coherent shards: one per chain, chains larger than
+    maxShardSize being bisected along their longest axis (octree like) until they fit.
+    The order of the shards and of the indices within them is deterministic.
+    """
+    shards = []
+    for chain in sorted(set(chains)):
+        _bisect(np.flatnonzero(chains == chain), coords, maxShardSize, shards)
+    return shards
+
+
+def _bisect(indices, coords, maxShardSize, shards):
+    if len(indices) <= maxShardSize:
+        shards.append(indices)
+        return
+    points = coords[indices]
+    axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+    order = np.argsort(points[:, axis], kind='stable')
+    half = len(indices) // 2
+    _bisect(np.sort(indices[order[:half]]), coords, maxShardSize, shards)
+    _bisect(np.sort(indices[order[half:]]), coords, maxShardSize, shards)
+
+
+def _initWorker(mapFile, coords, box, kwargs):
+    _worker['grid'] = _openMap(mapFile, box)
+    _worker['coords'] = coords
+    _worker['kwargs'] = kwargs
+    # Built once per worker instead of once per shard
+    _worker['atomIndex'] = neighbourAtomIndex(coords, kwargs.get('precision', PRECISION))
+
+
+def _scoreShard(indices):
+    return computeQScores(_worker['grid'], _worker['coords'], indices, atomIndex=_worker['atomIndex'],
+                          **_worker['kwargs'])
+
+
+def _openMap(mapFile, box=None):
+    grid = readMap(mapFile, mmap=True)
+    return grid if box is None else grid.crop(*box)
+
+
+def parallelQScores(mapFile, coords, chains, indices=None, numberOfProcesses=1, cropMap=True, atomIndex=None,
+                    grid=None, **kwargs):
+    """
+    Q-scores of the atoms in coords selected by indices (all by default), scored in a pool of
+    numberOfProcesses workers. Every worker memory maps mapFile read-only, so the map is never copied.
+    With cropMap, scoring only reads the bounding box of the scored atoms padded by the sampling
+    radius, and no other part of the map is ever read (see computeQScores).
+    Shard results are written back by atom index, making the output independent of the order in
+    which shards finish. A sequence of sigma values gives one column of scores per value.
+    An atomIndex of coords (see neighbourAtomIndex) may be given when scoring them in several calls;
+    workers always build their own. Coordinates are shipped to the workers in the scoring precision.
+    grid may be the MapGrid of mapFile already in memory, used instead of memory mapping the file when
+    scoring in this process.
+    """
+    coords = np.asarray(coords, dtype=kwargs.get('precision', PRECISION))
+    indices = np.arange(len(coords)) if indices is None else np.asarray(indices)
+    grid = readMap(mapFile, mmap=True) if grid is None else grid
+    box = None
+    if cropMap and len(indices):
+        margin = kwargs.get('maxRadius', MAX_RADIUS) + np.max(grid.voxelSize)
+        box = (coords[indices].min(axis=0) - margin, coords[indices].max(axis=0) + margin)
+        grid = grid.crop(*box)
+
+    if numberOfProcesses <= 1 or len(indices) < 2 * MIN_SHARD_SIZE:
+        return computeQScores(grid, coords, indices, atomIndex=atomIndex, **kwargs)
+    with ScoringPool(mapFile, coords, chains, numberOfProcesses, box=box, **kwargs) as pool:
+        return pool.score(indices)
+
+
+class ScoringPool:
+    """
+    Scoring of subsets of the atoms in coords against mapFile in several calls, e.g. batch after batch,
+    by a pool of numberOfProcesses workers started once. Every worker memory maps mapFile, cropped to
+    box when given, and builds the neighbourAtomIndex of coords once, so every call only ships the
+    indices of its atoms. With a single process the atoms are scored in this one, reusing grid and
+    atomIndex when given. Use it as a context manager to stop the workers.
+    """
+    def __init__(self, mapFile, coords, chains, numberOfProcesses=1, box=None, grid=None, atomIndex=None,
+                 **kwargs):
+        self.coords = np.asarray(coords, dtype=kwargs.get('precision', PRECISION))
+        self.chains = np.asarray(chains)
+        self.numberOfProcesses = numberOfProcesses
+        self.kwargs = kwargs
+        self.atomIndex = atomIndex
+        self.grid = None
+        self.pool = None
+        if numberOfProcesses > 1:
+            self.pool = multiprocessing.Pool(numberOfProcesses, initializer=_initWorker,
+                                             initargs=(mapFile, self.coords, box, kwargs))
+        else:
+            grid = readMap(mapFile, mmap=True) if grid is None else grid
+            self.grid = grid if box is None else grid.crop(*box)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def score(self, indices):
+        """ Q-scores of the atoms of coords selected by indices, as parallelQScores """
+        indices = np.asarray(indices)
+        if self.pool is None:
+            if self.atomIndex is None:
+                self.atomIndex = neighbourAtomIndex(self.coords, self.kwargs.get('precision', PRECISION))
+            return computeQScores(self.grid, self.coords, indices, atomIndex=self.atomIndex, **self.kwargs)
+        shardSize = max(MIN_SHARD_SIZE,
+                        int(np.ceil(len(indices) / (self.numberOfProcesses * SHARDS_PER_PROCESS))))
+        shards = [indices[shard] for shard in spatialShards(self.coords[indices], self.chains[indices], shardSize)]
+        position = np.empty(len(self.coords), dtype=np.int64)
+        position[indices] = np.arange(len(indices))
+        scores = np.zeros((len(indices),) + np.shape(self.kwargs.get('sigma', SIGMA)), dtype=np.float64)
+        for shard, shardScores in zip(shards, self.pool.imap(_scoreShard, shards)):
+            scores[position[shard]] = shardScores
+        return scores
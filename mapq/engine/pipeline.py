@@ -0,0 +1,186 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import contextlib
+import json
+
+import numpy as np
+
+from .incremental import MOVE_TOLERANCE, reusableScores
+from .parallel import ScoringPool, parallelQScores
+from .qscore import PRECISION, SIGMA
+from .structure import (formatPdbAtoms, iterPdbAtoms, readAtomColumns, readPdbAtoms, writePdbAtoms,
+                        writePdbBFactors)
+from .symmetry import symmetricQScores
+from .volume import readMap
+
+
+def scoreStructure(mapFile, pdbFile, outFile, **kwargs):
+    """ Score the atoms of pdbFile against mapFile, see scoreAtoms """
+    return scoreAtoms(mapFile, readPdbAtoms(pdbFile), outFile, **kwargs)
+
+
+def scoreAtoms(mapFile, atoms, outFile, sigma=SIGMA, bFactor=None, bFactorFile=None,
+               numberOfProcesses=1, cropMap=True, previous=None, moveTolerance=MOVE_TOLERANCE,
+               symmetry=None, checkCopies=1, symmetryReport=None, sweep=None, localResolution=None,
+               resolutionFile=None, localSigma=False, resolution=None, precision=PRECISION, selection=None,
+               grid=None, previousScored=None, writeCoords=False):
+    """
+    Score the atoms of an AtomTable against mapFile and write them to outFile with the Q-score in the
+    B-factor column, mirroring the __Q__ files produced by mapq_cmd.py. Hydrogens are not scored.
+    The records of the atoms are written as read, or with their current coordinates with writeCoords.
+    previous may be the __Q__ file of an already scored revision of the structure, in which case
+    only the atoms that moved more than moveTolerance Angstroms, or whose neighbourhood changed,
+    are scored again. previousScored may be the atoms of previous that hold a Q-score, see
+    reusableScores.
+    symmetry may be a list of (4, 4) symmetry matrices of the map, in which case only an asymmetric
+    unit and checkCopies of its copies are scored (see symmetricQScores), the report being written
+    as JSON to symmetryReport.
+    sweep may be a list of (sigma, fileName) pairs, in which case the atoms are also scored with every
+    other sigma, sampling the map only once, and written to fileName like outFile. It can not be
+    combined with symmetry or previous, which do not score every atom.
+    localResolution may be a local resolution map in the frame of mapFile. The resolution at every
+    atom is then written to resolutionFile, see atomResolution, and with localSigma the reference
+    Gaussian of every atom is scaled by its local resolution over resolution (by default the median
+    local resolution of the atoms).
+    precision is the floating point type, float32 or float64, in which the map is sampled.
+    selection may be a boolean mask of the atoms to score, e.g. from selectAtoms. The other atoms get a
+    score of 0 but still reject the shell points close to them, so the selected atoms get the same
+    scores as in a run scoring every atom, and with cropMap only the region around them is read.
+    grid may be the MapGrid of mapFile when already loaded, e.g. by the scoring server or the workers
+    of scorePairs.
+    """
+    sweep = sweep or []
+    if sweep and (symmetry is not None or previous is not None):
+        raise ValueError("A sigma sweep can not be combined with symmetry or previous Q-scores")
+    if selection is not None and symmetry is not None:
+        raise ValueError("A selection can not be combined with symmetry")
+    heavy = atoms.heavyAtoms()
+    selected = heavy if selection is None else heavy & selection
+    qScores = np.zeros(len(atoms))
+    sweepScores = np.zeros((len(atoms), len(sweep)))
+    toScore = selected
+    sigmaScale = None
+    if localResolution is not None:
+        resolutions = atomResolution(localResolution, atoms, resolutionFile)
+        if localSigma:
+            sigmaScale = localSigmaScale(resolutions[heavy], resolution)
+    if symmetry is not None:
+        labels = np.char.add(np.char.add(atoms.resName[heavy], ' '), atoms.name[heavy])
+        qScores[heavy], report = symmetricQScores(mapFile, atoms.coords[heavy], atoms.chain[heavy], labels,
+                                                  symmetry, checkCopies, numberOfProcesses=numberOfProcesses,
+                                                  cropMap=cropMap, sigma=sigma, sigmaScale=sigmaScale,
+                                                  precision=precision, grid=grid)
+        if symmetryReport:
+            with open(symmetryReport, 'w') as fh:
+                json.dump(report, fh, indent=2)
+        toScore = np.zeros(len(atoms), dtype=bool)
+    elif previous is not None:
+        qScores, rescore = reusableScores(atoms, readPdbAtoms(previous), tolerance=moveTolerance,
+                                          scored=previousScored)
+        toScore = selected & rescore
+        print("Reusing %d previous Q-scores, scoring %d atoms" % (np.count_nonzero(selected & ~rescore),
+                                                                 np.count_nonzero(toScore)))
+
+    if np.any(toScore):
+        # The first column holds the scores for sigma, the others those of the sweep
+        scores = parallelQScores(mapFile, atoms.coords[heavy], atoms.chain[heavy],
+                                 indices=np.flatnonzero(toScore[heavy]),
+                                 numberOfProcesses=numberOfProcesses, cropMap=cropMap,
+                                 sigma=[sigma] + [width for width, _ in sweep], sigmaScale=sigmaScale,
+                                 precision=precision, grid=grid)
+        qScores[toScore] = scores[:, 0]
+        sweepScores[toScore] = scores[:, 1:]
+    qScores[~selected] = 0.
+    sweepScores[~selected] = 0.
+    coords = atoms.coords if writeCoords else None
+    writePdbAtoms(atoms, outFile, coords=coords, bFactors=qScores)
+    for (_, fileName), values in zip(sweep, sweepScores.T):
+        writePdbAtoms(atoms, fileName, coords=coords, bFactors=values)
+    if bFactor and bFactorFile:
+        writePdbAtoms(atoms, bFactorFile, coords=coords, bFactors=bFactor * (1. - qScores))
+    return qScores
+
+
+def streamScoreStructure(mapFile, pdbFile, outFile, batchSize, sigma=SIGMA, bFactor=None, bFactorFile=None,
+                         numberOfProcesses=1, precision=PRECISION, grid=None):
+    """
+    As scoreStructure, for structures too big to be handled at once. The PDB records are read,
+    scored and written in batches of about batchSize atoms, cut at chain or residue boundaries,
+    and the memory mapped map is only read around the atoms of each batch. Only a compact record of
+    every atom (see readAtomColumns), needed to reject shell points near neighbours from other
+    batches, is kept in memory. The worker pool and the neighbour index of all the atoms are set up
+    once and reused by every batch (see ScoringPool). grid is used as in scoreAtoms.
+    """
+    columns, _ = readAtomColumns(pdbFile, batchSize, precision)
+    heavy = columns['heavy']
+    heavyCoords = columns['coords'][heavy]
+    heavyChains = columns['chain'][heavy]
+    # Position of every heavy atom among heavyCoords
+    heavyIndex = np.cumsum(heavy) - 1
+    qScores = columns['score']
+    with contextlib.ExitStack() as stack:
+        pool = stack.enter_context(ScoringPool(mapFile, heavyCoords, heavyChains, numberOfProcesses,
+                                               grid=grid, sigma=sigma, precision=precision))
+        fhQ = stack.enter_context(open(outFile, 'w'))
+        fhB = stack.enter_context(open(bFactorFile, 'w')) if bFactor and bFactorFile else None
+        start = 0
+        for atoms in iterPdbAtoms(pdbFile, batchSize):
+            stop = start + len(atoms)
+            batchHeavy = heavy[start:stop]
+            if np.any(batchHeavy):
+                print("Scoring atoms %d to %d of %d..." % (start + 1, stop, len(columns)))
+                qScores[start:stop][batchHeavy] = pool.score(heavyIndex[start:stop][batchHeavy])
+            fhQ.writelines(formatPdbAtoms(atoms, bFactors=qScores[start:stop]))
+            if fhB is not None:
+                fhB.writelines(formatPdbAtoms(atoms, bFactors=bFactor * (1. - qScores[start:stop])))
+            start = stop
+        fhQ.write('END\n')
+        if fhB is not None:
+            fhB.write('END\n')
+    return qScores
+
+
+def atomResolution(localResolution, atoms, resolutionFile=None):
+    """
+    Local resolution at the atoms of an AtomTable, interpolated from the localResolution map. Atoms
+    outside the map or where it holds no valid resolution get NaN. When given, resolutionFile is
+    written like the __Q__ files with the resolution (0 when unknown) in the B-factor column.
+    """
+    resolutions = readMap(localResolution, mmap=True).interpolate(atoms.coords)
+    resolutions[~(resolutions > 0)] = np.nan
+    if resolutionFile:
+        writePdbBFactors(atoms, np.nan_to_num(resolutions), resolutionFile)
+    return resolutions
+
+
+def localSigmaScale(resolutions, resolution=None):
+    """ Per atom factor of sigma following the local resolutions, 1 where they are unknown """
+    valid = np.isfinite(resolutions)
+    if not np.any(valid):
+        return np.ones(len(resolutions))
+    resolution = resolution or np.median(resolutions[valid])
+    return np.where(valid, resolutions / resolution, 1.)
@@ -0,0 +1,75 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import tempfile
+
+import numpy as np
+
+from .fitting import fitAtoms, fitStatistics
+from .structure import iterPdbAtoms, readAtomColumns, readPdbAtoms, writePdbAtomBatches, writePdbAtoms
+from .volume import readMap
+
+
+def prepareStructure(pdbFile, outFile, mapFile=None, newOrigin=(0., 0., 0.), batchSize=None):
+    """
+    Move the geometric center of the atoms of pdbFile to newOrigin and, given mapFile, fit them
+    into the map, writing the result to outFile once. Both transforms are applied to the whole
+    (N, 3) coordinate array. With batchSize, the PDB records are read and written in batches of
+    that many atoms and only the coordinates are held in memory.
+    Returns the statistics of the fit, holding an 'error' entry if it failed (the centered
+    coordinates are written then), or None when not fitting.
+    """
+    if batchSize:
+        coords = readAtomColumns(pdbFile, batchSize, np.float64)[0]['coords']
+    else:
+        atoms = readPdbAtoms(pdbFile)
+        coords = atoms.coords
+    coords = coords + (np.asarray(newOrigin, dtype=np.float64) - coords.mean(axis=0))
+    stats = None
+    if mapFile is not None:
+        try:
+            grid = readMap(mapFile, mmap=True)
+            fitted, steps = fitAtoms(grid, coords)
+            stats = fitStatistics(grid, coords, fitted)
+            stats['steps'] = steps
+            coords = fitted
+        except Exception as e:
+            stats = {'error': str(e)}
+    # Written next to outFile and renamed, as pdbFile is still read in batches and may be outFile itself
+    fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outFile)), suffix='.pdb')
+    os.close(fd)
+    try:
+        if batchSize:
+            writePdbAtomBatches(iterPdbAtoms(pdbFile, batchSize), tmpFile, coords=coords)
+        else:
+            writePdbAtoms(atoms, tmpFile, coords=coords)
+        os.replace(tmpFile, outFile)
+    finally:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+    return stats
+
@@ -0,0 +1,148 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+
+# Records of concurrent steps are appended to the same file
+_lock = threading.Lock()
+# A profiler sees the calls of every thread since Python 3.12, and only one may be active at a time
+_profileLock = threading.Lock()
+# Stages open in the current thread
+_stages = threading.local()
+
+
+def _ioCounters():
+    """ Bytes read and written by this process through system calls, None where /proc is missing """
+    try:
+        with open('/proc/self/io') as fh:
+            counters = dict(line.split(':') for line in fh)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peakRss():
+    """ High-water resident memory in bytes of this process and of its finished children """
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+class StageProfiler:
+    """
+    Writes one JSON line per timed stage to logFile with its wall time, the CPU time of the calling
+    thread and of the child processes finished meanwhile (workers, Chimera), the peak RSS of the
+    process and of its children so far, and the bytes read and written by the process. Stages run
+    concurrently in other threads share the process counters, so their IO may be counted twice.
+    With profileDir, every outermost stage, i.e. every step, is also profiled with cProfile, one .prof
+    file per step holding its nested stages. Profiled steps run one at a time, so that their profiles
+    never hold the calls of steps run by other threads.
+    """
+    def __init__(self, logFile, profileDir=None):
+        self.logFile = logFile
+        self.profileDir = profileDir
+
+    @contextlib.contextmanager
+    def stage(self, name, structure=None):
+        depth = getattr(_stages, 'depth', 0)
+        with contextlib.ExitStack() as stack:
+            profiler = None
+            if self.profileDir and depth == 0:
+                os.makedirs(self.profileDir, exist_ok=True)
+                stack.enter_context(_profileLock)
+                profiler = cProfile.Profile()
+                stack.callback(profiler.dump_stats, os.path.join(self.profileDir, '%s%s.prof'
+                                                                 % (name, '_' + structure if structure else '')))
+            _stages.depth = depth + 1
+            try:
+                with self._timed(name, structure):
+                    if profiler is None:
+                        yield
+                    else:
+                        with profiler:
+                            yield
+            finally:
+                _stages.depth = depth
+
+    @contextlib.contextmanager
+    def _timed(self, name, structure):
+        read0, written0 = _ioCounters()
+        children0 = os.times()
+        start, cpu0 = time.time(), time.thread_time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            children1 = os.times()
+            read1, written1 = _ioCounters()
+            self.record(name, structure, start=start, wall=time.time() - start,
+                        cpu=time.thread_time() - cpu0,
+                        childrenCpu=(children1.children_user + children1.children_system -
+                                     children0.children_user - children0.children_system),
+                        bytesRead=None if read0 is None else read1 - read0,
+                        bytesWritten=None if written0 is None else written1 - written0,
+                        error=error)
+
+    def record(self, name, structure=None, **values):
+        """ Append a record for a stage, e.g. one timed outside this process """
+        peakRss, peakRssChildren = _peakRss()
+        record = {'stage': name, 'structure': structure, 'peakRss': peakRss, 'peakRssChildren': peakRssChildren}
+        record.update(values)
+        with _lock, open(self.logFile, 'a') as fh:
+            fh.write(json.dumps(record) + '\n')
+
+
+def readStageRecords(logFile):
+    """ Records written by StageProfiler, in order """
+    if not os.path.exists(logFile):
+        return []
+    with open(logFile) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def stageTotals(records):
+    """ Per stage totals of the records, in order of first appearance: count, wall and CPU seconds,
+    bytes read and written and the largest peak RSS """
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'count': 0, 'wall': 0., 'cpu': 0., 'bytesRead': 0,
+                                                    'bytesWritten': 0, 'peakRss': 0})
+        total['count'] += 1
+        total['wall'] += record.get('wall') or 0.
+        total['cpu'] += (record.get('cpu') or 0.) + (record.get('childrenCpu') or 0.)
+        total['bytesRead'] += record.get('bytesRead') or 0
+        total['bytesWritten'] += record.get('bytesWritten') or 0
+        total['peakRss'] = max(total['peakRss'], record.get('peakRss') or 0, record.get('peakRssChildren') or 0)
+    return totals
@@ -0,0 +1,161 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+# Defaults used by mapq_cmd.py
+SIGMA = 0.6
+NUM_POINTS = 8
+MAX_RADIUS = 2.0
+RADIUS_STEP = 0.1
+# Number of progressively denser spirals tried when shell points clash with neighbour atoms
+NUM_TRIES = 10
+CHUNK_SIZE = 64
+# Floating point type of the coordinates, sample points and interpolated values
+PRECISION = np.float32
+
+
+def sphereDirections(numPoints):
+    """ Unit vectors evenly spread over a sphere following a golden spiral """
+    k = np.arange(numPoints, dtype=np.float64) + 0.5
+    phi = np.arccos(1. - 2. * k / numPoints)
+    theta = np.pi * (1. + 5. ** 0.5) * k
+    return np.stack([np.cos(theta) * np.sin(phi),
+                     np.sin(theta) * np.sin(phi),
+                     np.cos(phi)], axis=1)
+
+
+def shellRadii(maxRadius=MAX_RADIUS, step=RADIUS_STEP):
+    return np.arange(0., maxRadius + step / 2., step)
+
+
+def referenceGaussian(radii, sigma, mapMean, mapStd):
+    """ Reference profile of a well resolved atom, scaled to the map value range used by mapq """
+    minD, maxD = mapMean - mapStd, mapMean + 10. * mapStd
+    return (maxD - minD) * np.exp(-0.5 * (np.asarray(radii) / sigma) ** 2) + minD
+
+
+def computeQScores(grid, coords, indices=None, sigma=SIGMA, numPoints=NUM_POINTS, maxRadius=MAX_RADIUS,
+                   step=RADIUS_STEP, mapStats=None, chunkSize=CHUNK_SIZE, sigmaScale=None, atomIndex=None,
+                   precision=PRECISION):
+    """
+    Compute the Q-score of the atoms in coords (N, 3) selected by indices (all of them by default)
+    against a MapGrid. Every atom in coords takes part in the rejection of shell points.
+
+    For each atom, points are sampled on shells of increasing radius. Points closer than 0.9 times
+    the shell radius to any other atom are discarded and, as in mapq, denser spirals are tried until
+    numPoints points of the shell are accepted. The Q-score is the correlation about the mean between
+    the interpolated map values and a reference Gaussian of width sigma evaluated at the same radii.
+    mapq scales that Gaussian with the mean and standard deviation of the map, which may be given as
+    mapStats, but any positive scale gives the same correlation, so they are never computed: scoring
+    only reads the map around the atoms.
+
+    sigma may also be a sequence of widths, in which case the map is sampled once and the scores
+    for every width are returned as an (N, len(sigma)) array. sigmaScale may give a factor per atom
+    in coords applying to the width of its reference Gaussian, e.g. following the local resolution.
+    atomIndex may be the neighbourAtomIndex of coords, so that callers scoring the same atoms in
+    several calls build it only once.
+    Coordinates, sample points and map values are handled in the given precision (float32 or
+    float64), while the correlations are always accumulated in float64.
+    """
+    coords = np.asarray(coords, dtype=precision)
+    indices = np.arange(len(coords)) if indices is None else np.asarray(indices)
+    # The correlation about the mean does not change with the offset and positive scale that the map
+    # statistics give the reference Gaussian, so the map is never scanned for them
+    mapMean, mapStd = mapStats if mapStats is not None else (0., 1.)
+    radii = shellRadii(maxRadius, step)
+    sigmas = np.atleast_1d(np.asarray(sigma, dtype=np.float64))
+    references = [referenceGaussian(radii, width, mapMean, mapStd) for width in sigmas]
+
+    if atomIndex is None:
+        atomIndex = neighbourAtomIndex(coords, precision)
+
+    scores = np.zeros((len(indices), len(sigmas)), dtype=np.float64)
+    for start in range(0, len(indices), chunkSize):
+        chunk = indices[start:start + chunkSize]
+        atomIdx, shellIdx, points = shellPoints(coords[chunk], atomIndex, radii.astype(precision), numPoints)
+        u = grid.interpolate(points)
+        for k, reference in enumerate(references):
+            if sigmaScale is None:
+                v = reference[shellIdx]
+            else:
+                v = referenceGaussian(radii[shellIdx], sigmas[k] * sigmaScale[chunk][atomIdx], mapMean, mapStd)
+            scores[start:start + chunkSize, k] = _correlationAboutMean(atomIdx, u, v, len(chunk))
+    return scores if np.ndim(sigma) else scores[:, 0]
+
+
+def neighbourAtomIndex(coords, precision=PRECISION):
+    """ Spatial index of the atoms in coords (N, 3) used to reject shell points close to them """
+    return cKDTree(np.asarray(coords, dtype=precision))
+
+
+def shellPoints(centers, atomIndex, radii, numPoints=NUM_POINTS, numTries=NUM_TRIES):
+    """
+    Accepted sample points around every center, rejecting those close to the atoms of atomIndex
+    (see neighbourAtomIndex). Returns the center index and shell index of each point together with
+    the (M, 3) point coordinates.
+    """
+    nShells = len(radii)
+    pendingAtom = np.repeat(np.arange(len(centers)), nShells)
+    pendingShell = np.tile(np.arange(nShells), len(centers))
+    atomIdx, shellIdx, points = [], [], []
+
+    for i in range(numTries):
+        directions = sphereDirections(numPoints + 2 * i).astype(centers.dtype)
+        candidates = (centers[pendingAtom][:, None, :] +
+                      radii[pendingShell][:, None, None] * directions[None, :, :])
+        # Only atoms closer than the largest rejection distance matter, farther ones come back as inf
+        closest = atomIndex.query(candidates.reshape(-1, 3), distance_upper_bound=0.9 * np.max(radii) + 1e-6)[0]
+        accepted = closest.reshape(candidates.shape[:2]) >= 0.9 * radii[pendingShell][:, None]
+        done = accepted.sum(axis=1) >= numPoints
+        if i == numTries - 1:
+            done[:] = True
+        keep = accepted & (np.cumsum(accepted, axis=1) <= numPoints) & done[:, None]
+        pairIdx, candIdx = np.nonzero(keep)
+        atomIdx.append(pendingAtom[pairIdx])
+        shellIdx.append(pendingShell[pairIdx])
+        points.append(candidates[pairIdx, candIdx])
+        pendingAtom, pendingShell = pendingAtom[~done], pendingShell[~done]
+        if len(pendingAtom) == 0:
+            break
+
+    return np.concatenate(atomIdx), np.concatenate(shellIdx), np.concatenate(points)
+
+
+def _correlationAboutMean(atomIdx, u, v, nAtoms):
+    """ Per atom correlation about the mean of the paired samples u and v """
+    n = np.bincount(atomIdx, minlength=nAtoms).astype(np.float64)
+    n[n == 0] = 1.
+    du = u - (np.bincount(atomIdx, u, nAtoms) / n)[atomIdx]
+    dv = v - (np.bincount(atomIdx, v, nAtoms) / n)[atomIdx]
+    num = np.bincount(atomIdx, du * dv, nAtoms)
+    den = np.sqrt(np.bincount(atomIdx, du * du, nAtoms) * np.bincount(atomIdx, dv * dv, nAtoms))
+    scores = np.zeros(nAtoms)
+    valid = den > 0
+    scores[valid] = num[valid] / den[valid]
+    return scores
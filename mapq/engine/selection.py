@@ -0,0 +1,74 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import re
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def parseResidueRanges(text):
+    """
+    (chain, first, last) residue ranges of a text like 'A:10-25, B:40 100-120', where a range
+    without chain applies to every chain (chain None) and a single number selects one residue
+    """
+    ranges = []
+    for token in re.split(r'[,\s]+', text.strip()):
+        if not token:
+            continue
+        chain, _, numbers = token.rpartition(':')
+        match = re.fullmatch(r'(-?\d+)(?:-(-?\d+))?', numbers)
+        if match is None:
+            raise ValueError("Invalid residue range: %s" % token)
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) is not None else first
+        ranges.append((chain or None, min(first, last), max(first, last)))
+    return ranges
+
+
+def selectAtoms(atoms, chains=None, residueRanges=None, ligands=None, radius=0.):
+    """
+    Boolean mask of the atoms of an AtomTable in a region of interest. Atoms must belong to one of
+    chains, when given, and to one of the (chain, first, last) residueRanges or to a residue named as
+    one of ligands, when any of them is given. With a radius, every residue with an atom closer than
+    radius Angstroms to the selected atoms is added as a whole, e.g. the pocket around a ligand.
+    """
+    selected = np.ones(len(atoms), dtype=bool)
+    if chains:
+        selected &= np.isin(atoms.chain, list(chains))
+    if residueRanges or ligands:
+        inResidues = np.zeros(len(atoms), dtype=bool)
+        for chain, first, last in residueRanges or []:
+            inRange = (atoms.resSeq >= first) & (atoms.resSeq <= last)
+            inResidues |= inRange if chain is None else inRange & (atoms.chain == chain)
+        if ligands:
+            inResidues |= np.isin(atoms.resName, [ligand.upper() for ligand in ligands])
+        selected &= inResidues
+    if radius and np.any(selected):
+        distances = cKDTree(atoms.coords[selected]).query(atoms.coords, distance_upper_bound=radius)[0]
+        residues = np.char.add(np.char.add(atoms.chain, ':'), atoms.resSeq.astype(str))
+        selected |= np.isin(residues, residues[distances <= radius])
+    return selected
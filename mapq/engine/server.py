@@ -0,0 +1,225 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import argparse
+import contextlib
+import io
+import os
+import signal
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.connection import Client, Listener
+
+from .pipeline import scoreStructure, streamScoreStructure
+from .volume import INTERPOLATION_SUFFIX, PLACEMENT_SUFFIX, readMap
+
+
+# Maps kept in memory by the server, in least recently used order
+MAX_CACHED_MAPS = 4
+KEY_SUFFIX = '.key'
+
+# Functions the server runs, all taking the map file as first argument
+SERVER_FUNCTIONS = {function.__name__: function for function in (scoreStructure, streamScoreStructure)}
+
+
+class MapCache:
+    """
+    Maps loaded in memory, keeping the maxMaps most recently used ones.
+    Maps are identified by the path, modification time and size of their file and of the placement and
+    interpolation files next to it, so a map is loaded again when any of them changes.
+    """
+    def __init__(self, maxMaps=MAX_CACHED_MAPS):
+        self.maxMaps = maxMaps
+        self._maps = OrderedDict()
+
+    def get(self, mapFile):
+        """ MapGrid of mapFile """
+        mapFile = os.path.abspath(mapFile)
+        key = tuple((fileName, os.stat(fileName).st_mtime_ns, os.stat(fileName).st_size)
+                    for fileName in (mapFile, mapFile + PLACEMENT_SUFFIX, mapFile + INTERPOLATION_SUFFIX)
+                    if fileName == mapFile or os.path.exists(fileName))
+        if key in self._maps:
+            self._maps.move_to_end(key)
+        else:
+            self._maps[key] = readMap(mapFile)
+            while len(self._maps) > self.maxMaps:
+                self._maps.popitem(last=False)
+        return self._maps[key]
+
+
+class ScoringServer:
+    """
+    Local server running the scoring functions of the pipeline (see SERVER_FUNCTIONS) for clients of
+    scoreOnServer, over a Unix socket at address. The interpreter and the imported modules stay warm
+    between jobs and the maps are kept in a MapCache. Jobs are run one at a time, each one with the
+    processes it asks for. Clients authenticate with a random key stored next to the socket. Both live
+    in a directory only accessible by the user running the server, created if needed.
+    """
+    def __init__(self, address, maxMaps=MAX_CACHED_MAPS):
+        self.address = address
+        self.maps = MapCache(maxMaps)
+
+    def serve(self):
+        """ Accept and run jobs until interrupted """
+        directory = os.path.dirname(os.path.abspath(self.address))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if not isPrivate(directory):
+            raise RuntimeError("The directory of the socket, %s, must only be accessible by its owner" % directory)
+        if os.path.exists(self.address):
+            if serverRunning(self.address):
+                raise RuntimeError("A scoring server is already running at %s" % self.address)
+            os.remove(self.address)
+        authkey = os.urandom(32)
+        keyFile = self.address + KEY_SUFFIX
+        fd = os.open(keyFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(authkey)
+        print("MapQ scoring server listening at %s" % self.address)
+        try:
+            with Listener(self.address, family='AF_UNIX', authkey=authkey) as listener:
+                os.chmod(self.address, 0o600)
+                while True:
+                    try:
+                        connection = listener.accept()
+                    except (OSError, EOFError) as e:
+                        # Failed authentication or a client gone before sending its job
+                        print("Rejected connection: %s" % e)
+                        continue
+                    with connection:
+                        self.handle(connection)
+        finally:
+            self.removeFiles()
+
+    def removeFiles(self):
+        """ Remove the socket and key files of the server """
+        for fileName in (self.address, self.address + KEY_SUFFIX):
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def handle(self, connection):
+        """ Run the job received from connection, sending back its result and printed output """
+        try:
+            job = connection.recv()
+        except (OSError, EOFError):
+            return
+        start = time.time()
+        output = io.StringIO()
+        cwd = os.getcwd()
+        try:
+            function = SERVER_FUNCTIONS[job['function']]
+            args, kwargs = job['args'], job['kwargs']
+            os.chdir(job['cwd'])
+            with contextlib.redirect_stdout(output):
+                result = {'result': function(*args, grid=self.maps.get(args[0]), **kwargs)}
+        except Exception:
+            result = {'error': traceback.format_exc()}
+        finally:
+            os.chdir(cwd)
+        result['output'] = output.getvalue()
+        print("%s %s in %.2f s" % ("Failed" if 'error' in result else "Ran", job.get('function'), time.time() - start))
+        try:
+            connection.send(result)
+        except (OSError, EOFError):
+            pass
+
+
+def serverRunning(address):
+    """ True if a scoring server accepts connections at address """
+    try:
+        _connect(address).close()
+        return True
+    except ConnectionError:
+        return False
+
+
+def isPrivate(path):
+    """ True if path is owned by the current user and neither its group nor others can access it """
+    stat = os.lstat(path)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+
+def _connect(address):
+    """ Authenticated connection to the scoring server at address, ConnectionError if there is none or
+    its files may have been written by another user """
+    try:
+        keyFile = address + KEY_SUFFIX
+        if not isPrivate(os.path.dirname(os.path.abspath(address))) or not isPrivate(keyFile):
+            raise PermissionError("its directory and key are not private to the current user")
+        with open(keyFile, 'rb') as fh:
+            authkey = fh.read()
+        return Client(address, family='AF_UNIX', authkey=authkey)
+    except (OSError, EOFError) as e:
+        raise ConnectionError("No MapQ scoring server at %s (%s)" % (address, e))
+
+
+def scoreOnServer(address, function, *args, **kwargs):
+    """
+    Run the pipeline function named function, e.g. 'scoreStructure', with the given arguments in the
+    scoring server at address and return its result. Relative paths are taken from the current
+    directory and the output of the job is printed here. Raises ConnectionError when no server is
+    running or it goes away before answering, so callers can score by themselves instead.
+    """
+    connection = _connect(address)
+    with connection:
+        try:
+            connection.send({'function': function, 'args': args, 'kwargs': kwargs, 'cwd': os.getcwd()})
+            result = connection.recv()
+        except (OSError, EOFError) as e:
+            raise ConnectionError("The MapQ scoring server at %s did not answer (%s)" % (address, e))
+    print(result['output'], end='')
+    if 'error' in result:
+        raise Exception("Scoring failed in the MapQ scoring server:\n%s" % result['error'])
+    return result['result']
+
+
+def main():
+    import mapq  # Local import, the engine does not depend on Scipion otherwise
+    parser = argparse.ArgumentParser(description="Warm MapQ scoring server for the native engine")
+    parser.add_argument('--socket', default=mapq.SERVER_SOCKET,
+                        help="Unix socket to listen at (MAPQ_SERVER_SOCKET, default %(default)s)")
+    parser.add_argument('--maps', type=int, default=MAX_CACHED_MAPS,
+                        help="Maps kept in memory (default %(default)s)")
+    args = parser.parse_args()
+    server = ScoringServer(args.socket, args.maps)
+
+    serverPid = os.getpid()
+
+    def terminate(signum, frame):
+        # Forked pool workers inherit the handler and are terminated with SIGTERM at the end of every job
+        if os.getpid() == serverPid:
+            server.removeFiles()
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import numpy as np
+
+
+ATOM_RECORDS = ('ATOM  ', 'HETATM')
+SCIPION_ATTRIBUTES = '_scipion_attributes.'
+# Atoms read at once when converting PDB files to mmCIF
+CIF_BATCH_SIZE = 100000
+
+
+class AtomTable:
+    """
+    Column oriented view of the atoms of a PDB file. Every attribute is an array with one
+    entry per ATOM/HETATM record, in file order. The original lines are kept so the file
+    can be written back changing only the B-factor column. position is the number of every
+    record among those of its file, starting at 1, iCode the insertion code of its residue and
+    model the number of its MODEL (1 for files without them).
+    """
+    def __init__(self, lines, serial, name, resName, chain, resSeq, element, coords, bFactor, position=None,
+                 iCode=None, model=None):
+        self.lines = lines
+        self.serial = serial
+        self.name = name
+        self.resName = resName
+        self.chain = chain
+        self.resSeq = resSeq
+        self.element = element
+        self.coords = coords
+        self.bFactor = bFactor
+        self.position = np.arange(1, len(serial) + 1) if position is None else position
+        self.iCode = np.full(len(serial), '') if iCode is None else iCode
+        self.model = np.ones(len(serial), dtype=np.int64) if model is None else model
+
+    def __len__(self):
+        return len(self.serial)
+
+    def heavyAtoms(self):
+        """ Boolean mask of the non hydrogen atoms """
+        return ~np.isin(self.element, ('H', 'D'))
+
+    def subset(self, mask):
+        """ AtomTable of the atoms selected by a boolean mask or an index array, in file order """
+        indices = np.flatnonzero(mask) if np.asarray(mask).dtype == bool else np.asarray(mask)
+        return AtomTable([self.lines[i] for i in indices], self.serial[indices], self.name[indices],
+                         self.resName[indices], self.chain[indices], self.resSeq[indices], self.element[indices],
+                         self.coords[indices], self.bFactor[indices], self.position[indices], self.iCode[indices],
+                         self.model[indices])
+
+
+def readPdbAtoms(fileName):
+    """ Parse the ATOM/HETATM records of a PDB file into an AtomTable """
+    with open(fileName) as fh:
+        records = list(_atomLines(fh))
+    return _parseAtomLines([line for line, _ in records], models=[model for _, model in records])
+
+
+def iterPdbAtoms(fileName, batchSize):
+    """
+    Parse the ATOM/HETATM records of a PDB file into consecutive AtomTables of about batchSize
+    atoms, so that only one batch is held in memory. Batches are cut at the first chain or residue
+    change after reaching batchSize atoms, so residues are never split.
+    """
+    batch, models, first, lastResidue = [], [], 1, None
+    with open(fileName) as fh:
+        for line, model in _atomLines(fh):
+            residue = (model, line[21:27])
+            if len(batch) >= batchSize and residue != lastResidue:
+                yield _parseAtomLines(batch, first, models)
+                batch, models, first = [], [], first + len(batch)
+            batch.append(line)
+            models.append(model)
+            lastResidue = residue
+    if batch:
+        yield _parseAtomLines(batch, first, models)
+
+
+def _atomLines(fh):
+    """ ATOM/HETATM records of an open PDB file, without line ends, with the number of their MODEL """
+    model, models = 1, 0
+    for line in fh:
+        if line.startswith(ATOM_RECORDS):
+            yield line.rstrip('\n'), model
+        elif line.startswith('MODEL'):
+            models += 1
+            try:
+                model = int(line[5:].split()[0])
+            except (ValueError, IndexError):
+                model = models
+
+def atomRecordType(precision=np.float32):
+    """ Structured dtype of the compact per atom records, see atomRecords """
+    return np.dtype([('serial', np.int32), ('chain', np.uint16), ('heavy', np.bool_),
+                     ('coords', precision, 3), ('score', precision)])
+
+
+def atomRecords(atoms, precision=np.float32, chainIds=None, scores=None):
+    """
+    Compact structured array with the serial, chain, heavy atom flag, and the coordinates and score
+    (0 by default) in the given precision of every atom of an AtomTable, taking 23 bytes per atom in
+    float32. Chains are stored as their index in the chainIds list, which is extended with the
+    chain IDs it does not hold yet, so that consecutive batches share the same indices.
+    """
+    chainIds = [] if chainIds is None else chainIds
+    names, inverse = np.unique(atoms.chain, return_inverse=True)
+    for name in names.tolist():
+        if name not in chainIds:
+            chainIds.append(name)
+    records = np.zeros(len(atoms), dtype=atomRecordType(precision))
+    records['serial'] = atoms.serial
+    records['chain'] = np.asarray([chainIds.index(name) for name in names.tolist()], dtype=np.uint16)[inverse]
+    records['heavy'] = atoms.heavyAtoms()
+    records['coords'] = atoms.coords
+    if scores is not None:
+        records['score'] = scores
+    return records
+
+
+def readAtomColumns(fileName, batchSize, precision=np.float32):
+    """
+    Compact records (see atomRecords) of the atoms of a PDB file and the list of their chain IDs,
+    parsed in batches of batchSize atoms so that the PDB records themselves are never held all at once
+    """
+    chainIds = []
+    records = [atomRecords(atoms, precision, chainIds) for atoms in iterPdbAtoms(fileName, batchSize)]
+    if not records:
+        return np.zeros(0, dtype=atomRecordType(precision)), chainIds
+    return np.concatenate(records), chainIds
+
+
+def _parseAtomLines(lines, first=1, models=None):
+    """ AtomTable of ATOM/HETATM records, the first one being the record number first of its file, and the
+    models they belong to """
+    serial, name, resName, chain, resSeq, iCode, element, coords, bFactor = [], [], [], [], [], [], [], [], []
+    for position, line in enumerate(lines, first):
+        try:
+            serial.append(int(line[6:11]))
+        except ValueError:
+            # Hybrid-36 or missing serials: keep the position in the file
+            serial.append(position)
+        atomName = line[12:16].strip()
+        name.append(atomName)
+        resName.append(line[17:20].strip())
+        chain.append(line[21:22].strip())
+        resSeq.append(int(line[22:26]))
+        iCode.append(line[26:27].strip())
+        coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+        bFactor.append(float(line[60:66]) if line[60:66].strip() else 0.)
+        atomElement = line[76:78].strip().upper()
+        element.append(atomElement if atomElement else atomName.lstrip('0123456789')[:1].upper())
+
+    return AtomTable(lines, np.asarray(serial, dtype=np.int64), np.asarray(name), np.asarray(resName),
+                     np.asarray(chain), np.asarray(resSeq, dtype=np.int64), np.asarray(element),
+                     np.asarray(coords, dtype=np.float64).reshape(-1, 3), np.asarray(bFactor, dtype=np.float64),
+                     np.arange(first, first + len(lines)), np.asarray(iCode, dtype=str),
+                     None if models is None else np.asarray(models, dtype=np.int64))
+
+
+def formatPdbAtoms(atoms, coords=None, bFactors=None):
+    """
+    PDB records of the atoms of an AtomTable, replacing their coordinates and/or their B-factor
+    column when given. Every other field is copied from the original records.
+    """
+    for i, line in enumerate(atoms.lines):
+        line = line.ljust(66)
+        if coords is not None:
+            line = '%s%8.3f%8.3f%8.3f%s' % ((line[:30],) + tuple(coords[i]) + (line[54:],))
+        if bFactors is not None:
+            line = '%s%6.2f%s' % (line[:60], bFactors[i], line[66:])
+        yield line.rstrip() + '\n'
+
+
+def writePdbAtoms(atoms, fileName, coords=None, bFactors=None):
+    """ Write the atoms of an AtomTable to a PDB file, see formatPdbAtoms """
+    with open(fileName, 'w') as fh:
+        fh.writelines(formatPdbAtoms(atoms, coords, bFactors))
+        fh.write('END\n')
+
+
+def writePdbAtomBatches(batches, fileName, coords=None, bFactors=None):
+    """
+    Write consecutive AtomTables, as given by iterPdbAtoms, to a PDB file. coords and bFactors
+    refer to all the atoms of the batches, in order.
+    """
+    with open(fileName, 'w') as fh:
+        start = 0
+        for atoms in batches:
+            stop = start + len(atoms)
+            fh.writelines(formatPdbAtoms(atoms, None if coords is None else coords[start:stop],
+                                         None if bFactors is None else bFactors[start:stop]))
+            start = stop
+        fh.write('END\n')
+
+
+def writePdbBFactors(atoms, values, fileName):
+    """ Write the atoms of an AtomTable to a PDB file with their B-factor column set to values """
+    writePdbAtoms(atoms, fileName, bFactors=values)
+
+
+def atomSpecs(atoms, atomIds=None):
+    """
+    Scipion attribute specifiers of the atoms of an AtomTable, 'chain:id', as an array. The id is the
+    position of the atom in its PDB file, which is the _atom_site.id given by writePdbAsCif, or the
+    entry of atomIds at that position when the atoms come from an mmCIF file with other ids.
+    """
+    chain = np.where(atoms.chain == '', ' ', atoms.chain)
+    ids = atoms.position if atomIds is None else np.asarray(atomIds)[atoms.position - 1]
+    return np.char.add(np.char.add(chain, ':'), ids.astype(str))
+
+
+def residueSpecs(residues):
+    """ Scipion attribute specifiers of the rows of a residue table, 'chain:resSeq' followed by the insertion
+    code if any, as an array """
+    chain = np.where(residues['chain'] == '', ' ', residues['chain'])
+    resSeq = np.char.add(np.asarray(residues['resSeq']).astype(str), np.asarray(residues['iCode'], dtype=str))
+    return np.char.add(np.char.add(chain, ':'), resSeq)
+
+
+def hasScipionAttributes(cifFile):
+    """ True if the mmCIF file already has a _scipion_attributes category """
+    with open(cifFile) as fh:
+        return any(line.startswith(SCIPION_ATTRIBUTES) for line in fh)
+
+
+def appendScipionAttributes(cifFile, attributes):
+    """
+    Append a _scipion_attributes loop to an mmCIF file without parsing it, with the rows of an iterable
+    of (attrName, recipient, specs, values) attributes or batches of their rows, one per spec. The file
+    must not have that category yet (see hasScipionAttributes). Values are written rounded to 4 decimals.
+    """
+    with open(cifFile, 'rb') as fh:
+        fh.seek(max(fh.seek(0, 2) - 1, 0))
+        endsWithNewline = fh.read(1) in (b'\n', b'')
+    with open(cifFile, 'a') as fh:
+        fh.write('loop_\n' if endsWithNewline else '\nloop_\n')
+        for field in ('name', 'recipient', 'specifier', 'value'):
+            fh.write(SCIPION_ATTRIBUTES + field + '\n')
+        for attrName, recipient, specs, values in attributes:
+            specs = np.asarray(specs, dtype=str)
+            # Specifiers holding blanks (empty chain IDs) must be quoted
+            quoted = np.char.add(np.char.add("'", specs), "'")
+            specs = np.where(np.char.find(specs, ' ') >= 0, quoted, specs)
+            rows = np.char.add(np.char.add('%s %s ' % (attrName, recipient), specs), ' ')
+            rows = np.char.add(rows, np.round(np.asarray(values, dtype=np.float64), 4).astype(str))
+            for row in rows.tolist():
+                fh.write(row + '\n')
+        fh.write('#\n')
+
+
+ATOM_SITE_FIELDS = ('group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_alt_id', 'label_comp_id',
+                    'label_asym_id', 'label_entity_id', 'label_seq_id', 'pdbx_PDB_ins_code',
+                    'Cartn_x', 'Cartn_y', 'Cartn_z', 'occupancy', 'B_iso_or_equiv',
+                    'auth_seq_id', 'auth_asym_id', 'pdbx_PDB_model_num')
+
+
+def writePdbAsCif(pdbFile, cifFile, batchSize=CIF_BATCH_SIZE):
+    """
+    Convert a PDB file to an mmCIF file holding its _atom_site loop, reading and writing batches of
+    batchSize atoms, so memory does not grow with the size of the structure. The columns follow
+    those written by Biopython, but atoms keep the order of the PDB file and are numbered by their
+    position in it, whatever their serials and TER records, matching the atomSpecs specifiers. Every
+    MODEL keeps its number, and its chains are labelled as those of the first one.
+    """
+    def cifValue(value, missing='?'):
+        if not value:
+            return missing
+        return '"%s"' % value if "'" in value or ' ' in value else value
+
+    def labelAsymId(entity):
+        label = ''
+        while entity > 0:
+            mod = (entity - 1) % 26
+            label += chr(65 + mod)
+            entity = (entity - mod) // 26
+        return label
+
+    entity, residueNumber, previous = 0, 0, (None, None, None, None, None)
+    with open(cifFile, 'w') as fh:
+        fh.write('data_%s\n#\nloop_\n' % os.path.splitext(os.path.basename(pdbFile))[0])
+        for field in ATOM_SITE_FIELDS:
+            fh.write('_atom_site.%s\n' % field)
+        for atoms in iterPdbAtoms(pdbFile, batchSize):
+            for i, line in enumerate(atoms.lines):
+                line = line.ljust(80)
+                group, chain = line[:6].strip(), atoms.chain[i]
+                model = atoms.model[i]
+                residue = (model, chain, line[22:27])
+                if residue != previous[:3]:
+                    if model != previous[0]:
+                        entity = 0
+                    if residue[:2] != previous[:2]:
+                        residueNumber = 0
+                    # New label_asym_id for every chain, and for every hetero molecule within it
+                    if residue[:2] != previous[:2] or group != previous[3] or \
+                            (group == 'HETATM' and atoms.resName[i] != previous[4]):
+                        entity += 1
+                    if group == 'ATOM':
+                        residueNumber += 1
+                    previous = residue + (group, atoms.resName[i])
+                fh.write(' '.join((group, str(atoms.position[i]), cifValue(atoms.element[i]),
+                                   cifValue(atoms.name[i]), cifValue(line[16].strip(), '.'),
+                                   cifValue(atoms.resName[i]), labelAsymId(entity), '?',
+                                   str(residueNumber) if group == 'ATOM' else '.',
+                                   cifValue(atoms.iCode[i]),
+                                   '%.3f' % atoms.coords[i, 0], '%.3f' % atoms.coords[i, 1],
+                                   '%.3f' % atoms.coords[i, 2],
+                                   str(float(line[54:60]) if line[54:60].strip() else 1.),
+                                   str(atoms.bFactor[i]), str(atoms.resSeq[i]), cifValue(chain, '.'),
+                                   str(model))) + '\n')
+        fh.write('#\n')
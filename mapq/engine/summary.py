@@ -0,0 +1,147 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+
+from .qscore import SIGMA
+
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def scoreSummary(scores, chains, percentiles=PERCENTILES, chainNames=None):
+    """
+    Compact description of the per atom scores of a structure: atom count, mean, spread,
+    percentiles and the atom count and mean of every chain. The result only holds plain
+    Python types so it can be stored as JSON. chains may also be indices into chainNames.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    chains = np.asarray(chains)
+    if chainNames is not None:
+        chains = np.asarray(chainNames, dtype=str)[chains]
+    summary = {'atoms': int(len(scores))}
+    if not len(scores):
+        return summary
+    summary.update({'mean': float(scores.mean()), 'std': float(scores.std()),
+                    'min': float(scores.min()), 'max': float(scores.max()),
+                    'median': float(np.median(scores)),
+                    'percentiles': {str(p): float(v) for p, v in zip(percentiles, np.percentile(scores, percentiles))}})
+    names, inverse, counts = np.unique(chains, return_inverse=True, return_counts=True)
+    sums = np.bincount(inverse, weights=scores)
+    summary['chains'] = {str(name): {'atoms': int(count), 'mean': float(total / count)}
+                         for name, count, total in zip(names, counts, sums)}
+    return summary
+
+
+def scoreDeviation(scores, reference):
+    """ Atom count, maximum and mean absolute difference between two sets of per atom scores, and the
+    position of the atom differing the most, as plain Python types """
+    deviation = np.abs(np.asarray(scores, dtype=np.float64) - np.asarray(reference, dtype=np.float64))
+    if not len(deviation):
+        return {'atoms': 0}
+    return {'atoms': int(len(deviation)), 'maxDeviation': float(deviation.max()),
+            'meanDeviation': float(deviation.mean()), 'worstAtom': int(np.argmax(deviation))}
+
+
+# Backbone atoms of amino acids, and phosphate and sugar atoms of nucleotides
+BACKBONE_ATOMS = ('N', 'CA', 'C', 'O', 'OXT',
+                  'P', 'OP1', 'OP2', 'OP3', "O5'", "C5'", "C4'", "O4'", "C3'", "O3'", "C2'", "O2'", "C1'")
+
+
+def expectedQScore(resolution, sigma=SIGMA):
+    """
+    Q-score expected for protein atoms in a map of the given resolution, following the linear fit
+    to EMDB maps used by mapq for sigma 0.6. None for other sigma values, for which mapq has no fit.
+    """
+    if resolution is None or abs(sigma - SIGMA) > 1e-5:
+        return None
+    return -0.1775 * np.asarray(resolution) + 1.1192
+
+
+def residueScores(atoms, scores, expected=None):
+    """
+    Per residue table of the scores of the heavy atoms of an AtomTable, as a dictionary of column
+    arrays: chain, resSeq, iCode, resName, atoms, q (mean of all its atoms), qBackbone and qSideChain
+    (NaN when the residue has no such atoms) and, when given a per atom expected Q-score,
+    expectedQ. Residues are runs of consecutive atoms with the same model, chain, number, insertion
+    code and name.
+    """
+    heavy = atoms.heavyAtoms()
+    scores = np.asarray(scores, dtype=np.float64)[heavy]
+    chain, resSeq, resName = atoms.chain[heavy], atoms.resSeq[heavy], atoms.resName[heavy]
+    iCode, model = atoms.iCode[heavy], atoms.model[heavy]
+    newResidue = np.ones(len(chain), dtype=bool)
+    newResidue[1:] = (chain[1:] != chain[:-1]) | (resSeq[1:] != resSeq[:-1]) | (resName[1:] != resName[:-1]) | \
+        (iCode[1:] != iCode[:-1]) | (model[1:] != model[:-1])
+    starts = np.flatnonzero(newResidue)
+    residue = np.cumsum(newResidue) - 1
+    backbone = np.isin(atoms.name[heavy], BACKBONE_ATOMS)
+
+    def residueMean(mask, values=scores):
+        counts = np.bincount(residue[mask], minlength=len(starts))
+        sums = np.bincount(residue[mask], weights=values[mask], minlength=len(starts))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    table = {'chain': chain[starts], 'resSeq': resSeq[starts], 'iCode': iCode[starts], 'resName': resName[starts],
+             'atoms': np.bincount(residue, minlength=len(starts)),
+             'q': residueMean(np.ones(len(chain), dtype=bool)),
+             'qBackbone': residueMean(backbone), 'qSideChain': residueMean(~backbone)}
+    if expected is not None:
+        expected = np.broadcast_to(np.asarray(expected, dtype=np.float64), heavy.shape)[heavy]
+        table['expectedQ'] = residueMean(np.ones(len(chain), dtype=bool), expected)
+    return table
+
+
+def chainScores(residues):
+    """
+    Per chain table, in the same format, from a residue table given by residueScores. Scores are
+    averaged over the atoms of the chain; backbone and side chain scores over its residues.
+    """
+    names, inverse = np.unique(residues['chain'], return_inverse=True)
+    atomCounts = np.asarray(residues['atoms'], dtype=np.float64)
+
+    def chainMean(values, weights):
+        valid = ~np.isnan(values)
+        counts = np.bincount(inverse[valid], weights=weights[valid], minlength=len(names))
+        sums = np.bincount(inverse[valid], weights=values[valid] * weights[valid], minlength=len(names))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    ones = np.ones(len(inverse))
+    table = {'chain': names, 'residues': np.bincount(inverse, minlength=len(names)),
+             'atoms': np.bincount(inverse, weights=atomCounts, minlength=len(names)).astype(np.int64),
+             'q': chainMean(residues['q'], atomCounts),
+             'qBackbone': chainMean(residues['qBackbone'], ones),
+             'qSideChain': chainMean(residues['qSideChain'], ones)}
+    if 'expectedQ' in residues:
+        table['expectedQ'] = chainMean(residues['expectedQ'], atomCounts)
+    return table
+
+
+def concatenateTables(tables):
+    """ Single table with the rows of a list of tables with the same columns, e.g. per batch residue tables """
+    return {column: np.concatenate([table[column] for table in tables]) for column in tables[0]}
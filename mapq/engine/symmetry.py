@@ -0,0 +1,121 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .parallel import parallelQScores
+
+
+# Largest distance between an atom moved by a symmetry operator and its mate (Angstroms)
+SYMMETRY_TOLERANCE = 1.
+# Copies whose mean Q-score difference with the scored asymmetric unit is above this are flagged
+MAX_COPY_DIFFERENCE = 0.05
+# Copies with a smaller fraction of atoms matching the asymmetric unit are flagged
+MIN_MATCHED_FRACTION = 0.9
+
+
+def symmetryMates(coords, labels, matrices, tolerance=SYMMETRY_TOLERANCE):
+    """
+    For every (4, 4) symmetry matrix, the index of the atom with the same label closest to where
+    each atom of coords is moved by it, or -1 when there is none within tolerance. Also returns
+    the distances to the mates.
+    """
+    tree = cKDTree(coords)
+    mates = np.full((len(matrices), len(coords)), -1, dtype=np.int64)
+    distances = np.full((len(matrices), len(coords)), np.inf)
+    for k, matrix in enumerate(matrices):
+        matrix = np.asarray(matrix, dtype=np.float64)
+        distance, index = tree.query(coords @ matrix[:3, :3].T + matrix[:3, 3], distance_upper_bound=tolerance)
+        found = np.flatnonzero(np.isfinite(distance))
+        found = found[labels[index[found]] == labels[found]]
+        mates[k, found] = index[found]
+        distances[k, found] = distance[found]
+    return mates, distances
+
+
+def asymmetricUnit(mates):
+    """
+    Representative of every atom: the atom of lowest index among its symmetry mates, so that every
+    orbit is scored once. Atoms without mates represent themselves.
+    """
+    representative = np.arange(mates.shape[1])
+    for k in range(len(mates)):
+        matched = mates[k] >= 0
+        representative[matched] = np.minimum(representative[matched], mates[k][matched])
+    # Partial matches may chain representatives, follow them until every one represents itself
+    while True:
+        following = representative[representative]
+        if np.array_equal(following, representative):
+            return representative
+        representative = following
+
+
+def symmetricQScores(mapFile, coords, chains, labels, matrices, checkCopies=1, tolerance=SYMMETRY_TOLERANCE,
+                     **kwargs):
+    """
+    Q-scores of all atoms in coords scoring only one atom of every set of symmetry equivalent atoms
+    and copying its score to the rest. The copies produced by the first checkCopies non identity
+    operators are also scored to measure how well the map follows the symmetry. Every atom still
+    takes part in the rejection of shell points. Returns the scores and a report with, for every
+    operator, the fraction of atoms matching the asymmetric unit and, for the checked ones, the
+    difference between their scores and those of the asymmetric unit.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    labels = np.asarray(labels)
+    operators = [k for k, matrix in enumerate(matrices)
+                 if not np.allclose(np.asarray(matrix, dtype=np.float64), np.eye(4))]
+    mates, distances = symmetryMates(coords, labels, [matrices[k] for k in operators], tolerance)
+    representative = asymmetricUnit(mates)
+    asu = np.flatnonzero(representative == np.arange(len(coords)))
+
+    checked = []
+    for k in range(min(checkCopies, len(operators))):
+        copies = mates[k, asu]
+        copies = copies[(copies >= 0) & (copies != asu)]
+        checked.append(copies)
+    toScore = np.unique(np.concatenate([asu] + checked))
+    print("Scoring %d of %d atoms, %d in the asymmetric unit" % (len(toScore), len(coords), len(asu)))
+
+    scores = np.zeros(len(coords))
+    scores[toScore] = parallelQScores(mapFile, coords, chains, indices=toScore, **kwargs)
+    transferred = np.ones(len(coords), dtype=bool)
+    transferred[toScore] = False
+    scores[transferred] = scores[representative[transferred]]
+
+    report = {'atoms': int(len(coords)), 'asymmetricUnit': int(len(asu)), 'operators': []}
+    for k, operator in enumerate(operators):
+        matched = mates[k] >= 0
+        entry = {'operator': int(operator), 'matchedFraction': float(np.mean(matched)) if len(coords) else 0.,
+                 'rmsd': float(np.sqrt(np.mean(distances[k, matched] ** 2))) if np.any(matched) else None}
+        if k < len(checked) and len(checked[k]):
+            difference = np.abs(scores[checked[k]] - scores[representative[checked[k]]])
+            entry.update({'checkedAtoms': int(len(checked[k])), 'meanDifference': float(difference.mean()),
+                          'maxDifference': float(difference.max())})
+        entry['flagged'] = bool(entry['matchedFraction'] < MIN_MATCHED_FRACTION or
+                                entry.get('meanDifference', 0.) > MAX_COPY_DIFFERENCE)
+        report['operators'].append(entry)
+    return scores, report
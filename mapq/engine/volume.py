@@ -0,0 +1,242 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+import os
+
+import mrcfile
+import mrcfile.utils
+import numpy as np
+
+
+PLACEMENT_SUFFIX = '.placement.json'
+INTERPOLATION_SUFFIX = '.interp.npy'
+
+
+class MapGrid:
+    """
+    Voxel values of a map together with their placement in space.
+    Data is indexed as [z, y, x] while voxel size and origin are given in (x, y, z) Angstroms,
+    the origin being the position of the first voxel.
+    """
+    def __init__(self, data, voxelSize, origin):
+        self.data = data
+        self.voxelSize = np.asarray(voxelSize, dtype=np.float64)
+        self.origin = np.asarray(origin, dtype=np.float64)
+
+    def getShape(self):
+        """ Return the grid dimensions as (x, y, z) """
+        return self.data.shape[::-1]
+
+    def toIndices(self, points):
+        """ Convert (..., 3) points in Angstroms to fractional (x, y, z) voxel indices, in float32 for
+        float32 points and in float64 otherwise """
+        points = np.asarray(points)
+        dtype = np.float32 if points.dtype == np.float32 else np.float64
+        return (points.astype(dtype, copy=False) - self.origin.astype(dtype)) / self.voxelSize.astype(dtype)
+
+    def interpolate(self, points):
+        """
+        Trilinear interpolation of the map at (..., 3) points given in Angstroms, computed in float32
+        for float32 points and in float64 otherwise.
+        Points falling outside the grid get a value of 0, as Chimera does.
+        """
+        points = np.asarray(points)
+        idx = self.toIndices(points.reshape(-1, 3))
+        nx, ny, nz = self.getShape()
+        i0 = np.floor(idx).astype(np.int64)
+        frac = idx - i0
+        inside = np.all((i0 >= 0) & (i0 < np.array([nx - 1, ny - 1, nz - 1])), axis=1)
+        # Points lying exactly on the last plane are still valid
+        onEdge = np.all((idx >= 0) & (idx <= np.array([nx - 1, ny - 1, nz - 1])), axis=1) & ~inside
+        i0[onEdge] = np.minimum(i0[onEdge], np.array([nx - 2, ny - 2, nz - 2]))
+        frac[onEdge] = idx[onEdge] - i0[onEdge]
+        inside |= onEdge
+
+        values = np.zeros(idx.shape[0], dtype=idx.dtype)
+        # The 8 corners are gathered from a flat view with precomputed offsets
+        flat, (sx, sy, sz) = self._flatView()
+        base = i0[inside] @ np.array([sx, sy, sz])
+        fx, fy, fz = frac[inside].T
+        c00 = flat[base] * (1 - fx) + flat[base + sx] * fx
+        c10 = flat[base + sy] * (1 - fx) + flat[base + sy + sx] * fx
+        c01 = flat[base + sz] * (1 - fx) + flat[base + sz + sx] * fx
+        c11 = flat[base + sz + sy] * (1 - fx) + flat[base + sz + sy + sx] * fx
+        c0 = c00 * (1 - fy) + c10 * fy
+        c1 = c01 * (1 - fy) + c11 * fy
+        values[inside] = c0 * (1 - fz) + c1 * fz
+        return values.reshape(points.shape[:-1])
+
+    def _flatView(self):
+        """ 1D view of the voxels, starting at the first one, and the (x, y, z) steps between them in it """
+        data = self.data
+        if data.size == 0:
+            return np.zeros(0, dtype=np.float32), [0, 0, 0]
+        if any(stride <= 0 or stride % data.itemsize for stride in data.strides):
+            data = np.ascontiguousarray(data)
+        steps = [stride // data.itemsize for stride in data.strides]
+        span = sum((n - 1) * step for n, step in zip(data.shape, steps)) + 1
+        flat = np.lib.stride_tricks.as_strided(data, shape=(span,), strides=(data.itemsize,))
+        return flat, steps[::-1]
+
+    def statistics(self, slabSize=16):
+        """
+        Return the mean and standard deviation of the map values. The map is visited in slabs
+        of slabSize sections so memory mapped maps are never fully loaded.
+        """
+        data = self.data
+        count, mean, m2 = 0, 0., 0.
+        for z in range(0, data.shape[0], slabSize):
+            slab = np.asarray(data[z:z + slabSize], dtype=np.float64)
+            n = slab.size
+            slabMean = slab.mean()
+            slabM2 = np.sum((slab - slabMean) ** 2)
+            delta = slabMean - mean
+            total = count + n
+            mean += delta * n / total
+            m2 += slabM2 + delta ** 2 * count * n / total
+            count = total
+        return float(mean), float(np.sqrt(m2 / count))
+
+    def crop(self, lower, upper):
+        """
+        Sub-grid covering the box between lower and upper (x, y, z) Angstroms, clipped to the map.
+        The data is a view, so memory mapped maps are only read where the box lies.
+        """
+        shape = np.array(self.getShape())
+        i0 = np.clip(np.floor(self.toIndices(lower)).astype(int), 0, shape - 1)
+        i1 = np.clip(np.ceil(self.toIndices(upper)).astype(int) + 1, i0 + 1, shape)
+        data = self.data[i0[2]:i1[2], i0[1]:i1[1], i0[0]:i1[0]]
+        return MapGrid(data, self.voxelSize, self.origin + i0 * self.voxelSize)
+
+
+def readMap(fileName, mmap=False):
+    """
+    Read an MRC/CCP4 map into a MapGrid. The origin follows Chimera conventions: the header
+    origin is used when set, otherwise the start indices scaled by the voxel size. A placement
+    written next to the file with writePlacement overrides the header.
+    With mmap=True the voxels are memory mapped read-only instead of loaded, so several
+    processes can share the same map without copying it. Voxels stored next to the map by
+    writeInterpolationGrid, if not older than it, are read instead of those of the map.
+    """
+    with mrcfile.open(fileName, permissive=True, header_only=mmap) as mrc:
+        header = mrc.header.copy()
+        if not mmap:
+            data = np.asarray(mrc.data, dtype=np.float32)
+    if mmap:
+        data = np.memmap(fileName, dtype=mrcfile.utils.data_dtype_from_header(header), mode='r',
+                         offset=header.nbytes + int(header.nsymbt),
+                         shape=mrcfile.utils.data_shape_from_header(header))
+
+    axes = (int(header.mapc), int(header.mapr), int(header.maps))
+    voxelSize, origin = _placement(fileName, header)
+    data = _toZYX(data, axes)
+    interpolationFile = fileName + INTERPOLATION_SUFFIX
+    if os.path.exists(interpolationFile) and os.path.getmtime(interpolationFile) >= os.path.getmtime(fileName):
+        precomputed = np.load(interpolationFile, mmap_mode='r' if mmap else None)
+        if precomputed.shape == data.shape:
+            data = precomputed
+    return MapGrid(data, voxelSize, origin)
+
+
+def writeInterpolationGrid(fileName, slabSize=16):
+    """
+    Store the voxels of a map next to it as a C ordered (z, y, x) float32 .npy file, which readMap
+    uses instead of the map from then on. Maps of other types or axis orders are then interpolated
+    from a native layout that every process can memory map. The map is converted in slabs of
+    slabSize sections, so it is never fully loaded. Returns the name of the written file.
+    """
+    interpolationFile = fileName + INTERPOLATION_SUFFIX
+    if os.path.exists(interpolationFile):
+        os.remove(interpolationFile)
+    data = readMap(fileName, mmap=True).data
+    tmpFile = interpolationFile + '.tmp.npy'
+    out = np.lib.format.open_memmap(tmpFile, mode='w+', dtype=np.float32, shape=data.shape)
+    for z in range(0, data.shape[0], slabSize):
+        out[z:z + slabSize] = data[z:z + slabSize]
+    out.flush()
+    del out
+    os.replace(tmpFile, interpolationFile)
+    return interpolationFile
+
+
+def readPlacement(fileName):
+    """ Return the (x, y, z) voxel size and origin in Angstroms of a map without reading its voxels """
+    with mrcfile.open(fileName, permissive=True, header_only=True) as mrc:
+        return _placement(fileName, mrc.header)
+
+
+def fixedOrigin(origin, sampling):
+    """ Origin of a map written by Ccp4Header.fixFile with the START field, which rounds to whole voxels """
+    return np.round(np.asarray(origin, dtype=np.float64) / sampling) * sampling
+
+
+def hasPlacement(fileName, sampling, origin, tolerance=1e-3):
+    """ True if the header of fileName already places the map at origin with the given sampling """
+    voxelSize, fileOrigin = readPlacement(fileName)
+    return (np.allclose(voxelSize, sampling, rtol=1e-4, atol=0) and
+            np.allclose(fileOrigin, origin, rtol=0, atol=tolerance))
+
+
+def writePlacement(fileName, sampling, origin):
+    """ Store a voxel size and origin next to fileName, used instead of its header by readMap """
+    with open(fileName + PLACEMENT_SUFFIX, 'w') as fh:
+        json.dump({'voxelSize': np.broadcast_to(sampling, 3).tolist(),
+                   'origin': np.asarray(origin, dtype=np.float64).tolist()}, fh)
+
+
+def _placement(fileName, header):
+    if os.path.exists(fileName + PLACEMENT_SUFFIX):
+        with open(fileName + PLACEMENT_SUFFIX) as fh:
+            placement = json.load(fh)
+        return np.array(placement['voxelSize']), np.array(placement['origin'])
+
+    axes = (int(header.mapc), int(header.mapr), int(header.maps))
+    cell = np.array([header.cella.x, header.cella.y, header.cella.z], dtype=np.float64)
+    grid = np.array([header.mx, header.my, header.mz], dtype=np.float64)
+    voxelSize = np.divide(cell, grid, out=np.ones(3), where=grid > 0)
+    origin = np.array([header.origin.x, header.origin.y, header.origin.z], dtype=np.float64)
+    if not np.any(origin):
+        start = _toXYZ(np.array([header.nxstart, header.nystart, header.nzstart], dtype=np.float64), axes)
+        origin = start * voxelSize
+    return voxelSize, origin
+
+
+def _toZYX(data, axes):
+    """ Reorder file axes (sections, rows, columns) to (z, y, x) """
+    if axes == (1, 2, 3):
+        return data
+    # File axis k (0=columns, 1=rows, 2=sections) holds the spatial axis axes[k]
+    fileToArray = {0: 2, 1: 1, 2: 0}
+    order = [fileToArray[axes.index(a)] for a in (3, 2, 1)]
+    return np.transpose(data, order)
+
+
+def _toXYZ(values, axes):
+    """ Reorder per file axis (columns, rows, sections) values to (x, y, z) """
+    if axes == (1, 2, 3):
+        return values
+    return np.array([values[axes.index(a)] for a in (1, 2, 3)])
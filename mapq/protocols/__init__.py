@@ -24,4 +24,5 @@
 # *
 # **************************************************************************
 
-from .protocol_mapq import ProtMapQ
\ No newline at end of file
+from .protocol_mapq import ProtMapQ
+from .protocol_mapq_batch import ProtMapQBatch
\ No newline at end of file
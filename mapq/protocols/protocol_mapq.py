@@ -24,19 +24,87 @@
 # *
 # **************************************************************************
 
+import functools
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
 from os.path import abspath
 import numpy as np
 
 from pwem.convert import toCIF, Ccp4Header
+from pwem.constants import SCIPION_SYM_NAME, SYM_CYCLIC, SYM_DIHEDRAL_X, SYM_DIHEDRAL_Y, SYM_HELICAL
+from pwem.convert import symmetry
 from pwem.convert.atom_struct import toPdb, AtomicStructHandler, addScipionAttribute
 from pwem.objects import SetOfAtomStructs, AtomStruct
 from pwem.protocols import ProtAnalysis3D
 
-from pyworkflow.protocol import PointerParam, FloatParam, MultiPointerParam, IntParam, BooleanParam
+from pyworkflow.protocol import (STEPS_PARALLEL, PointerParam, FloatParam, MultiPointerParam, IntParam,
+                                 BooleanParam, EnumParam, StringParam)
+from pyworkflow.protocol.params import LEVEL_ADVANCED
 from pyworkflow import BETA
 import pyworkflow.utils as pwutils
 
 import mapq
+from mapq.constants import (MAPQ_VERSION, NATIVE_ENGINE, CHIMERA_ENGINE, ENGINE_CHOICES,
+                            CHIMERA_FIT, NATIVE_FIT, FIT_CHOICES, FLOAT32, FLOAT64, PRECISION_CHOICES)
+from mapq.engine import (scoreStructure, streamScoreStructure, scoreSummary, scoreDeviation, readMap, readPdbAtoms,
+                         SIGMA)
+from mapq.engine.cache import ResultCache, atomsDigest, fileDigest, fileIdentity, mapDigest
+from mapq.engine.fitting import fitStatistics
+from mapq.engine.incremental import MOVE_TOLERANCE
+from mapq.engine.pipeline import atomResolution
+from mapq.engine.preprocess import prepareStructure
+from mapq.engine.profiling import StageProfiler, readStageRecords, stageTotals
+from mapq.engine.selection import parseResidueRanges, selectAtoms
+from mapq.engine.server import scoreOnServer
+from mapq.engine.structure import (appendScipionAttributes, atomRecords, atomSpecs, hasScipionAttributes,
+                                   iterPdbAtoms, readAtomColumns, residueSpecs, writePdbAsCif, writePdbBFactors)
+from mapq.engine.summary import chainScores, concatenateTables, expectedQScore, residueScores
+from mapq.engine.volume import (INTERPOLATION_SUFFIX, PLACEMENT_SUFFIX, fixedOrigin, hasPlacement, readPlacement,
+                                writeInterpolationGrid, writePlacement)
+
+# Guards the digests of the maps, shared by the structures scored concurrently
+_digestLock = threading.Lock()
+
+
+def structureStep(step):
+    """
+    Decorator of the steps processing a single structure. When one of them fails, the error is
+    stored and the remaining steps of that structure are skipped, so that the other structures
+    still produce their outputs.
+    """
+    @functools.wraps(step)
+    def wrapper(self, pdbFile, *args):
+        failedFile = self._getFailedFile(pdbFile)
+        if os.path.exists(failedFile):
+            return
+        try:
+            step(self, pdbFile, *args)
+        except Exception:
+            error = traceback.format_exc()
+            print("Processing of %s failed, it will not be part of the output:\n%s"
+                  % (pwutils.removeBaseExt(pdbFile), error))
+            with open(failedFile, 'w') as fh:
+                fh.write(error)
+    return wrapper
+
+
+def profiledStep(stage):
+    """
+    Decorator recording the wall and CPU time, memory and IO of a step as the given stage, see
+    ProtMapQ.getProfiler. Steps of a single structure are recorded under its base name.
+    """
+    def decorator(step):
+        @functools.wraps(step)
+        def wrapper(self, *args):
+            structure = pwutils.removeBaseExt(args[0]) if args else None
+            with self.getProfiler().stage(stage, structure):
+                return step(self, *args)
+        return wrapper
+    return decorator
 
 
 class ProtMapQ(ProtAnalysis3D):
@@ -47,6 +115,10 @@ class ProtMapQ(ProtAnalysis3D):
     _devStatus = BETA
     _ATTRNAME = "MapQ_Score"
     _OUTNAME = "scoredStructures"
+    # Residue attributes written for the columns of the residue tables
+    _RESIDUE_ATTRNAMES = (('q', 'MapQ_Residue_Score'), ('qBackbone', 'MapQ_Backbone_Score'),
+                          ('qSideChain', 'MapQ_SideChain_Score'), ('expectedQ', 'MapQ_Expected_Score'))
+    stepsExecutionMode = STEPS_PARALLEL
 
     # --------------------------- DEFINE param functions ------------------------
     def _defineParams(self, form):
@@ -56,6 +128,143 @@ class ProtMapQ(ProtAnalysis3D):
         form.addParam('pdbs', MultiPointerParam, pointerClass="AtomStruct", important=True,
                       label="Input structures",
                       help='PDBs to compare to input map')
+        self._defineScoreParams(form)
+        form.addParam('autoFit', BooleanParam, default=True, label="Auto fit map and structures?",
+                      help="If true, the map and structures will be automatically aligned with Chimera. "
+                           "Otherwise, map and structures will be assumed to be aligned")
+        form.addParam('fitMethod', EnumParam, choices=FIT_CHOICES, default=CHIMERA_FIT,
+                      condition="autoFit", display=EnumParam.DISPLAY_HLIST, label="Fitting method",
+                      help="Chimera: run fitmap for every structure in a Chimera session. \n"
+                           "Native: rigid body optimization of the average map value at the atom positions "
+                           "within Scipion, similar to fitmap. Structures are fitted in parallel using as many "
+                           "processes as threads.")
+        form.addParam('engine', EnumParam, choices=ENGINE_CHOICES, default=CHIMERA_ENGINE,
+                      display=EnumParam.DISPLAY_HLIST, label="Q-score engine",
+                      help="Chimera: run mapq_cmd.py inside Chimera's Python. \n"
+                           "Native: compute the Q-scores within Scipion with NumPy, avoiding the Chimera "
+                           "start-up and the per-atom Python loop. The __Q__map.pdb files written are "
+                           "equivalent in both cases. The native engine splits every structure into "
+                           "spatially coherent shards scored by a pool of as many processes as threads.")
+        form.addParam('cropMap', BooleanParam, default=True, condition="engine==%d" % NATIVE_ENGINE,
+                      label="Crop map around structures?",
+                      help="If true, the map is memory mapped and only the bounding box of each structure, "
+                           "padded by the Q-score sampling radius, is read during scoring. This reduces the "
+                           "peak memory for local models in big maps without changing the scores.")
+        form.addParam('selectChains', StringParam, default='', condition="engine==%d" % NATIVE_ENGINE,
+                      label="Score only chains",
+                      help="Optional - Chain IDs to score, e.g. 'A B'. Leave empty to score every chain.")
+        form.addParam('selectResidues', StringParam, default='', condition="engine==%d" % NATIVE_ENGINE,
+                      label="Score only residues",
+                      help="Optional - Residue ranges to score, e.g. 'A:10-25, B:40, 100-120'. Ranges without "
+                           "chain apply to every chain.")
+        form.addParam('selectLigands', StringParam, default='', condition="engine==%d" % NATIVE_ENGINE,
+                      label="Score only ligands",
+                      help="Optional - Residue names to score, e.g. 'ATP NAG'. Residues matching either these "
+                           "names or the residue ranges are scored, within the selected chains.")
+        form.addParam('selectRadius', FloatParam, default=0., condition="engine==%d" % NATIVE_ENGINE,
+                      label="Radius around the selection (Å)",
+                      help="If greater than 0, every residue with an atom closer than this to the selected atoms "
+                           "is also scored, e.g. the pocket of a ligand. \n"
+                           "Only the selected atoms are scored and, with the map cropped, only the region around "
+                           "them is read. The atoms left out still reject the sampling points close to them, so "
+                           "the selected atoms get the same Q-scores as when scoring the whole structure. The "
+                           "other atoms get a Q-score of 0 in the output and the statistics only cover the "
+                           "selection.")
+        form.addParam('checkPrecision', BooleanParam, default=False, expertLevel=LEVEL_ADVANCED,
+                      condition="engine==%d" % NATIVE_ENGINE,
+                      label="Check the precision?",
+                      help="If true, every structure is scored a second time in the other precision and the "
+                           "maximum and mean difference between both sets of Q-scores is reported in the summary "
+                           "and stored in extra/<structure>_precision.json.")
+        form.addParam('sigmaSweep', StringParam, default='', expertLevel=LEVEL_ADVANCED,
+                      condition="engine==%d" % NATIVE_ENGINE,
+                      label="Additional sigmas (Å)",
+                      help="Optional - List of extra widths of the reference Gaussian, e.g. '0.4 0.5 0.7'. "
+                           "The map is sampled around every atom only once and the Q-scores for each width are "
+                           "stored as additional attributes named after it, e.g. MapQ_Score_s0.4, next to "
+                           "MapQ_Score computed with Sigma. This replaces one run of the protocol per width.")
+        form.addParam('localResolution', PointerParam, pointerClass="Volume", allowsNull=True,
+                      condition="engine==%d" % NATIVE_ENGINE, label="Local resolution map",
+                      help="Optional - Local resolution of the input map, e.g. from ResMap or MonoRes, in the "
+                           "same frame. The resolution at every atom is interpolated during scoring and used for "
+                           "the expected Q-scores of the residue tables instead of the global map resolution.")
+        form.addParam('localSigma', BooleanParam, default=False, expertLevel=LEVEL_ADVANCED,
+                      condition="engine==%d and localResolution" % NATIVE_ENGINE,
+                      label="Adapt sigma to the local resolution?",
+                      help="If true, the reference Gaussian of every atom is widened or narrowed by its local "
+                           "resolution over the map resolution (or the median local resolution at the atoms "
+                           "when the map resolution is not given). Expected Q-scores are then not reported, as "
+                           "they only apply to a fixed sigma.")
+        form.addParam('symmetryGroup', EnumParam, choices=list(SCIPION_SYM_NAME.values()), default=SYM_CYCLIC,
+                      condition="engine==%d" % NATIVE_ENGINE, label="Map symmetry",
+                      help="Symmetry of the map around its center, using Scipion's conventions. With any "
+                           "symmetry other than C1, only one atom of every set of symmetry equivalent atoms "
+                           "is scored and its Q-score is copied to the rest. Atoms without an equivalent, "
+                           "e.g. in partial models, are scored as usual.")
+        form.addParam('symmetryOrder', IntParam, default=1,
+                      condition="engine==%d and symmetryGroup in [%d, %d, %d, %d]"
+                                % (NATIVE_ENGINE, SYM_CYCLIC, SYM_DIHEDRAL_X, SYM_DIHEDRAL_Y, SYM_HELICAL),
+                      label="Symmetry order",
+                      help="Order of cyclic and dihedral symmetries (4 for C4). For helical symmetry, number "
+                           "of subunits considered at each side of every subunit.")
+        form.addParam('helicalRise', FloatParam, default=0.,
+                      condition="engine==%d and symmetryGroup==%d" % (NATIVE_ENGINE, SYM_HELICAL),
+                      label="Helical rise (Å)")
+        form.addParam('helicalTwist', FloatParam, default=0.,
+                      condition="engine==%d and symmetryGroup==%d" % (NATIVE_ENGINE, SYM_HELICAL),
+                      label="Helical twist (deg)")
+        form.addParam('checkCopies', IntParam, default=1, expertLevel=LEVEL_ADVANCED,
+                      condition="engine==%d" % NATIVE_ENGINE,
+                      label="Symmetry copies to check",
+                      help="Number of symmetry copies scored independently to verify the symmetry. The "
+                           "difference between their Q-scores and those of the asymmetric unit, as well as "
+                           "the fraction of atoms matching every symmetry operator, are reported and copies "
+                           "that do not follow the symmetry are flagged in the summary.")
+        form.addParam('previousScores', PointerParam, pointerClass="SetOfAtomStructs", allowsNull=True,
+                      condition="engine==%d" % NATIVE_ENGINE, label="Previous Q-scores (optional)",
+                      help="Structures scored by a previous run of this protocol against the same map, e.g. "
+                           "an earlier refinement iteration. Atoms are matched by chain, residue number, "
+                           "insertion code and atom name; only the atoms that moved, and those whose "
+                           "neighbourhood changed, are scored again while the rest keep their previous Q-score. "
+                           "Structures are paired by file name, and those left are paired in input order. The "
+                           "comparison is done in the frame of the map, so unchanged atoms only keep their "
+                           "scores if the structures are placed the same way in both runs. Previous Q-scores "
+                           "computed against another map or with other scoring parameters are not reused, nor "
+                           "are those of the atoms outside the selection of the previous run. Maps are told "
+                           "apart by their input file, so a map modified since the previous run, or imported "
+                           "again, is considered another map.")
+        form.addParam('moveTolerance', FloatParam, default=MOVE_TOLERANCE, expertLevel=LEVEL_ADVANCED,
+                      condition="engine==%d and previousScores" % NATIVE_ENGINE,
+                      label="Move tolerance (Å)",
+                      help="Atoms displaced less than this since the previous run are considered unchanged.")
+        form.addParam('batchSize', IntParam, default=0, expertLevel=LEVEL_ADVANCED,
+                      condition="engine==%d" % NATIVE_ENGINE,
+                      label="Streaming batch size (atoms)",
+                      help="If greater than 0, PDB structures are centered, scored and written to the output in "
+                           "batches of about this many atoms, cut at chain or residue boundaries. Only the "
+                           "coordinates of the whole structure are kept in memory, so the peak memory of very "
+                           "large assemblies depends on the batch size. 0 processes every structure at once. "
+                           "mmCIF inputs are still converted as a whole.")
+        form.addParam('useCache', BooleanParam, default=False, expertLevel=LEVEL_ADVANCED,
+                      label="Reuse cached Q-scores?",
+                      help="If true, Q-scores are stored in a persistent cache (MAPQ_CACHE_DIR, by default "
+                           "mapq_cache inside SPOCSCRATCHDIR) keyed on the map voxels, the atoms, the scoring "
+                           "parameters and the MapQ version. Structures already scored with the same inputs are "
+                           "not scored again. The least recently used entries are removed when the cache grows "
+                           "over MAPQ_CACHE_SIZE GB (10 by default).")
+        form.addParam('useServer', BooleanParam, default=False, expertLevel=LEVEL_ADVANCED,
+                      condition="engine==%d" % NATIVE_ENGINE,
+                      label="Use the scoring server?",
+                      help="If true, the structures are scored by the MapQ scoring server when it is running, "
+                           "avoiding the start-up of the scoring and the loading of the map in every run. The server "
+                           "is started with 'python -m mapq.engine.server' and listens at MAPQ_SERVER_SOCKET "
+                           "(mapq-<uid>/server.sock inside SPOCSCRATCHDIR by default). When it is not running, the "
+                           "structures are scored within the protocol.")
+        self._defineEngineParams(form, condition="engine==%d" % NATIVE_ENGINE)
+        form.addParallelSection(threads=4, mpi=0)
+
+    def _defineScoreParams(self, form):
+        """ Parameters of the Q-score computation shared with the batch protocol """
         form.addParam('mapRes', FloatParam, allowsNull=True,
                       label = "Map resolution",
                       help = "Optional - Default is 3.0 - Specifies resolution of map; it is used to output perresidue "
@@ -67,52 +276,184 @@ class ProtMapQ(ProtAnalysis3D):
         form.addParam('sigma', FloatParam, allowsNull=True,
                       label="Sigma",
                       help="Optional – default is 0.6 – specifies width of reference Gaussian in Å ")
-        form.addParam('autoFit', BooleanParam, default=True, label="Auto fit map and structures?",
-                      help="If true, the map and structures will be automatically aligned with Chimera. "
-                           "Otherwise, map and structures will be assumed to be aligned")
-        form.addParallelSection(threads=4, mpi=0)
+
+    def _defineEngineParams(self, form, condition=None):
+        """ Expert parameters of the native scoring and the profiling of the steps shared with the batch protocol,
+        the former only shown when condition holds """
+        form.addParam('precision', EnumParam, choices=PRECISION_CHOICES, default=FLOAT32,
+                      condition=condition, expertLevel=LEVEL_ADVANCED,
+                      display=EnumParam.DISPLAY_HLIST, label="Scoring precision",
+                      help="Floating point type of the coordinates, sample points and map values during scoring. "
+                           "float32 halves the memory and bandwidth used by the sampling of the maps, the "
+                           "correlations being still accumulated in float64, and changes the Q-scores well below "
+                           "the 2 decimals of the __Q__ files.")
+        form.addParam('precomputeMap', BooleanParam, default=False, expertLevel=LEVEL_ADVANCED,
+                      condition=condition,
+                      label="Precompute interpolation grids?",
+                      help="If true, the voxels of every map are stored once next to it as a float32 array in "
+                           "(z, y, x) order, which all the scoring processes memory map instead of the map. This "
+                           "speeds up interpolation for maps stored as integers or with permuted axes, at the "
+                           "cost of a disk copy of the map. Scores do not change.")
+        form.addParam('profile', BooleanParam, default=False, expertLevel=LEVEL_ADVANCED,
+                      label="Profile the steps?",
+                      help="The wall and CPU time, peak memory and IO of every step and of its main stages (e.g. "
+                           "Chimera start-up, fitmap, scoring, CIF writing) are always stored in extra/stages.jsonl "
+                           "and summarized. If true, the steps run within Scipion are also profiled with cProfile, "
+                           "writing one .prof file per step to extra/profiles. Profiled steps run one at a time.")
 
     # --------------------------- INSERT steps functions ------------------------
     def _insertAllSteps(self):
-        self._insertFunctionStep(self.convertInputStep)
-        self._insertFunctionStep(self.computeQScoresStep)
-        self._insertFunctionStep(self.createOutputStep)
+        convertId = self._insertFunctionStep(self.convertMapStep)
+        pdbFiles = [pdb.get().getFileName() for pdb in self.pdbs]
+        convertIds = {pdbFile: self._insertFunctionStep(self.convertStructureStep, pdbFile, prerequisites=[convertId])
+                      for pdbFile in pdbFiles}
+        fitIds = None
+        if self.autoFit.get() and self.fitMethod.get() == CHIMERA_FIT:
+            # A single Chimera session fits all the structures, opening the map only once
+            fitIds = [self._insertFunctionStep(self.fitStructuresStep, prerequisites=list(convertIds.values()))]
+        structureIds = []
+        # Past the fit, every structure goes through its own chain of steps, run concurrently with the others
+        for pdbFile in pdbFiles:
+            deps = [self._insertFunctionStep(self.computeQScoresStep, pdbFile,
+                                             prerequisites=fitIds or [convertIds[pdbFile]])]
+            structureIds.append(self._insertFunctionStep(self.createStructureOutputStep, pdbFile,
+                                                         prerequisites=deps))
+        self._insertFunctionStep(self.createOutputStep, prerequisites=structureIds)
 
     # --------------------------- STEPS functions -------------------------------
-    def convertInputStep(self):
+    @profiledStep('convert_map')
+    def convertMapStep(self):
         volFile = self.inputVol.get().getFileName()
         sampling = self.inputVol.get().getSamplingRate()
         origin = self.inputVol.get().getShiftsFromOrigin()
-        self.volOutFile = abspath(self._getExtraPath('map.mrc'))
-        Ccp4Header.fixFile(volFile, self.volOutFile, origin, sampling,
-                           Ccp4Header.START)
+        self.convertMap(volFile, origin, sampling)
+        if self.isNativeEngine() and self.precomputeMap.get():
+            writeInterpolationGrid(self._getMapFile())
+        # Digests of the previous conversion, if any, no longer apply (see getMapDigest)
+        pwutils.cleanPath(self._getMapDigestFile(), self._getLocalResolutionDigestFile())
 
-        self.pdbOutFile = []
+        if self.getLocalResolutionFile():
+            localRes = self.localResolution.get()
+            self.convertMap(localRes.getFileName(), localRes.getShiftsFromOrigin(), localRes.getSamplingRate(),
+                            self.getLocalResolutionFile())
+
+    @structureStep
+    @profiledStep('convert_structure')
+    def convertStructureStep(self, pdbFile):
+        structFile = self._getStructureFile(pdbFile)
+        pdbFile = self.convertStructure(pdbFile, structFile)
+
+        nativeFit = self.autoFit.get() and self.fitMethod.get() == NATIVE_FIT
+        if nativeFit:
+            print("Fitting %s into map..." % pwutils.removeBaseExt(pdbFile))
+        fitStats = prepareStructure(pdbFile, structFile, self._getMapFile() if nativeFit else None,
+                                    batchSize=self.getBatchSize())
+        if nativeFit:
+            if 'error' in fitStats:
+                print("Fitting of %s failed, keeping its centered coordinates: %s"
+                      % (pwutils.removeBaseExt(pdbFile), fitStats['error']))
+            self.writeFittingStats(pdbFile, fitStats)
+
+    @profiledStep('fit_structures')
+    def fitStructuresStep(self):
+        """ Fit all the structures into the map within a single Chimera session, which opens the map only once """
+        structFiles, before = {}, {}
         for pdb in self.pdbs:
             pdbFile = pdb.get().getFileName()
+            if not os.path.exists(self._getFailedFile(pdbFile)):
+                structFiles[pdbFile] = abspath(self._getStructureFile(pdbFile))
+                before[pdbFile] = readPdbAtoms(structFiles[pdbFile]).coords
+        if not structFiles:
+            return
+        statusFile = abspath(self._getTmpPath("fitting_status.json"))
+        scriptFile = self._getTmpPath("fitting.py")
+        mapFile = self._getMapFile()
+        fhCmd = open(scriptFile, 'w')
+        fhCmd.write("import json\n")
+        fhCmd.write("import time\n")
+        fhCmd.write("import chimera\n")
+        fhCmd.write("from chimera import runCommand\n")
+        fhCmd.write("volId = chimera.openModels.open('%s')[0].id\n" % mapFile)
+        if os.path.exists(mapFile + PLACEMENT_SUFFIX):
+            voxelSize, volOrigin = readPlacement(mapFile)
+            fhCmd.write("runCommand('volume #%%d voxelSize %s originIndex %s' %% volId)\n"
+                        % (",".join(map(str, voxelSize)), ",".join(map(str, -volOrigin / voxelSize))))
+        fhCmd.write("status = []\n")
+        fhCmd.write("for structFile in %s:\n" % repr(list(structFiles.values())))
+        fhCmd.write("    error = None\n")
+        fhCmd.write("    fitStart = time.time()\n")
+        fhCmd.write("    try:\n")
+        fhCmd.write("        models = chimera.openModels.open(structFile)\n")
+        fhCmd.write("        fitStart = time.time()\n")
+        fhCmd.write("        runCommand('fitmap #%d #%d' % (models[0].id, volId))\n")
+        fhCmd.write("        runCommand('write relative #%d #%d %s' % (volId, models[0].id, structFile))\n")
+        fhCmd.write("        chimera.openModels.close(models)\n")
+        fhCmd.write("    except Exception as e:\n")
+        fhCmd.write("        error = str(e)\n")
+        fhCmd.write("    status.append({'error': error, 'fitStart': fitStart, 'end': time.time()})\n")
+        fhCmd.write("json.dump(status, open('%s', 'w'))\n" % statusFile)
+        fhCmd.close()
+
+        print("Fitting %d structures into map..." % len(structFiles))
+        args = "--nogui --script %s" % scriptFile
+        launch = time.time()
+        self.runJob(mapq.Plugin.getChimeraProgram(), args)
+
+        with open(statusFile) as fh:
+            status = json.load(fh)
+        grid = readMap(mapFile, mmap=True)
+        # Chimera start-up includes opening the map, done once for all the structures
+        self.getProfiler().record('chimera_startup', start=launch, wall=status[0]['fitStart'] - launch)
+        for (pdbFile, structFile), fitStatus in zip(structFiles.items(), status):
             baseName = pwutils.removeBaseExt(pdbFile)
-            self.pdbOutFile.append(abspath(self._getExtraPath('%s.pdb' % baseName)))
-            h = AtomicStructHandler()
-            h.read(pdbFile)
-            self.moveOriginTo([0, 0, 0], h)
-            h.writeAsPdb(self.pdbOutFile[-1])
-
-            if self.autoFit.get():
-                print("Fitting %s into map..." % baseName)
-                scriptFile = self._getTmpPath("fitting.py")
-                fhCmd = open(scriptFile, 'w')
-                fhCmd.write("import chimera\n")
-                fhCmd.write("from chimera import runCommand\n")
-                fhCmd.write("runCommand('open %s')\n" % self.pdbOutFile[-1])
-                fhCmd.write("runCommand('open %s')\n" % self.volOutFile)
-                fhCmd.write("runCommand('fitmap #0 #1')\n")
-                fhCmd.write("runCommand('write relative #1 #0 %s')\n" % self.pdbOutFile[-1])
-                args = "--nogui --script %s" % scriptFile
-                self.runJob(mapq.Plugin.getChimeraProgram(), args)
-
-    def computeQScoresStep(self):
-        args = '%s %s ' % (mapq.Plugin.getChimeraPath(), self.volOutFile)
-        args += " ".join(self.pdbOutFile)
+            self.getProfiler().record('fitmap', baseName, start=fitStatus['fitStart'],
+                                      wall=fitStatus['end'] - fitStatus['fitStart'])
+            if fitStatus['error'] is None:
+                fitStats = fitStatistics(grid, before[pdbFile], readPdbAtoms(structFile).coords)
+            else:
+                print("Fitting of %s failed, keeping its centered coordinates: %s" % (baseName, fitStatus['error']))
+                fitStats = {'error': fitStatus['error']}
+            self.writeFittingStats(pdbFile, fitStats)
+
+    @structureStep
+    @profiledStep('qscores')
+    def computeQScoresStep(self, pdbFile):
+        structFile = self._getStructureFile(pdbFile)
+        if self.useCache.get():
+            atoms = readPdbAtoms(structFile)
+            cache = ResultCache(mapq.CACHEDIR, mapq.CACHESIZE)
+            key = self.getCacheKey(atoms, pdbFile)
+            scores = cache.get(key)
+            if scores is not None and len(scores) == len(atoms):
+                print("Reusing cached Q-scores for %s" % pwutils.removeBaseExt(pdbFile))
+                # Scores of the sigma sweep, if any, are stored as additional columns
+                scores = scores.reshape(len(atoms), -1)
+                for width, values in zip(self.getSigmaSweep(), scores[:, 1:].T):
+                    writePdbBFactors(atoms, values, self._getSweepFile(pdbFile, width))
+                scores = scores[:, 0]
+                writePdbBFactors(atoms, scores, self._getQScoresFile(pdbFile))
+                if self.getLocalResolutionFile():
+                    atomResolution(self.getLocalResolutionFile(), atoms, self._getResolutionFile(pdbFile))
+                if self.bFactor.get():
+                    writePdbBFactors(atoms, self.bFactor.get() * (1. - scores), self._getBFactorFile(pdbFile))
+                self.writeScoringParams(pdbFile, atoms)
+                return
+
+        with self.getProfiler().stage('native_scoring' if self.isNativeEngine() else 'mapq_cmd',
+                                      pwutils.removeBaseExt(pdbFile)):
+            if self.isNativeEngine():
+                self.computeNativeQScores(structFile)
+            else:
+                self.computeChimeraQScores(structFile)
+
+        if self.useCache.get():
+            cache.put(key, np.column_stack([readPdbAtoms(self._getQScoresFile(pdbFile)).bFactor] +
+                                           [readPdbAtoms(self._getSweepFile(pdbFile, width)).bFactor
+                                            for width in self.getSigmaSweep()]))
+        self.writeScoringParams(pdbFile)
+
+    def computeChimeraQScores(self, structFile):
+        args = '%s %s %s' % (mapq.Plugin.getChimeraPath(), self._getMapFile(), structFile)
 
         if self.mapRes.get():
             args += " res=%f" % self.mapRes.get()
@@ -123,42 +464,532 @@ class ProtMapQ(ProtAnalysis3D):
         if self.sigma.get():
             args += ' sigma=%f' % self.sigma.get()
 
-        args += " np=%d" % self.numberOfThreads.get()
+        args += " np=%d" % self.getStructureProcesses()
 
         python_file, mapq_file = mapq.Plugin.getMapQProgram()
         self.runJob(python_file, mapq_file + " " + args)
 
+    def computeNativeQScores(self, structFile):
+        sigma = self.sigma.get() or SIGMA
+        baseName = pwutils.removeBaseExt(structFile)
+        print("Computing Q-scores for %s..." % baseName)
+        if self.getBatchSize():
+            score = functools.partial(self.runScoring, streamScoreStructure, self._getMapFile(), structFile,
+                                      batchSize=self.getBatchSize(), sigma=sigma,
+                                      numberOfProcesses=self.getStructureProcesses())
+            outputs = {}
+        else:
+            previous, previousScored = self.getPreviousScores(baseName)
+            score = functools.partial(self.runScoring, scoreStructure, self._getMapFile(), structFile, sigma=sigma,
+                                      numberOfProcesses=self.getStructureProcesses(),
+                                      cropMap=self.cropMap.get(), previous=previous, previousScored=previousScored,
+                                      moveTolerance=self.moveTolerance.get(),
+                                      symmetry=self.getSymmetryMatrices(), checkCopies=self.checkCopies.get(),
+                                      localResolution=self.getLocalResolutionFile(),
+                                      localSigma=self.localSigma.get(), resolution=self.mapRes.get(),
+                                      selection=self.getSelection(readPdbAtoms(structFile)))
+            outputs = {'symmetryReport': self._getSymmetryReportFile(structFile),
+                       'sweep': [(width, self._getSweepFile(structFile, width)) for width in self.getSigmaSweep()],
+                       'resolutionFile': self._getResolutionFile(structFile)}
+        scores = score(self._getQScoresFile(structFile), bFactor=self.bFactor.get(),
+                       bFactorFile=self._getBFactorFile(structFile), precision=self.getPrecision(), **outputs)
+        if self.checkPrecision.get():
+            self.checkScorePrecision(structFile, scores, score)
+
+    def runScoring(self, function, *args, **kwargs):
+        """ Run a scoring function of the pipeline in the scoring server when requested and running,
+        or within the protocol otherwise """
+        if self.useServer.get():
+            try:
+                return scoreOnServer(mapq.SERVER_SOCKET, function.__name__, *args, **kwargs)
+            except ConnectionError as e:
+                print("%s, scoring within the protocol" % e)
+        return function(*args, **kwargs)
+
+    def checkScorePrecision(self, structFile, scores, score):
+        """ Score structFile again with score in the other precision and store the deviation of its
+        heavy atom scores from the given ones """
+        baseName = pwutils.removeBaseExt(structFile)
+        other = np.float64 if self.getPrecision() == np.float32 else np.float32
+        print("Scoring %s again in %s to check the precision..." % (baseName, other.__name__))
+        otherFile = self._getTmpPath(baseName + "__Q__%s.pdb" % other.__name__)
+        reference = score(otherFile, precision=other)
+        pwutils.cleanPath(otherFile)
+        if self.getBatchSize():
+            heavy = readAtomColumns(structFile, self.getBatchSize())[0]['heavy']
+        else:
+            atoms = readPdbAtoms(structFile)
+            heavy = atoms.heavyAtoms()
+            if self.hasSelection():
+                heavy &= self.getSelection(atoms)
+        report = scoreDeviation(scores[heavy], reference[heavy])
+        report.update(precision=self.getPrecision().__name__, reference=other.__name__)
+        print("Maximum deviation of the Q-scores in %s: %g" % (other.__name__, report.get('maxDeviation', 0.)))
+        with open(self._getPrecisionReportFile(structFile), 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    @structureStep
+    @profiledStep('structure_output')
+    def createStructureOutputStep(self, pdbFile):
+        """ Write the scored structure as mmCIF and store its statistics """
+        outStructFileName = self._getOutputFile(pdbFile)
+        qScoresFile = self._getQScoresFile(pdbFile)
+        if self.getBatchSize() and pdbFile.endswith(('.pdb', '.ent')):
+            with self.getProfiler().stage('cif_write', pwutils.removeBaseExt(pdbFile)):
+                attributes, records, chainIds, residues = self.writeScoredStructureBatches(pdbFile, qScoresFile,
+                                                                                           outStructFileName)
+            scores, chains = records['score'], records['chain']
+        else:
+            atoms = readPdbAtoms(qScoresFile)
+            # Every atom gets the attributes, viewers map them by position, those outside the selection
+            # with the score of 0 of unscored atoms. The statistics and residue tables only cover the selection.
+            selected = self.getSelection(atoms) if self.hasSelection() else np.ones(len(atoms), dtype=bool)
+            selectedAtoms = atoms.subset(selected)
+            atomIds = self.getAtomIds(self._getStructureFile(pdbFile))
+            residues = residueScores(selectedAtoms, selectedAtoms.bFactor, self.getExpectedQScores(pdbFile, selected))
+            sweep = [('%s_s%g' % (self._ATTRNAME, width), 'atoms', atomSpecs(atoms, atomIds),
+                      readPdbAtoms(self._getSweepFile(pdbFile, width)).bFactor)
+                     for width in self.getSigmaSweep()]
+            with self.getProfiler().stage('cif_write', pwutils.removeBaseExt(pdbFile)):
+                attributes = self.writeScoredStructure(pdbFile, atoms, outStructFileName,
+                                                       sweep + self.getResidueAttributes(residues), atomIds)
+            scores, chains, chainIds = selectedAtoms.bFactor, selectedAtoms.chain, None
+        self.writeResidueTables(pdbFile, residues)
+        stats = scoreSummary(scores, chains, chainNames=chainIds)
+        stats['attributes'] = attributes
+        if self.getSigmaSweep():
+            stats['sweep'] = {'%g' % width: scoreSummary(values[selected], chains)
+                              for width, (_, _, _, values) in zip(self.getSigmaSweep(), sweep)}
+        if os.path.exists(self._getSymmetryReportFile(pdbFile)):
+            with open(self._getSymmetryReportFile(pdbFile)) as fh:
+                stats['symmetry'] = json.load(fh)
+        if os.path.exists(self._getPrecisionReportFile(pdbFile)):
+            with open(self._getPrecisionReportFile(pdbFile)) as fh:
+                stats['precision'] = json.load(fh)
+        with open(self._getStructureStatsFile(pdbFile), 'w') as fh:
+            json.dump(stats, fh)
+
+    @profiledStep('output')
     def createOutputStep(self):
-        outStructFileBase = self._getExtraPath('{}.cif')
-        ASH = AtomicStructHandler()
         outSet = SetOfAtomStructs.create(self._getPath())
+        stats, fitting, failed = {}, {}, []
         for pdb in self.pdbs:
             pdbFile = pdb.get().getFileName()
             baseName = pwutils.removeBaseExt(pdbFile)
-            outStructFileName = outStructFileBase.format(baseName)
-            ASH.read(self._getExtraPath(baseName + "__Q__map.pdb"))
-            mapQ_dict = {'{}:{}'.format(atom.full_id[2], atom.serial_number): str(round(atom.bfactor, 4))
-                         for atom in ASH.getStructure().get_atoms()}
-            inpAS = toCIF(pdbFile, outStructFileName)
-            cifDic = ASH.readLowLevel(inpAS)
-            cifDic = addScipionAttribute(cifDic, mapQ_dict, self._ATTRNAME, recipient = 'atoms')
-            ASH._writeLowLevel(outStructFileName, cifDic)
+            if os.path.exists(self._getFailedFile(pdbFile)):
+                failed.append(baseName)
+                continue
+            with open(self._getStructureStatsFile(pdbFile)) as fh:
+                stats[baseName] = json.load(fh)
+            if os.path.exists(self._getFittingStatsFile(pdbFile)):
+                with open(self._getFittingStatsFile(pdbFile)) as fh:
+                    fitting[baseName] = json.load(fh)
 
             outAS = AtomStruct()
-            outAS.setFileName(outStructFileName)
+            outAS.setFileName(self._getOutputFile(pdbFile))
             outSet.append(outAS.clone())
 
+        if not stats:
+            raise Exception("None of the structures could be scored: %s" % ", ".join(failed))
+        if fitting:
+            with open(self._getExtraPath('fitting.json'), 'w') as fh:
+                json.dump(fitting, fh, indent=2)
+        self.writeScoreStats(stats)
         self._defineOutputs(scoredStructures=outSet)
         for pdb in self.pdbs:
             self._defineSourceRelation(pdb, outSet)
 
     # --------------------------- UTILS functions -------------------------------
-    def moveOriginTo(self, newOrigin, handler):
-        centerMass = handler.centerOfMass(geometric=True)
-        for atom in handler.getStructure().get_atoms():
-            coords = atom.get_coord()
-            atom.coord = coords + np.asarray(newOrigin) - np.asarray(centerMass)
+    def _getMapFile(self):
+        return abspath(self._getExtraPath('map.mrc'))
+
+    def _getStructureFile(self, pdbFile):
+        """ Centered (and fitted) copy of an input structure that is scored """
+        return abspath(self._getExtraPath('%s.pdb' % pwutils.removeBaseExt(pdbFile)))
+
+    def _getQScoresFile(self, pdbFile):
+        """ File with the Q-scores of a structure in the B-factor column, as named by mapq_cmd.py """
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "__Q__map.pdb")
+
+    def _getBFactorFile(self, pdbFile):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "__Bfactor.pdb")
+
+    def _getOutputFile(self, pdbFile):
+        return self._getExtraPath('%s.cif' % pwutils.removeBaseExt(pdbFile))
+
+    def _getStructureStatsFile(self, pdbFile):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "_stats.json")
+
+    def _getFittingStatsFile(self, pdbFile):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "_fitting.json")
+
+    def _getFailedFile(self, pdbFile):
+        """ File holding the error of a structure that could not be processed """
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "_failed.txt")
+
+    def _getMapDigestFile(self):
+        return self._getExtraPath('map.digest')
+
+    def getMapDigest(self):
+        """ Hash of the voxels of the converted map, only computed the first time the cache needs it """
+        return self._getDigest(self._getMapFile(), self._getMapDigestFile())
+
+    def getLocalResolutionDigest(self):
+        return self._getDigest(self.getLocalResolutionFile(), self._getLocalResolutionDigestFile())
+
+    @staticmethod
+    def _getDigest(mapFile, digestFile):
+        # Structures scored concurrently wait for the first one to hash the map instead of hashing it again
+        with _digestLock:
+            if not os.path.exists(digestFile):
+                with open(digestFile, 'w') as fh:
+                    fh.write(mapDigest(mapFile))
+            with open(digestFile) as fh:
+                return fh.read()
+
+    @staticmethod
+    def _getVolumeIdentity(vol):
+        """ Input file of a volume and its placement, telling maps apart without reading them """
+        return fileIdentity(vol.getFileName()) + [vol.getSamplingRate(),
+                                                  [float(x) for x in vol.getShiftsFromOrigin()]]
+
+    def getStructureProcesses(self):
+        """ Processes used by the steps of one structure, sharing the threads with the other structures """
+        threads = max(1, self.numberOfThreads.get())
+        return max(1, threads // min(threads, len(self.pdbs)))
+
+    def getScoringParams(self, digests=False):
+        """ Everything the Q-score of a scored atom depends on, besides the atoms themselves. With digests, maps
+        are identified by the hash of their voxels, as the cache shared by all runs needs; otherwise by their
+        input files, which is cheap enough for every run to store it next to its Q-scores """
+        params = {'map': self.getMapDigest() if digests else self._getVolumeIdentity(self.inputVol.get())}
+        params.update({'engine': self.engine.get(), 'sigma': self.sigma.get() or SIGMA, 'mapRes': self.mapRes.get(),
+                       'pluginVersion': mapq.__version__, 'mapqVersion': MAPQ_VERSION})
+        if self.isNativeEngine():
+            params['precision'] = self.getPrecision().__name__
+        if self.getLocalResolutionFile() and self.localSigma.get():
+            params['localResolution'] = (self.getLocalResolutionDigest() if digests
+                                         else self._getVolumeIdentity(self.localResolution.get()))
+        if self.getSymmetryMatrices() is not None:
+            # Transferred scores differ slightly from those computed for every copy
+            params['symmetry'] = [self.getSymmetryGroup(), self.helicalRise.get(), self.helicalTwist.get(),
+                                  self.checkCopies.get()]
+        return params
+
+    def getCacheKey(self, atoms, pdbFile):
+        params = self.getScoringParams(digests=True)
+        mapHash = params.pop('map')
+        if self.hasSelection():
+            params['selection'] = [self.selectChains.get(), self.selectResidues.get(), self.selectLigands.get(),
+                                   self.selectRadius.get()]
+        if self.getSigmaSweep():
+            params['sigmaSweep'] = self.getSigmaSweep()
+        previous, previousScored = self.getPreviousScores(pwutils.removeBaseExt(pdbFile))
+        if previous is not None:
+            # Reused scores are close to, but not the same as, those of a full run
+            params['previous'] = [fileDigest(previous), previousScored, self.moveTolerance.get()]
+        return ResultCache.key(mapHash, atomsDigest(atoms), **params)
+
+    def writeScoringParams(self, pdbFile, atoms=None):
+        """ Store the scoring parameters and the atoms holding a Q-score next to the __Q__ file of a structure,
+        so that later runs only reuse its scores when they are comparable (see getPreviousScores) """
+        params = {'params': self.getScoringParams(), 'scored': None}
+        if self.hasSelection():
+            atoms = atoms or readPdbAtoms(self._getStructureFile(pdbFile))
+            params['scored'] = np.flatnonzero(atoms.heavyAtoms() & self.getSelection(atoms)).tolist()
+        with open(self._getScoringParamsFile(self._getQScoresFile(pdbFile)), 'w') as fh:
+            json.dump(params, fh)
 
+    def getPreviousScores(self, baseName):
+        """ __Q__ file of the previous scores of a structure and the indices of its scored atoms (None for all
+        its heavy atoms), or (None, None) when there are none or they were scored with other parameters """
+        previous = self.getPreviousScoresFiles().get(baseName)
+        if previous is None:
+            return None, None
+        paramsFile = self._getScoringParamsFile(previous)
+        if not os.path.exists(paramsFile):
+            print("No scoring parameters found for the previous Q-scores of %s, all its atoms will be scored"
+                  % baseName)
+            return None, None
+        with open(paramsFile) as fh:
+            params = json.load(fh)
+        if params['params'] != self.getScoringParams():
+            print("The previous Q-scores of %s were computed with another map or parameters, all its atoms will "
+                  "be scored" % baseName)
+            return None, None
+        return previous, params['scored']
+
+    def getPreviousScoresFiles(self):
+        """ __Q__ files of the previous scored structures, written next to their output CIF, by base name of the
+        structure they are paired with """
+        previousFiles = {}
+        for baseName, fileName in self.getPreviousPairs().items():
+            qFile = os.path.join(os.path.dirname(fileName), pwutils.removeBaseExt(fileName) + "__Q__map.pdb")
+            if os.path.exists(qFile):
+                previousFiles[baseName] = qFile
+            else:
+                print("No previous Q-scores found for %s, all its atoms will be scored" % baseName)
+        return previousFiles
+
+    def getPreviousPairs(self):
+        """ Output CIF of the previous scored structure paired with each input structure, by base name: the one
+        with the same name or, failing that, the next one left in input order, e.g. an earlier refinement
+        iteration written under another name """
+        if self.previousScores.get() is None:
+            return {}
+        previous = {pwutils.removeBaseExt(struct.getFileName()): struct.getFileName()
+                    for struct in self.previousScores.get()}
+        baseNames = [pwutils.removeBaseExt(pdb.get().getFileName()) for pdb in self.pdbs]
+        pairs = {baseName: previous[baseName] for baseName in baseNames if baseName in previous}
+        unpaired = [fileName for name, fileName in previous.items() if name not in pairs]
+        for baseName in baseNames:
+            if baseName not in pairs and unpaired:
+                pairs[baseName] = unpaired.pop(0)
+        return pairs
+
+    def writeScoredStructure(self, pdbFile, atoms, outFile, extraAttributes=(), atomIds=None):
+        """ Write pdbFile as mmCIF to outFile with the Q-scores of the AtomTable atoms as atom attributes,
+        followed by the (attrName, recipient, specs, values) extraAttributes. atomIds are the ids of the
+        atoms of mmCIF inputs (see getAtomIds). Returns the names of the attributes with rows in the written
+        file. """
+        attributes = [(self._ATTRNAME, 'atoms', atomSpecs(atoms, atomIds), atoms.bFactor)] + list(extraAttributes)
+        if pdbFile.endswith(('.pdb', '.ent')):
+            # Numbered like the specifiers, in the same way as in streaming mode
+            writePdbAsCif(pdbFile, outFile)
+            inpAS = outFile
+        else:
+            inpAS = toCIF(pdbFile, outFile)
+        if not hasScipionAttributes(inpAS):
+            if inpAS != outFile:
+                shutil.copyfile(inpAS, outFile)
+            appendScipionAttributes(outFile, attributes)
+            return list(dict.fromkeys(attrName for attrName, _, specs, _ in attributes if len(specs)))
+        else:
+            # The new rows must be merged with the attributes already in the file
+            ASH = AtomicStructHandler()
+            cifDic = ASH.readLowLevel(inpAS)
+            for attrName, recipient, specs, values in attributes:
+                attrDict = dict(zip(np.asarray(specs).tolist(), np.round(values, 4).astype(str).tolist()))
+                cifDic = addScipionAttribute(cifDic, attrDict, attrName, recipient=recipient)
+            ASH._writeLowLevel(outFile, cifDic)
+            return sorted(set(cifDic['_scipion_attributes.name']))
+
+    def writeScoredStructureBatches(self, pdbFile, qScoresFile, outFile):
+        """ As writeScoredStructure, for PDB files, reading and writing them in batches. Returns the
+        names of the attributes of the written file, the compact records of the atoms holding their
+        Q-scores (see atomRecords), the chain IDs they refer to and the residue table. """
+        batchSize = self.getBatchSize()
+        writePdbAsCif(pdbFile, outFile, batchSize)
+        records, chains, residues = [], [], []
+
+        def batches():
+            for atoms in iterPdbAtoms(qScoresFile, batchSize):
+                records.append(atomRecords(atoms, self.getPrecision(), chains, atoms.bFactor))
+                # Batches never split residues
+                residues.append(residueScores(atoms, atoms.bFactor, self.getExpectedQScores(pdbFile)))
+                yield self._ATTRNAME, 'atoms', atomSpecs(atoms), atoms.bFactor
+            # Residue rows go after all the atom rows, in the same loop
+            yield from self.getResidueAttributes(concatenateTables(residues))
+
+        appendScipionAttributes(outFile, batches())
+        residues = concatenateTables(residues)
+        attributes = [self._ATTRNAME] + [attrName for attrName, _, _, _ in self.getResidueAttributes(residues)]
+        return attributes, np.concatenate(records), chains, residues
+
+    def getResidueAttributes(self, residues):
+        """ (attrName, recipient, specs, values) residue attributes of a residue table, leaving out
+        the residues without a value, e.g. the backbone score of ligands, and the attributes without any,
+        e.g. the side chain score of backbone only models """
+        specs = residueSpecs(residues)
+        attributes = []
+        for column, attrName in self._RESIDUE_ATTRNAMES:
+            if column in residues:
+                valid = ~np.isnan(residues[column])
+                if np.any(valid):
+                    attributes.append((attrName, 'residues', specs[valid], residues[column][valid]))
+        return attributes
+
+    def getExpectedQScores(self, pdbFile, selected=None):
+        """ Expected Q-score of the atoms of a structure (those of the selected mask when given), at their
+        local resolution when given or at the map resolution, None when unknown """
+        if not self.getLocalResolutionFile():
+            return expectedQScore(self.mapRes.get(), self.sigma.get() or SIGMA)
+        if self.localSigma.get():
+            return None
+        resolutions = readPdbAtoms(self._getResolutionFile(pdbFile)).bFactor
+        if selected is not None:
+            resolutions = resolutions[selected]
+        return expectedQScore(np.where(resolutions > 0, resolutions, np.nan), self.sigma.get() or SIGMA)
+
+    def getLocalResolutionFile(self):
+        """ Local resolution map in the frame of the map, None when not given """
+        if not self.isNativeEngine() or self.localResolution.get() is None:
+            return None
+        return abspath(self._getExtraPath('local_resolution.mrc'))
+
+    @staticmethod
+    def _getScoringParamsFile(qFile):
+        return os.path.splitext(qFile)[0] + '.json'
+
+    def _getLocalResolutionDigestFile(self):
+        return self._getExtraPath('local_resolution.digest')
+
+    def _getResolutionFile(self, pdbFile):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "__resolution.pdb")
+
+    def writeResidueTables(self, pdbFile, residues):
+        """ Store the residue and chain tables of a structure as columns in .npz files """
+        np.savez(self._getResidueTableFile(pdbFile), **residues)
+        np.savez(self._getChainTableFile(pdbFile), **chainScores(residues))
+
+    def _getResidueTableFile(self, pdbFile):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "_residues.npz")
+
+    def _getChainTableFile(self, pdbFile):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "_chains.npz")
+
+    def getSymmetryMatrices(self):
+        """ (4, 4) symmetry matrices of the map around its center, None when it is not symmetric """
+        if not self.isNativeEngine() or self.getSymmetryGroup() == 'C1':
+            return None
+        grid = readMap(self._getMapFile(), mmap=True)
+        center = grid.origin + (np.asarray(grid.getShape()) // 2) * grid.voxelSize
+        return np.asarray(symmetry.getSymmetryMatrices(self.symmetryGroup.get(), n=self.symmetryOrder.get(),
+                                                       center=tuple(center), rise=self.helicalRise.get(),
+                                                       angle=self.helicalTwist.get()))
+
+    def getSymmetryGroup(self):
+        """ Name of the symmetry of the map, e.g. C4 """
+        group = self.symmetryGroup.get()
+        name = SCIPION_SYM_NAME[group]
+        if group in [SYM_CYCLIC, SYM_DIHEDRAL_X, SYM_DIHEDRAL_Y]:
+            name = name[:-1] + str(self.symmetryOrder.get())
+        return name
+
+    def _getSymmetryReportFile(self, pdbFile):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "_symmetry.json")
+
+    def hasSelection(self):
+        """ True if only a region of interest of the structures is scored """
+        return self.isNativeEngine() and bool(self.selectChains.get() or self.selectResidues.get() or
+                                              self.selectLigands.get())
+
+    def getSelection(self, atoms):
+        """ Boolean mask of the atoms of an AtomTable in the region of interest, None without selection """
+        if not self.hasSelection():
+            return None
+        selected = selectAtoms(atoms, chains=self.selectChains.get().replace(',', ' ').split(),
+                               residueRanges=parseResidueRanges(self.selectResidues.get() or ''),
+                               ligands=self.selectLigands.get().replace(',', ' ').split(),
+                               radius=self.selectRadius.get())
+        if not np.any(selected):
+            raise ValueError("No atom matches the selection")
+        return selected
+
+    def getPrecision(self):
+        """ NumPy floating point type used by the native scoring """
+        return np.float64 if self.precision.get() == FLOAT64 else np.float32
+
+    def _getPrecisionReportFile(self, pdbFile):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "_precision.json")
+
+    def getProfiler(self):
+        """ Profiler recording the stages of this run as JSON lines, also profiling them with cProfile
+        when requested """
+        return StageProfiler(self._getStagesFile(), self._getExtraPath('profiles') if self.profile.get() else None)
+
+    def _getStagesFile(self):
+        return self._getExtraPath('stages.jsonl')
+
+    def getSigmaSweep(self):
+        """ Additional widths of the reference Gaussian the structures are scored with """
+        if not self.isNativeEngine() or not self.sigmaSweep.get():
+            return []
+        return [float(width) for width in self.sigmaSweep.get().replace(',', ' ').split()]
+
+    def _getSweepFile(self, pdbFile, sigma):
+        return self._getExtraPath(pwutils.removeBaseExt(pdbFile) + "__Q__s%g.pdb" % sigma)
+
+    def getBatchSize(self):
+        """ Number of atoms processed at once by the streaming mode, None when not streaming """
+        if self.isNativeEngine() and self.batchSize.get():
+            return self.batchSize.get()
+        return None
+
+    def writeScoreStats(self, stats):
+        with open(self._getScoreStatsFile(), 'w') as fh:
+            json.dump(stats, fh, indent=2)
+
+    def readScoreStats(self):
+        """ Statistics of the scored structures by base name, or None for runs that did not store them """
+        statsFile = self._getScoreStatsFile()
+        if not os.path.exists(statsFile):
+            return None
+        with open(statsFile) as fh:
+            return json.load(fh)
+
+    def _getScoreStatsFile(self):
+        return self._getExtraPath('qscores_stats.json')
+
+    def writeFittingStats(self, pdbFile, fitStats):
+        with open(self._getFittingStatsFile(pdbFile), 'w') as fh:
+            json.dump(fitStats, fh, indent=2)
+
+    def convertMap(self, volFile, origin, sampling, outFile=None):
+        """ Make the input map available as outFile (_getMapFile() by default) placed at origin with the
+        given sampling. The voxels are only copied when they cannot be used in place. """
+        outFile = outFile or self._getMapFile()
+        volFile = volFile.split(':')[0]
+        pwutils.cleanPath(outFile, outFile + PLACEMENT_SUFFIX, outFile + INTERPOLATION_SUFFIX)
+        if Ccp4Header.isCompatible(volFile):
+            volOrigin = fixedOrigin(origin, sampling)
+            if hasPlacement(volFile, sampling, volOrigin):
+                print("Map header already correct, linking %s..." % volFile)
+                pwutils.createAbsLink(volFile, outFile)
+                return
+            if self.isNativeEngine():
+                # mapq_cmd.py can only read the placement from the header, the native engine and Chimera
+                # fitting can take it from a small file stored next to the map instead
+                print("Patching map header of %s without copying its voxels..." % volFile)
+                pwutils.createAbsLink(volFile, outFile)
+                writePlacement(outFile, sampling, volOrigin)
+                return
+
+        Ccp4Header.fixFile(volFile, outFile, origin, sampling,
+                           Ccp4Header.START)
+
+    def convertStructure(self, pdbFile, structFile):
+        """ PDB file with the atoms of pdbFile, mmCIF structures being converted to structFile. The
+        _atom_site.id of their atoms, in the order of the PDB file, are stored for getAtomIds. """
+        pwutils.cleanPath(self._getAtomIdsFile(structFile))
+        if pdbFile.endswith(('.pdb', '.ent')):
+            return pdbFile
+        # mmCIF structures are converted once, the centering is done on the PDB
+        h = AtomicStructHandler()
+        h.read(pdbFile)
+        h.writeAsPdb(structFile)
+        # Atoms are written by residue, every alternate location included, renumbered from 1
+        atomIds = [atom.get_serial_number() for residue in h.getStructure().get_residues()
+                   for atom in residue.get_unpacked_list()]
+        np.save(self._getAtomIdsFile(structFile), atomIds)
+        return structFile
+
+    def getAtomIds(self, structFile):
+        """ _atom_site.id of the atoms of the structure converted to structFile, in order, None for PDB
+        inputs, whose atoms are numbered by their position """
+        idsFile = self._getAtomIdsFile(structFile)
+        return np.load(idsFile) if os.path.exists(idsFile) else None
+
+    def _getAtomIdsFile(self, structFile):
+        return os.path.splitext(structFile)[0] + "_ids.npy"
+
+    def getFailedNames(self):
+        """ Names of the structures that could not be scored """
+        return [pwutils.removeBaseExt(pdb.get().getFileName()) for pdb in self.pdbs
+                if os.path.exists(self._getFailedFile(pdb.get().getFileName()))]
+
+    def isNativeEngine(self):
+        return self.engine.get() == NATIVE_ENGINE
 
     # --------------------------- INFO functions ------------------------------
     def _methods(self):
@@ -166,21 +997,119 @@ class ProtMapQ(ProtAnalysis3D):
         methods.append('QScore computation using MapQ')
         return methods
 
+    def _validate(self):
+        errors = []
+        if self.getBatchSize() and self.previousScores.get() is not None:
+            errors.append("Previous Q-scores can not be reused in streaming mode, set the batch size to 0.")
+        try:
+            sweep = self.getSigmaSweep()
+        except ValueError:
+            errors.append("Additional sigmas must be a list of numbers, e.g. 0.4 0.5 0.7")
+            sweep = []
+        if sweep:
+            if self.getBatchSize():
+                errors.append("Additional sigmas can not be used in streaming mode, set the batch size to 0.")
+            if self.getSymmetryGroup() != 'C1' or self.previousScores.get() is not None:
+                errors.append("Additional sigmas can not be combined with symmetry or previous Q-scores.")
+        try:
+            parseResidueRanges(self.selectResidues.get() or '')
+        except ValueError:
+            errors.append("Residues must be a list of ranges, e.g. A:10-25, B:40, 100-120")
+        if self.hasSelection():
+            if self.getBatchSize():
+                errors.append("A selection can not be scored in streaming mode, set the batch size to 0.")
+            if self.getSymmetryGroup() != 'C1':
+                errors.append("A selection can not be combined with symmetry.")
+        if self.getLocalResolutionFile() and self.getBatchSize():
+            errors.append("The local resolution can not be used in streaming mode, set the batch size to 0.")
+        if self.isNativeEngine() and self.getSymmetryGroup() != 'C1':
+            if self.getBatchSize():
+                errors.append("Symmetry can not be used in streaming mode, set the batch size to 0.")
+            if self.previousScores.get() is not None:
+                errors.append("Symmetry can not be combined with reusing previous Q-scores.")
+        return errors
+
     def _summary(self):
         summary = []
         if not self.isFinished():
             summary.append("QScores not ready yet.")
 
+        failed = self.getFailedNames()
+        if failed:
+            summary.append("Structures that could not be scored: %s" % ", ".join(failed))
+        summary += self._summaryPrevious()
+
         if self.getOutputsSize() >= 1:
+            stats = self.readScoreStats()
+            if stats is None:
+                return summary + self._summaryFromFiles()
             summary.append("*Mean Q-Scores:*")
-            ASH = AtomicStructHandler()
-            for struct in self.scoredStructures:
-                fileName = struct.getFileName()
-                fields = ASH.readLowLevel(fileName)
-                attributes = fields["_scipion_attributes.name"]
-                values = fields["_scipion_attributes.value"]
-                mapq_scores = [float(value) for attribute, value in zip(attributes, values)
-                               if attribute == self._ATTRNAME]
-                mean_score = sum(mapq_scores) / len(mapq_scores)
-                summary.append("      - %s --> %.4f" % (pwutils.removeBaseExt(fileName), mean_score))
+            for baseName, structStats in stats.items():
+                if not structStats['atoms']:
+                    continue
+                summary.append("      - %s --> %.4f" % (baseName, structStats['mean']))
+                percentiles = structStats['percentiles']
+                summary.append("          median %.4f, 5-95%% range [%.4f, %.4f], %d atoms" %
+                               (structStats['median'], percentiles['5'], percentiles['95'], structStats['atoms']))
+                for width, sweepStats in structStats.get('sweep', {}).items():
+                    summary.append("          sigma %s: mean %.4f, median %.4f" %
+                                   (width, sweepStats['mean'], sweepStats['median']))
+                if 'symmetry' in structStats:
+                    symStats = structStats['symmetry']
+                    flagged = [op for op in symStats['operators'] if op['flagged']]
+                    summary.append("          %d of %d atoms scored in the asymmetric unit, %s" %
+                                   (symStats['asymmetricUnit'], symStats['atoms'],
+                                    "%d symmetry copies do not follow the map symmetry" % len(flagged)
+                                    if flagged else "all symmetry copies consistent"))
+                if structStats.get('precision', {}).get('atoms'):
+                    precision = structStats['precision']
+                    summary.append("          %s scores differ from %s ones by at most %.2e (mean %.2e)" %
+                                   (precision['precision'], precision['reference'], precision['maxDeviation'],
+                                    precision['meanDeviation']))
+                if len(structStats['chains']) > 1:
+                    chains = structStats['chains'].items()
+                    summary.append("          chains: " + ", ".join("%s %.4f" % (chain, chainStats['mean'])
+                                                                    for chain, chainStats in chains))
+        return summary + self._summaryStages()
+
+    def _summaryPrevious(self):
+        if self.previousScores.get() is None:
+            return []
+        summary = []
+        pairs = self.getPreviousPairs()
+        for baseName, fileName in pairs.items():
+            if pwutils.removeBaseExt(fileName) != baseName:
+                summary.append("Previous Q-scores of %s paired with %s" % (pwutils.removeBaseExt(fileName), baseName))
+        unpaired = [pwutils.removeBaseExt(pdb.get().getFileName()) for pdb in self.pdbs]
+        unpaired = [baseName for baseName in unpaired if baseName not in pairs]
+        if unpaired:
+            summary.append("No previous Q-scores paired with: %s, all their atoms were scored" % ", ".join(unpaired))
+        return summary
+
+    def _summaryStages(self):
+        """ Time and resources used by every stage, as recorded in extra/stages.jsonl """
+        totals = stageTotals(readStageRecords(self._getStagesFile()))
+        if not totals:
+            return []
+        summary = ["*Time per stage:*"]
+        for stage, total in totals.items():
+            summary.append("      - %s: %.1f s wall, %.1f s CPU, peak RSS %.0f MB, %.1f MB read, %.1f MB written%s" %
+                           (stage, total['wall'], total['cpu'], total['peakRss'] / 2. ** 20,
+                            total['bytesRead'] / 2. ** 20, total['bytesWritten'] / 2. ** 20,
+                            " (%d runs)" % total['count'] if total['count'] > 1 else ""))
+        return summary
+
+    def _summaryFromFiles(self):
+        """ Mean scores read from the output files, for runs that did not store their statistics """
+        summary = ["*Mean Q-Scores:*"]
+        ASH = AtomicStructHandler()
+        for struct in self.scoredStructures:
+            fileName = struct.getFileName()
+            fields = ASH.readLowLevel(fileName)
+            attributes = fields["_scipion_attributes.name"]
+            values = fields["_scipion_attributes.value"]
+            mapq_scores = [float(value) for attribute, value in zip(attributes, values)
+                           if attribute == self._ATTRNAME]
+            mean_score = sum(mapq_scores) / len(mapq_scores)
+            summary.append("      - %s --> %.4f" % (pwutils.removeBaseExt(fileName), mean_score))
         return summary
@@ -0,0 +1,205 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+import os
+
+from pwem.objects import SetOfAtomStructs, AtomStruct
+
+from pyworkflow.protocol import STEPS_SERIAL, PointerParam, StringParam, BooleanParam, EnumParam
+
+from mapq.constants import PAIR_BY_ID, PAIR_ALL, PAIR_BY_ATTRIBUTE, PAIRING_CHOICES
+from mapq.engine import SIGMA, readPdbAtoms, residueScores, scoreSummary
+from mapq.engine.batch import scorePairs
+from mapq.engine.preprocess import prepareStructure
+from mapq.engine.volume import writeInterpolationGrid
+from .protocol_mapq import ProtMapQ, profiledStep
+
+
+class ProtMapQBatch(ProtMapQ):
+    """
+    Compute Q-Scores for many pairs of structures and maps in a single run, using the native engine.
+    Pairs are scored by a pool of workers that stays alive for the whole run and opens every map once.
+    """
+    _label = 'compute q-scores (batch)'
+    stepsExecutionMode = STEPS_SERIAL
+
+    # --------------------------- DEFINE param functions ------------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolumes', PointerParam, pointerClass="SetOfVolumes", important=True,
+                      label="Input maps")
+        form.addParam('inputStructures', PointerParam, pointerClass="SetOfAtomStructs", important=True,
+                      label="Input structures")
+        form.addParam('pairing', EnumParam, choices=PAIRING_CHOICES, default=PAIR_BY_ID,
+                      display=EnumParam.DISPLAY_HLIST, label="Pairing",
+                      help="By ID: every structure is scored against the map with its same ID. \n"
+                           "All vs all: every structure is scored against every map. \n"
+                           "Matching attribute: every structure is scored against the maps with the same value "
+                           "of the given attribute.")
+        form.addParam('pairAttribute', StringParam, default='_objLabel',
+                      condition="pairing==%d" % PAIR_BY_ATTRIBUTE, label="Attribute",
+                      help="Name of an attribute of both maps and structures, e.g. _objLabel or a class ID.")
+        self._defineScoreParams(form)
+        form.addParam('autoFit', BooleanParam, default=False, label="Auto fit map and structures?",
+                      help="If true, every structure is fitted into the map of each of its pairs by rigid body "
+                           "optimization of the average map value at the atom positions. Otherwise, maps and "
+                           "structures are assumed to be aligned.")
+        self._defineEngineParams(form)
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions ------------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep(self.convertInputStep)
+        self._insertFunctionStep(self.computeQScoresStep)
+        self._insertFunctionStep(self.createOutputStep)
+
+    # --------------------------- STEPS functions -------------------------------
+    @profiledStep('convert_input')
+    def convertInputStep(self):
+        for vol in self.inputVolumes.get():
+            self.convertMap(vol.getFileName(), vol.getShiftsFromOrigin(), vol.getSamplingRate(),
+                            self._getVolumeFile(vol.getObjId()))
+            if self.precomputeMap.get():
+                writeInterpolationGrid(self._getVolumeFile(vol.getObjId()))
+        for struct in self.inputStructures.get():
+            structFile = self._getStructureFile(struct.getObjId())
+            prepareStructure(self.convertStructure(struct.getFileName(), structFile), structFile)
+
+    @profiledStep('qscores')
+    def computeQScoresStep(self):
+        jobs = [{'mapFile': self._getVolumeFile(volId), 'pdbFile': self._getStructureFile(structId),
+                 'outFile': self._getQScoresFile(self.getPairName(structId, volId)),
+                 'sigma': self.sigma.get() or SIGMA, 'bFactor': self.bFactor.get(),
+                 'bFactorFile': self._getBFactorFile(self.getPairName(structId, volId)),
+                 'fit': self.autoFit.get(), 'precision': self.getPrecision()}
+                for structId, volId in self.getPairs()]
+        print("Scoring %d pairs of structures and maps..." % len(jobs))
+        results = scorePairs(jobs, self.numberOfThreads.get())
+        for (structId, volId), result in zip(self.getPairs(), results):
+            name = self.getPairName(structId, volId)
+            if 'error' in result:
+                print("Scoring of %s failed, it will not be part of the output: %s" % (name, result['error']))
+                with open(self._getFailedFile(name), 'w') as fh:
+                    fh.write(result['error'])
+            elif result['fitting'] is not None:
+                self.writeFittingStats(name, result['fitting'])
+
+    @profiledStep('output')
+    def createOutputStep(self):
+        structures = {struct.getObjId(): struct.clone() for struct in self.inputStructures.get()}
+        volumes = {vol.getObjId(): vol.clone() for vol in self.inputVolumes.get()}
+        outSet = SetOfAtomStructs.create(self._getPath())
+        stats, fitting = {}, {}
+        for structId, volId in self.getPairs():
+            name = self.getPairName(structId, volId)
+            if os.path.exists(self._getFailedFile(name)):
+                continue
+            atoms = readPdbAtoms(self._getQScoresFile(name))
+            residues = residueScores(atoms, atoms.bFactor, self.getExpectedQScores(name))
+            self.writeResidueTables(name, residues)
+            stats[name] = scoreSummary(atoms.bFactor, atoms.chain)
+            stats[name]['attributes'] = self.writeScoredStructure(structures[structId].getFileName(), atoms,
+                                                                  self._getOutputFile(name),
+                                                                  self.getResidueAttributes(residues),
+                                                                  self.getAtomIds(self._getStructureFile(structId)))
+            if os.path.exists(self._getFittingStatsFile(name)):
+                with open(self._getFittingStatsFile(name)) as fh:
+                    fitting[name] = json.load(fh)
+
+            outAS = AtomStruct()
+            outAS.setFileName(self._getOutputFile(name))
+            outAS.setVolume(volumes[volId])
+            outSet.append(outAS)
+
+        if not stats:
+            raise Exception("None of the pairs could be scored")
+        if fitting:
+            with open(self._getExtraPath('fitting.json'), 'w') as fh:
+                json.dump(fitting, fh, indent=2)
+        self.writeScoreStats(stats)
+        self._defineOutputs(scoredStructures=outSet)
+        self._defineSourceRelation(self.inputStructures, outSet)
+        self._defineSourceRelation(self.inputVolumes, outSet)
+
+    # --------------------------- UTILS functions -------------------------------
+    def getPairs(self):
+        """ (structure ID, map ID) of every pair to score, following the pairing rule """
+        structures = self.inputStructures.get()
+        volumes = self.inputVolumes.get()
+        pairing = self.pairing.get()
+        if pairing == PAIR_ALL:
+            volIds = [vol.getObjId() for vol in volumes]
+            return [(struct.getObjId(), volId) for struct in structures for volId in volIds]
+        if pairing == PAIR_BY_ID:
+            volIds = {vol.getObjId() for vol in volumes}
+            return [(struct.getObjId(), struct.getObjId()) for struct in structures if struct.getObjId() in volIds]
+
+        attrName = self.pairAttribute.get()
+        volIds = {}
+        for vol in volumes:
+            volIds.setdefault(str(getattr(vol, attrName, None)), []).append(vol.getObjId())
+        return [(struct.getObjId(), volId) for struct in structures
+                for volId in volIds.get(str(getattr(struct, attrName, None)), [])
+                if getattr(struct, attrName, None) is not None]
+
+    def getPairName(self, structId, volId):
+        return 'structure%d_map%d' % (structId, volId)
+
+    def getFailedNames(self):
+        return [self.getPairName(structId, volId) for structId, volId in self.getPairs()
+                if os.path.exists(self._getFailedFile(self.getPairName(structId, volId)))]
+
+    def _getVolumeFile(self, volId):
+        return os.path.abspath(self._getExtraPath('map%d.mrc' % volId))
+
+    def _getStructureFile(self, structId):
+        return os.path.abspath(self._getExtraPath('structure%d.pdb' % structId))
+
+    def isNativeEngine(self):
+        return True
+
+    def getLocalResolutionFile(self):
+        return None
+
+    def hasSelection(self):
+        return False
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self.pairing.get() == PAIR_BY_ATTRIBUTE:
+            attrName = self.pairAttribute.get()
+            if not attrName or not hasattr(self.inputVolumes.get().getFirstItem(), attrName) or \
+                    not hasattr(self.inputStructures.get().getFirstItem(), attrName):
+                errors.append("Maps and structures must both have the attribute %s" % attrName)
+                return errors
+        if not self.getPairs():
+            errors.append("No pair of structure and map matches the pairing rule.")
+        return errors
+
+    def _methods(self):
+        return ['QScore computation using MapQ for %d pairs of structures and maps' % len(self.getPairs())]
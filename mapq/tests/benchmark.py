@@ -0,0 +1,328 @@
+# **************************************************************************
+# *
+# * Authors:     David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] National Center for Biotechnology (CSIC)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Offline benchmark of the native Q-score pipeline on synthetic maps and models.
+
+Every run builds a structure of the requested size, random or made of helices, and a map of
+Gaussian blobs at its atoms, then times the stages run by ProtMapQ for each structure: the map
+conversion of convertMapStep, the PDB rewrite of convertStructureStep, the scoring and the output
+of createStructureOutputStep. Stages are timed without memory tracing, which slows Python code
+down, and run again to measure their peak memory unless --no-memory is given: the memory traced
+by tracemalloc in this process and, separately, the peak RSS of the worker processes they start,
+which tracemalloc does not see.
+Results can be stored as a baseline and later runs compared with it:
+
+    python -m mapq.tests.benchmark --sizes 1000 10000 --save baseline.json
+    python -m mapq.tests.benchmark --sizes 1000 10000 --baseline baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import mrcfile
+import numpy as np
+
+from mapq.constants import MAPQ_VERSION, NATIVE_ENGINE
+from mapq.engine import scoreStructure, readPdbAtoms, residueScores, chainScores
+from mapq.engine.preprocess import prepareStructure
+from mapq.engine.structure import appendScipionAttributes, atomSpecs, residueSpecs, writePdbAsCif
+from mapq.protocols import ProtMapQ
+
+
+LAYOUTS = ('random', 'helical')
+SIZES = (1000, 10000)
+STAGES = ('map', 'structure', 'scoring', 'output')
+# Protein like density of atoms (atoms per cubic Angstrom)
+ATOM_DENSITY = 1. / 11.
+# Runs slower than the baseline by more than this fraction are reported as regressions
+TOLERANCE = 0.2
+# Seconds between samples of the memory of the worker processes
+SAMPLING_INTERVAL = 0.05
+BACKBONE = ('N', 'CA', 'C', 'O')
+
+
+def syntheticAtoms(numAtoms, layout='random', seed=0):
+    """
+    Coordinates (N, 3) of a synthetic structure centered at the origin. Random structures place
+    atoms at random offsets of a cubic lattice at protein density; helical ones pack ideal helices
+    (1.5 Angstroms rise, 100 degrees twist) side by side.
+    """
+    rng = np.random.default_rng(seed)
+    if layout == 'random':
+        # Jittered lattice, as uniformly random atoms would clash far more than in real structures
+        spacing = ATOM_DENSITY ** (-1. / 3.)
+        side = int(np.ceil(numAtoms ** (1. / 3.)))
+        lattice = np.stack(np.meshgrid(*[np.arange(side)] * 3, indexing='ij'), -1).reshape(-1, 3)[:numAtoms]
+        coords = lattice * spacing + rng.uniform(-0.3, 0.3, (numAtoms, 3))
+    elif layout == 'helical':
+        helixLength = 100
+        numHelices = int(np.ceil(numAtoms / helixLength))
+        perRow = int(np.ceil(np.sqrt(numHelices)))
+        step = np.arange(helixLength)
+        helix = np.stack([2.3 * np.cos(np.radians(100. * step)), 2.3 * np.sin(np.radians(100. * step)),
+                          1.5 * step], axis=1)
+        axes = np.stack([np.arange(numHelices) % perRow, np.arange(numHelices) // perRow,
+                         np.zeros(numHelices)], axis=1) * 10.
+        coords = (axes[:, None, :] + helix[None, :, :]).reshape(-1, 3)[:numAtoms]
+        coords += rng.normal(0., 0.1, coords.shape)
+    else:
+        raise ValueError("Unknown layout %s, use one of %s" % (layout, ", ".join(LAYOUTS)))
+    return coords - coords.mean(axis=0)
+
+
+def writeSyntheticPdb(coords, fileName, chainSize=5000):
+    """ Write the atoms as backbone atoms of alanines, 4 per residue, in chains of chainSize atoms """
+    with open(fileName, 'w') as fh:
+        for i, (x, y, z) in enumerate(coords):
+            chain = chr(65 + (i // chainSize) % 26)
+            name = BACKBONE[i % 4]
+            fh.write("ATOM  %5d  %-3s ALA %s%4d    %8.3f%8.3f%8.3f  1.00  0.00           %s\n"
+                     % ((i + 1) % 100000, name, chain, (i % chainSize) // 4 + 1, x, y, z, name[0]))
+        fh.write("END\n")
+
+
+def writeSyntheticMap(coords, fileName, voxelSize=1., sigma=0.6, noise=0.02, seed=0, padding=8.):
+    """ Write a map of Gaussian blobs of width sigma at the atoms plus Gaussian noise. Returns its origin. """
+    rng = np.random.default_rng(seed)
+    # Whole voxel origin, as kept by Ccp4Header.fixFile
+    lower = np.floor((coords.min(axis=0) - padding) / voxelSize) * voxelSize
+    shape = np.ceil((coords.max(axis=0) + padding - lower) / voxelSize).astype(int) + 1
+    data = rng.normal(0., noise, shape[::-1]).astype(np.float32)
+    # Splat every atom over the voxels within 3 sigma, one stencil offset at a time
+    center = np.round((coords - lower) / voxelSize).astype(int)
+    radius = int(np.ceil(3. * sigma / voxelSize))
+    for offset in np.stack(np.meshgrid(*[np.arange(-radius, radius + 1)] * 3, indexing='ij'), -1).reshape(-1, 3):
+        voxel = center + offset
+        d2 = np.sum((lower + voxel * voxelSize - coords) ** 2, axis=1)
+        np.add.at(data, (voxel[:, 2], voxel[:, 1], voxel[:, 0]), np.exp(-0.5 * d2 / sigma ** 2))
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data(data)
+        mrc.voxel_size = voxelSize
+        mrc.header.origin = tuple(lower)
+    return lower
+
+
+def _timed(function, *args, **kwargs):
+    """ Run function returning its wall time in seconds """
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _measured(function, *args, **kwargs):
+    """
+    Run function returning its peak memory in bytes as traced by tracemalloc in this process, and the
+    sum of the peak RSS of the child processes alive meanwhile, e.g. the scoring workers (None when
+    there were none or /proc is not available).
+    """
+    sampler = _WorkerSampler()
+    sampler.start()
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1], sampler.stop()
+    finally:
+        tracemalloc.stop()
+        sampler.stop()
+
+
+class _WorkerSampler(threading.Thread):
+    """ Samples the high-water RSS (VmHWM) of the child processes of this one until stopped """
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.peaks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            for pid in _childPids():
+                self.peaks[pid] = max(self.peaks.get(pid, 0), _peakRss(pid))
+            if self.stopped.wait(SAMPLING_INTERVAL):
+                return
+
+    def stop(self):
+        """ Stop sampling and return the summed peak RSS of the sampled processes in bytes, or None """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        return sum(self.peaks.values()) or None
+
+
+def _childPids():
+    pids = []
+    if not os.path.isdir('/proc'):
+        return pids
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as fh:
+                    # The parent pid follows the state, after the command name in parentheses
+                    if int(fh.read().rpartition(')')[2].split()[1]) == os.getpid():
+                        pids.append(int(entry))
+            except (OSError, ValueError, IndexError):
+                pass
+    return pids
+
+
+def _peakRss(pid):
+    try:
+        with open('/proc/%d/status' % pid) as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _convertMap(volFile, origin, sampling, outFile):
+    """ What convertMapStep does with the map for the native engine """
+    prot = ProtMapQ()
+    prot.engine.set(NATIVE_ENGINE)
+    prot.convertMap(volFile, origin, sampling, outFile)
+
+
+def _writeOutput(pdbFile, qScoresFile, cifFile):
+    """ What createStructureOutputStep does for a PDB input: mmCIF with atom and residue attributes """
+    atoms = readPdbAtoms(qScoresFile)
+    residues = residueScores(atoms, atoms.bFactor)
+    chainScores(residues)
+    writePdbAsCif(pdbFile, cifFile, 10000)
+    appendScipionAttributes(cifFile, [('MapQ_Score', 'atoms', atomSpecs(atoms), atoms.bFactor),
+                                      ('MapQ_Residue_Score', 'residues', residueSpecs(residues), residues['q'])])
+
+
+def benchmarkStructure(numAtoms, layout, workDir, numberOfProcesses=1, seed=0, memory=True):
+    """
+    Time every stage for a synthetic structure, measuring its traced peak memory with memory.
+    Returns {stage: {seconds, atomsPerSecond, peakMemory, workerPeakRss}}, see _measured, the memory
+    being None without memory.
+    """
+    coords = syntheticAtoms(numAtoms, layout, seed)
+    inputPdb = os.path.join(workDir, 'input.pdb')
+    inputMap = os.path.join(workDir, 'input.mrc')
+    writeSyntheticPdb(coords, inputPdb)
+    origin = writeSyntheticMap(coords, inputMap, seed=seed)
+
+    mapFile = os.path.join(workDir, 'map.mrc')
+    structFile = os.path.join(workDir, 'structure.pdb')
+    qScoresFile = os.path.join(workDir, 'structure__Q__map.pdb')
+    stages = [('map', _convertMap, (inputMap, tuple(origin), 1., mapFile), {}),
+              ('structure', prepareStructure, (inputPdb, structFile), {}),
+              ('scoring', scoreStructure, (mapFile, structFile, qScoresFile),
+               {'numberOfProcesses': numberOfProcesses}),
+              ('output', _writeOutput, (inputPdb, qScoresFile, os.path.join(workDir, 'structure.cif')), {})]
+    results = {}
+    for stage, function, args, kwargs in stages:
+        seconds = _timed(function, *args, **kwargs)
+        # Stages only write their outputs, so running them again is the same work
+        peak, workerPeak = _measured(function, *args, **kwargs) if memory else (None, None)
+        results[stage] = {'seconds': seconds, 'atomsPerSecond': numAtoms / seconds if seconds else None,
+                          'peakMemory': peak, 'workerPeakRss': workerPeak}
+    results['meanQ'] = float(readPdbAtoms(qScoresFile).bFactor.mean())
+    return results
+
+
+def runBenchmark(sizes=SIZES, layouts=LAYOUTS, numberOfProcesses=1, seed=0, memory=True):
+    """ Benchmark every size and layout in a temporary directory. Returns a JSON serializable report. """
+    report = {'mapqVersion': MAPQ_VERSION, 'python': platform.python_version(), 'machine': platform.machine(),
+              'numberOfProcesses': numberOfProcesses, 'runs': {}}
+    for layout in layouts:
+        for numAtoms in sizes:
+            workDir = tempfile.mkdtemp(prefix='mapq_benchmark_')
+            try:
+                report['runs']['%s_%d' % (layout, numAtoms)] = benchmarkStructure(numAtoms, layout, workDir,
+                                                                                  numberOfProcesses, seed, memory)
+            finally:
+                shutil.rmtree(workDir, ignore_errors=True)
+    return report
+
+
+def compareReports(report, baseline, tolerance=TOLERANCE):
+    """ Stages of the runs in both reports that got slower than the baseline by more than tolerance """
+    regressions = []
+    for run, stages in report['runs'].items():
+        for stage in STAGES:
+            previous = baseline['runs'].get(run, {}).get(stage)
+            if previous and stages[stage]['seconds'] > previous['seconds'] * (1. + tolerance):
+                regressions.append((run, stage, previous['seconds'], stages[stage]['seconds']))
+    return regressions
+
+
+def printReport(report):
+    print("%-16s %-10s %10s %12s %17s %17s" % ('run', 'stage', 'seconds', 'atoms/s', 'peak MB (traced)',
+                                                'worker MB (RSS)'))
+    for run, stages in report['runs'].items():
+        for stage in STAGES:
+            result = stages[stage]
+            print("%-16s %-10s %10.3f %12.0f %17s %17s" % (run, stage, result['seconds'],
+                                                           result['atomsPerSecond'] or 0.,
+                                                           _megabytes(result.get('peakMemory')),
+                                                           _megabytes(result.get('workerPeakRss'))))
+
+
+def _megabytes(size):
+    return '-' if size is None else '%.1f' % (size / 2. ** 20)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the native MapQ pipeline on synthetic data")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="numbers of atoms")
+    parser.add_argument('--layouts', nargs='+', choices=LAYOUTS, default=LAYOUTS)
+    parser.add_argument('-j', '--processes', type=int, default=1, help="processes used for scoring")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="skip the second run of every stage measuring its traced peak memory")
+    parser.add_argument('--save', help="store the report as a JSON baseline")
+    parser.add_argument('--baseline', help="compare with a JSON baseline, failing on regressions")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="allowed slowdown over the baseline, as a fraction")
+    args = parser.parse_args(argv)
+
+    report = runBenchmark(args.sizes, args.layouts, args.processes, args.seed, args.memory)
+    printReport(report)
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compareReports(report, json.load(fh), args.tolerance)
+        for run, stage, before, after in regressions:
+            print("Regression in %s %s: %.3f s -> %.3f s" % (run, stage, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
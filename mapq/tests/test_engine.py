@@ -0,0 +1,760 @@
+# **************************************************************************
+# *
+# * Authors:    David Herreros Calero (dherreros@cnb.csic.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Tests of the native Q-score engine on small synthetic maps and models, needing neither the Scipion
+test data nor Chimera.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import mrcfile
+import numpy as np
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+from scipy import ndimage
+
+from pwem.convert import toCIF
+from pwem.convert.atom_struct import AtomicStructHandler
+from pwem.objects import AtomStruct, SetOfAtomStructs, SetOfVolumes, Transform, Volume
+from pyworkflow.object import Pointer
+
+import mapq
+from mapq.constants import CHIMERA_ENGINE, NATIVE_ENGINE, PAIR_ALL, PAIR_BY_ATTRIBUTE, PAIR_BY_ID
+from mapq.engine import computeQScores, readMap, readPdbAtoms, scoreStructure, streamScoreStructure
+from mapq.engine.cache import ResultCache, atomsDigest, mapDigest
+from mapq.engine.fitting import MAX_STEPS, fitAtoms, fitStatistics, rigidTransform, rotate
+from mapq.engine.incremental import reusableScores
+from mapq.engine.pipeline import atomResolution, localSigmaScale
+from mapq.engine.preprocess import prepareStructure
+from mapq.engine.profiling import StageProfiler, readStageRecords
+from mapq.engine.qscore import NUM_POINTS, NUM_TRIES, shellRadii, sphereDirections
+from mapq.engine.selection import parseResidueRanges, selectAtoms
+from mapq.engine.server import KEY_SUFFIX, MapCache, ScoringServer, isPrivate, scoreOnServer, serverRunning
+from mapq.engine.structure import (appendScipionAttributes, atomSpecs, iterPdbAtoms, residueSpecs,
+                                   writePdbAsCif, writePdbAtoms)
+from mapq.engine.summary import chainScores, concatenateTables, residueScores
+from mapq.engine.volume import INTERPOLATION_SUFFIX, writeInterpolationGrid
+from mapq.protocols import ProtMapQ, ProtMapQBatch
+from mapq.tests.benchmark import syntheticAtoms, writeSyntheticMap, writeSyntheticPdb
+
+
+def bruteForceQScore(grid, coords, index, sigma, mapMean, mapStd):
+    """ Q-score of one atom following mapq_cmd.py step by step, as a reference for the engine """
+    u, v = [], []
+    for radius in shellRadii():
+        for i in range(NUM_TRIES):
+            points = coords[index] + radius * sphereDirections(NUM_POINTS + 2 * i)
+            distances = np.linalg.norm(points[:, None, :] - coords[None, :, :], axis=2).min(axis=1)
+            accepted = points[distances >= 0.9 * radius]
+            if len(accepted) >= NUM_POINTS or i == NUM_TRIES - 1:
+                break
+        accepted = accepted[:NUM_POINTS]
+        indices = ((accepted - grid.origin) / grid.voxelSize)[:, ::-1].T
+        u.extend(ndimage.map_coordinates(grid.data.astype(np.float64), indices, order=1))
+        minD, maxD = mapMean - mapStd, mapMean + 10. * mapStd
+        v.extend([(maxD - minD) * np.exp(-0.5 * (radius / sigma) ** 2) + minD] * len(accepted))
+    du, dv = np.array(u) - np.mean(u), np.array(v) - np.mean(v)
+    return np.sum(du * dv) / np.sqrt(np.sum(du * du) * np.sum(dv * dv))
+
+
+def newProtocol(workDir, protocolClass=ProtMapQ, **params):
+    """ Protocol outside of any project, working in workDir, whose steps can be called directly """
+    prot = protocolClass()
+    prot.workingDir.set(workDir)
+    for name, value in params.items():
+        getattr(prot, name).set(value)
+    os.makedirs(prot._getExtraPath(), exist_ok=True)
+    os.makedirs(prot._getTmpPath(), exist_ok=True)
+    return prot
+
+
+class EngineTestCase(unittest.TestCase):
+    """ Synthetic helical structure of numAtoms atoms, in chains of chainSize atoms, and its map """
+    numAtoms = 1200
+    chainSize = 600
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp(prefix='mapq-test-')
+        cls.coords = syntheticAtoms(cls.numAtoms, 'helical', seed=1)
+        cls.pdbFile = cls.getPath('structure.pdb')
+        cls.mapFile = cls.getPath('map.mrc')
+        writeSyntheticPdb(cls.coords, cls.pdbFile, chainSize=cls.chainSize)
+        writeSyntheticMap(cls.coords, cls.mapFile)
+        cls.atoms = readPdbAtoms(cls.pdbFile)
+        cls.scores = scoreStructure(cls.mapFile, cls.pdbFile, cls.getPath('full__Q__map.pdb'), cropMap=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    @classmethod
+    def getPath(cls, fileName):
+        return os.path.join(cls.tmpDir, fileName)
+
+
+class TestQScores(EngineTestCase):
+
+    def test_brute_force(self):
+        grid = readMap(self.mapFile)
+        indices = np.arange(0, self.numAtoms, 40)
+        reference = [bruteForceQScore(grid, self.coords, i, 0.6, *grid.statistics()) for i in indices]
+        # The map statistics used by mapq for the reference Gaussian do not change the scores
+        scores = computeQScores(grid, self.coords, indices, precision=np.float64)
+        np.testing.assert_allclose(scores, reference, atol=1e-6)
+        scores = computeQScores(grid, self.coords, indices, mapStats=(123., 0.5), precision=np.float64)
+        np.testing.assert_allclose(scores, reference, atol=1e-6)
+        scores = computeQScores(grid, self.coords, indices, precision=np.float32)
+        np.testing.assert_allclose(scores, reference, atol=1e-4)
+
+    def test_execution_modes(self):
+        """ Parallel, cropped and streaming runs give the scores of a serial run over the whole map """
+        cropped = scoreStructure(self.mapFile, self.pdbFile, self.getPath('crop.pdb'), cropMap=True)
+        np.testing.assert_allclose(cropped, self.scores, atol=1e-5)
+        parallel = scoreStructure(self.mapFile, self.pdbFile, self.getPath('parallel.pdb'), numberOfProcesses=2)
+        np.testing.assert_allclose(parallel, cropped, atol=1e-6)
+        for processes in (1, 2):
+            streamed = streamScoreStructure(self.mapFile, self.pdbFile, self.getPath('stream.pdb'), 250,
+                                            numberOfProcesses=processes)
+            np.testing.assert_allclose(streamed, self.scores, atol=1e-5)
+            np.testing.assert_allclose(readPdbAtoms(self.getPath('stream.pdb')).bFactor, streamed, atol=0.005)
+        # Streaming runs keep the precision asked for up to the returned scores
+        full = scoreStructure(self.mapFile, self.pdbFile, self.getPath('full64.pdb'), precision=np.float64)
+        streamed = streamScoreStructure(self.mapFile, self.pdbFile, self.getPath('stream.pdb'), 250,
+                                        precision=np.float64)
+        self.assertEqual(streamed.dtype, np.float64)
+        np.testing.assert_allclose(streamed, full, atol=1e-12)
+
+    def test_sigma_sweep(self):
+        sweep = [(0.4, self.getPath('s04.pdb')), (0.8, self.getPath('s08.pdb'))]
+        scores = scoreStructure(self.mapFile, self.pdbFile, self.getPath('sweep.pdb'), sweep=sweep)
+        np.testing.assert_allclose(scores, self.scores, atol=1e-5)
+        for width, fileName in sweep:
+            single = scoreStructure(self.mapFile, self.pdbFile, self.getPath('single.pdb'), sigma=width)
+            np.testing.assert_allclose(readPdbAtoms(fileName).bFactor, single, atol=0.005)
+
+    def test_selection(self):
+        self.assertEqual(parseResidueRanges('A:10-25, B:40 -3--1'), [('A', 10, 25), ('B', 40, 40), (None, -3, -1)])
+        self.assertRaises(ValueError, parseResidueRanges, 'A:x')
+
+        selected = selectAtoms(self.atoms, chains=['B'], residueRanges=parseResidueRanges('10-20'))
+        expected = (self.atoms.chain == 'B') & (self.atoms.resSeq >= 10) & (self.atoms.resSeq <= 20)
+        np.testing.assert_array_equal(selected, expected)
+        widened = selectAtoms(self.atoms, chains=['B'], residueRanges=parseResidueRanges('10-20'), radius=5.)
+        self.assertTrue(np.all(widened[selected]) and np.count_nonzero(widened) > np.count_nonzero(selected))
+        # Residues are added as a whole
+        residues = np.char.add(self.atoms.chain, self.atoms.resSeq.astype(str))
+        for residue in np.unique(residues[widened]):
+            self.assertTrue(np.all(widened[residues == residue]))
+
+        scores = scoreStructure(self.mapFile, self.pdbFile, self.getPath('selection.pdb'), selection=widened)
+        np.testing.assert_allclose(scores[widened], self.scores[widened], atol=1e-5)
+        self.assertTrue(np.all(scores[~widened] == 0.))
+
+    def test_incremental(self):
+        moved = self.atoms.coords.copy()
+        moved[100:104] += 1.
+        movedFile = self.getPath('moved.pdb')
+        writePdbAtoms(self.atoms, movedFile, coords=moved)
+        previousFile = self.getPath('full__Q__map.pdb')
+        atoms, previous = readPdbAtoms(movedFile), readPdbAtoms(previousFile)
+
+        scores, rescore = reusableScores(atoms, previous)
+        # Both the old and the new positions of the moved atoms change the neighbourhood
+        changes = np.concatenate([moved[100:104], self.atoms.coords[100:104]])
+        distances = np.linalg.norm(moved[:, None, :] - changes[None, :, :], axis=2).min(axis=1)
+        self.assertTrue(np.all(rescore[100:104]))
+        self.assertTrue(np.all(rescore[distances < 4.]))
+        self.assertFalse(np.any(rescore[distances > 4.5]))
+        np.testing.assert_array_equal(scores[~rescore], previous.bFactor[~rescore])
+
+        full = scoreStructure(self.mapFile, movedFile, self.getPath('moved_full.pdb'))
+        incremental = scoreStructure(self.mapFile, movedFile, self.getPath('moved_inc.pdb'), previous=previousFile)
+        # Reused scores come from the 2 decimals of the B-factor column
+        np.testing.assert_allclose(incremental, full, atol=0.005)
+
+        # Atoms left out of the previous run are scored, not given its placeholder
+        unscored = np.arange(600, self.numAtoms)
+        _, rescore = reusableScores(atoms, previous, scored=np.arange(600))
+        self.assertTrue(np.all(rescore[unscored]))
+        incremental = scoreStructure(self.mapFile, movedFile, self.getPath('moved_inc.pdb'),
+                                     previous=previousFile, previousScored=np.arange(600))
+        np.testing.assert_allclose(incremental, full, atol=0.005)
+
+    def test_previous_pairing(self):
+        previous = SetOfAtomStructs.create(self.tmpDir)
+        for name in ('model', 'refined_1'):
+            shutil.copy(self.getPath('full__Q__map.pdb'), self.getPath(name + '__Q__map.pdb'))
+            previous.append(AtomStruct(filename=self.getPath(name + '.cif')))
+        prot = newProtocol(self.getPath('pairing'), previousScores=previous)
+        for name in ('refined_2', 'model', 'other'):
+            prot.pdbs.append(Pointer(AtomStruct(filename=name + '.pdb')))
+
+        # Same names are paired first, whatever their position, and the rest in input order
+        self.assertEqual(prot.getPreviousScoresFiles(), {'model': self.getPath('model__Q__map.pdb'),
+                                                         'refined_2': self.getPath('refined_1__Q__map.pdb')})
+        self.assertIn("No previous Q-scores paired with: other, all their atoms were scored",
+                      prot._summaryPrevious())
+
+
+class TestLocalResolution(EngineTestCase):
+    numAtoms = 600
+    chainSize = 300
+
+    def writeResolutionMap(self, fileName, values):
+        """ Local resolution map on the grid of the map, holding values[0] below the center of the atoms
+        along x and values[1] above """
+        grid = readMap(self.mapFile)
+        centers = grid.origin[0] + np.arange(grid.data.shape[2]) * grid.voxelSize[0]
+        data = np.where(centers < self.coords[:, 0].mean(), *values).astype(np.float32)
+        with mrcfile.new(fileName, overwrite=True) as mrc:
+            mrc.set_data(np.ascontiguousarray(np.broadcast_to(data, grid.data.shape)))
+            mrc.voxel_size = tuple(grid.voxelSize)
+            mrc.header.origin = tuple(grid.origin)
+
+    def test_atom_resolution(self):
+        """ Atoms get the resolution around them, NaN where the map holds none """
+        resMap = self.getPath('resolution.mrc')
+        self.writeResolutionMap(resMap, (3., 0.))
+        resolutionFile = self.getPath('resolution.pdb')
+        resolutions = atomResolution(resMap, self.atoms, resolutionFile)
+        # Atoms closer than a voxel to the boundary get interpolated values
+        left = self.coords[:, 0] < self.coords[:, 0].mean() - 1.
+        right = self.coords[:, 0] > self.coords[:, 0].mean() + 1.
+        np.testing.assert_allclose(resolutions[left], 3.)
+        self.assertTrue(np.all(np.isnan(resolutions[right])))
+        np.testing.assert_allclose(readPdbAtoms(resolutionFile).bFactor, np.nan_to_num(resolutions), atol=0.005)
+
+        # Sigma follows the resolution relative to the given one, or to the median at the atoms
+        np.testing.assert_allclose(localSigmaScale(resolutions, 2.)[left], 1.5)
+        np.testing.assert_allclose(localSigmaScale(resolutions, 2.)[right], 1.)
+        np.testing.assert_allclose(localSigmaScale(resolutions)[left], 1.)
+        np.testing.assert_array_equal(localSigmaScale(np.full(3, np.nan)), 1.)
+
+    def test_local_sigma(self):
+        """ Atoms are scored with sigma scaled by their local resolution over the map resolution """
+        resMap = self.getPath('resolution.mrc')
+        self.writeResolutionMap(resMap, (3., 3.))
+        scores = scoreStructure(self.mapFile, self.pdbFile, self.getPath('local.pdb'), localResolution=resMap,
+                                localSigma=True, resolution=3.)
+        np.testing.assert_allclose(scores, self.scores, atol=1e-5)
+        scores = scoreStructure(self.mapFile, self.pdbFile, self.getPath('local.pdb'), localResolution=resMap,
+                                localSigma=True, resolution=2.)
+        wide = scoreStructure(self.mapFile, self.pdbFile, self.getPath('wide.pdb'), sigma=0.9)
+        np.testing.assert_allclose(scores, wide, atol=1e-5)
+        # Without localSigma, the local resolution is only recorded
+        resolutionFile = self.getPath('resolution.pdb')
+        scores = scoreStructure(self.mapFile, self.pdbFile, self.getPath('local.pdb'), localResolution=resMap,
+                                resolutionFile=resolutionFile)
+        np.testing.assert_allclose(scores, self.scores, atol=1e-5)
+        np.testing.assert_allclose(readPdbAtoms(resolutionFile).bFactor, 3.)
+
+
+class TestSymmetry(unittest.TestCase):
+
+    def test_symmetry(self):
+        """ C2 dimer: scores transferred from the asymmetric unit match those of every atom """
+        tmpDir = tempfile.mkdtemp(prefix='mapq-test-')
+        self.addCleanup(shutil.rmtree, tmpDir)
+        monomer = syntheticAtoms(400, 'helical', seed=2) + [12., 0., 0.]
+        rotation = np.diag([-1., -1., 1., 1.])
+        coords = np.concatenate([monomer, monomer * [-1., -1., 1.]])
+        pdbFile, mapFile = os.path.join(tmpDir, 'dimer.pdb'), os.path.join(tmpDir, 'dimer.mrc')
+        writeSyntheticPdb(coords, pdbFile, chainSize=400)
+        writeSyntheticMap(coords, mapFile, noise=0.)
+
+        full = scoreStructure(mapFile, pdbFile, os.path.join(tmpDir, 'full.pdb'))
+        reportFile = os.path.join(tmpDir, 'symmetry.json')
+        scores = scoreStructure(mapFile, pdbFile, os.path.join(tmpDir, 'sym.pdb'), symmetry=[np.eye(4), rotation],
+                                symmetryReport=reportFile)
+        np.testing.assert_allclose(scores, full, atol=0.01)
+        self.assertTrue(os.path.exists(reportFile))
+        self.assertRaises(ValueError, scoreStructure, mapFile, pdbFile, os.path.join(tmpDir, 'sel.pdb'),
+                          symmetry=[np.eye(4), rotation], selection=np.ones(len(coords), dtype=bool))
+
+
+class TestResultCache(EngineTestCase):
+    numAtoms = 100
+
+    def test_cache(self):
+        cache = ResultCache(self.getPath('cache'), maxSize=1 << 20)
+        mapHash, atomsHash = mapDigest(self.mapFile), atomsDigest(self.atoms)
+        key = ResultCache.key(mapHash, atomsHash, sigma=0.6)
+        self.assertEqual(key, ResultCache.key(mapHash, atomsHash, sigma=0.6))
+        self.assertNotEqual(key, ResultCache.key(mapHash, atomsHash, sigma=0.5))
+        self.assertIsNone(cache.get(key))
+        cache.put(key, self.scores)
+        np.testing.assert_array_equal(cache.get(key), self.scores)
+
+        # Moving an atom or changing the map misses
+        moved = readPdbAtoms(self.pdbFile)
+        moved.coords[0] += 0.1
+        self.assertNotEqual(atomsDigest(moved), atomsHash)
+        otherMap = self.getPath('other.mrc')
+        writeSyntheticMap(self.coords, otherMap, seed=1)
+        self.assertNotEqual(mapDigest(otherMap), mapHash)
+
+        # Least recently used entries are evicted
+        small = ResultCache(self.getPath('small'), maxSize=3 * self.scores.nbytes)
+        for age, sigma in enumerate((0.4, 0.5, 0.6, 0.7)):
+            key = ResultCache.key(mapHash, atomsHash, sigma=sigma)
+            small.put(key, self.scores)
+            # Distinct access times, whatever the resolution of the file system
+            os.utime(small._path(key), (age, age))
+        self.assertIsNone(small.get(ResultCache.key(mapHash, atomsHash, sigma=0.4)))
+        self.assertIsNotNone(small.get(ResultCache.key(mapHash, atomsHash, sigma=0.7)))
+
+
+class TestInterpolationGrid(EngineTestCase):
+    numAtoms = 600
+    chainSize = 300
+
+    def test_interpolation_grid(self):
+        """ Integer maps with permuted axes are read from the precomputed grid, with the same scores """
+        grid = readMap(self.mapFile)
+        data = np.round(grid.data * 1000.).astype(np.int16)
+        mapFile = self.getPath('permuted.mrc')
+        with mrcfile.new(mapFile, overwrite=True) as mrc:
+            # Stored with z as columns and x as sections
+            mrc.set_data(np.ascontiguousarray(data.transpose(2, 1, 0)))
+            mrc.header.mapc, mrc.header.mapr, mrc.header.maps = 3, 2, 1
+            mrc.voxel_size = tuple(grid.voxelSize)
+            mrc.header.origin = tuple(grid.origin)
+        reference = scoreStructure(mapFile, self.pdbFile, self.getPath('permuted__Q__map.pdb'))
+        for mmap in (False, True):
+            np.testing.assert_array_equal(readMap(mapFile, mmap=mmap).data, data)
+
+        interpolationFile = writeInterpolationGrid(mapFile)
+        self.assertEqual(interpolationFile, mapFile + INTERPOLATION_SUFFIX)
+        for mmap in (False, True):
+            precomputed = readMap(mapFile, mmap=mmap)
+            self.assertEqual(precomputed.data.dtype, np.float32)
+            self.assertTrue(precomputed.data.flags['C_CONTIGUOUS'])
+            np.testing.assert_array_equal(precomputed.data, data)
+            np.testing.assert_allclose(precomputed.origin, grid.origin)
+        scores = scoreStructure(mapFile, self.pdbFile, self.getPath('precomputed__Q__map.pdb'), numberOfProcesses=2)
+        np.testing.assert_allclose(scores, reference, atol=1e-6)
+
+        # Grids older than their map are not used
+        os.utime(interpolationFile, (0, 0))
+        self.assertEqual(readMap(mapFile, mmap=True).data.dtype, np.int16)
+
+
+class TestConvertMap(unittest.TestCase):
+
+    def test_convert_map(self):
+        """ Maps placed by a header link with a placement file read like those rewritten by fixFile """
+        tmpDir = tempfile.mkdtemp(prefix='mapq-test-')
+        self.addCleanup(shutil.rmtree, tmpDir)
+        volFile = os.path.join(tmpDir, 'input.mrc')
+        with mrcfile.new(volFile) as mrc:
+            mrc.set_data(np.random.default_rng(0).normal(size=(20, 22, 24)).astype(np.float32))
+            mrc.voxel_size = 1.2
+        origin, sampling = (-5.1, 3.6, 7.2), 1.2
+
+        grids = {}
+        for engine in (NATIVE_ENGINE, CHIMERA_ENGINE):
+            outFile = os.path.join(tmpDir, 'map%d.mrc' % engine)
+            prot = ProtMapQ()
+            prot.engine.set(engine)
+            prot.convertMap(volFile, origin, sampling, outFile)
+            grids[engine] = readMap(outFile)
+        self.assertTrue(os.path.islink(os.path.join(tmpDir, 'map%d.mrc' % NATIVE_ENGINE)))
+        self.assertFalse(os.path.islink(os.path.join(tmpDir, 'map%d.mrc' % CHIMERA_ENGINE)))
+        linked, fixed = grids[NATIVE_ENGINE], grids[CHIMERA_ENGINE]
+        np.testing.assert_allclose(linked.voxelSize, fixed.voxelSize, atol=1e-6)
+        np.testing.assert_allclose(linked.origin, fixed.origin, atol=1e-5)
+        np.testing.assert_array_equal(linked.data, fixed.data)
+
+        # A map already placed is linked as is
+        outFile = os.path.join(tmpDir, 'placed.mrc')
+        ProtMapQ().convertMap(os.path.join(tmpDir, 'map%d.mrc' % CHIMERA_ENGINE), origin, sampling, outFile)
+        self.assertTrue(os.path.islink(outFile))
+        self.assertFalse(os.path.exists(outFile + '.placement.json'))
+
+
+class TestFitting(EngineTestCase):
+    numAtoms = 600
+    chainSize = 300
+
+    def test_fit_atoms(self):
+        """ Atoms moved by about 1 Å and rotated by 3 degrees are fitted back into the map """
+        grid = readMap(self.mapFile)
+        center = self.coords.mean(axis=0)
+        shift = np.array([0.8, -0.5, 0.6])
+        moved = rotate(self.coords, center, np.array([0., 0., 1.]), np.radians(3.)) + shift
+        rotation, translation = rigidTransform(self.coords, moved)
+        np.testing.assert_allclose(self.coords @ rotation.T + translation, moved, atol=1e-8)
+
+        fitted, steps = fitAtoms(grid, moved)
+        self.assertLess(steps, MAX_STEPS)
+        self.assertLess(np.sqrt(np.mean(np.sum((fitted - self.coords) ** 2, axis=1))), 0.2)
+        stats = fitStatistics(grid, moved, fitted)
+        self.assertAlmostEqual(stats['angle'], 3., delta=0.2)
+        self.assertAlmostEqual(stats['shift'], np.linalg.norm(shift), delta=0.2)
+        self.assertEqual(stats['atomsOutsideMap'], 0)
+        self.assertGreater(stats['averageMapValue'], np.mean(grid.interpolate(moved)))
+
+    def test_prepare_structure(self):
+        """ Structures are centered at the new origin and then fitted, in one pass or in batches """
+        newOrigin = self.coords.mean(axis=0) + [0.8, -0.5, 0.6]
+        for batchSize in (None, 100):
+            outFile = self.getPath('fitted.pdb')
+            stats = prepareStructure(self.pdbFile, outFile, self.mapFile, newOrigin, batchSize)
+            self.assertNotIn('error', stats)
+            self.assertAlmostEqual(stats['shift'], 1.1, delta=0.2)
+            fitted = readPdbAtoms(outFile)
+            self.assertEqual(len(fitted), self.numAtoms)
+            self.assertLess(np.sqrt(np.mean(np.sum((fitted.coords - self.coords) ** 2, axis=1))), 0.2)
+        # A map that cannot be read leaves the centered structure and the error
+        stats = prepareStructure(self.pdbFile, outFile, self.getPath('missing.mrc'), newOrigin)
+        self.assertIn('error', stats)
+        np.testing.assert_allclose(readPdbAtoms(outFile).coords.mean(axis=0), newOrigin, atol=2e-3)
+
+
+class TestConvertStructure(EngineTestCase):
+    numAtoms = 600
+    chainSize = 300
+
+    def test_mmcif_streaming(self):
+        """ mmCIF inputs are converted to the structure file that is then centered in place in batches """
+        cifFile = self.getPath('structure.cif')
+        toCIF(self.pdbFile, cifFile)
+        prot = newProtocol(self.getPath('streaming'), engine=NATIVE_ENGINE, autoFit=False, batchSize=100)
+        prot.convertStructureStep(cifFile)
+        structFile = prot._getStructureFile(cifFile)
+        atoms = readPdbAtoms(structFile)
+        self.assertEqual(len(atoms), self.numAtoms)
+        np.testing.assert_allclose(atoms.coords, self.coords - self.coords.mean(axis=0), atol=2e-3)
+
+        streamed = streamScoreStructure(self.mapFile, structFile, self.getPath('streamed.pdb'), 100)
+        self.assertTrue(np.all(streamed != 0.))
+
+    def test_pdb_as_cif(self):
+        """ Atoms are numbered by their position, matching atomSpecs, whatever their serials and TER records """
+        with open(self.pdbFile) as fh:
+            lines = fh.read().splitlines()[:-1]
+        lines.insert(self.chainSize, 'TER')
+        lines += ["HETATM99999  C1  NAG B 101       1.000   2.000   3.000  1.00  0.00           C",
+                  "HETATM99999  O   HOH B 201       4.000   5.000   6.000  1.00  0.00           O"]
+        pdbFile = self.getPath('hetero.pdb')
+        with open(pdbFile, 'w') as fh:
+            fh.write('\n'.join(lines + ['END']) + '\n')
+        atoms = readPdbAtoms(pdbFile)
+
+        cifFile, batchFile = self.getPath('hetero.cif'), self.getPath('batches.cif')
+        writePdbAsCif(pdbFile, cifFile)
+        writePdbAsCif(pdbFile, batchFile, batchSize=7)
+        with open(cifFile) as fh, open(batchFile) as fhBatch:
+            self.assertEqual(fh.read(), fhBatch.read())
+        cifDic = MMCIF2Dict(cifFile)
+        self.assertEqual(cifDic['_atom_site.id'], [str(i) for i in range(1, len(atoms) + 1)])
+        # Every chain and every hetero molecule get their own label_asym_id
+        self.assertEqual(sorted(set(cifDic['_atom_site.label_asym_id'])), ['A', 'B', 'C', 'D'])
+        self.assertEqual(cifDic['_atom_site.label_seq_id'][-2:], ['.', '.'])
+
+        appendScipionAttributes(cifFile, [('MapQ_Score', 'atoms', atomSpecs(atoms), atoms.bFactor)])
+        handler = AtomicStructHandler()
+        handler.read(cifFile)
+        self.assertEqual(len(list(handler.getStructure().get_atoms())), len(atoms))
+        cifDic = handler.readLowLevel(cifFile)
+        self.assertEqual(cifDic['_scipion_attributes.specifier'], atomSpecs(atoms).tolist())
+
+    def test_models_and_insertion_codes(self):
+        """ Every MODEL keeps its number and residues with an insertion code their own rows """
+        lines, serial = [], 1
+        for model in (1, 2):
+            lines.append('MODEL     %4d' % model)
+            for resSeq, iCode in ((51, ' '), (52, ' '), (52, 'A'), (53, ' ')):
+                for name in ('N', 'CA', 'C', 'O'):
+                    lines.append("ATOM  %5d  %-3s ALA A%4d%s   %8.3f%8.3f%8.3f  1.00  0.00           %s"
+                                 % (serial, name, resSeq, iCode, serial, 10. * model, 0., name[0]))
+                    serial += 1
+            lines.append('ENDMDL')
+        pdbFile, cifFile = self.getPath('models.pdb'), self.getPath('models.cif')
+        with open(pdbFile, 'w') as fh:
+            fh.write('\n'.join(lines + ['END']) + '\n')
+
+        writePdbAsCif(pdbFile, cifFile, batchSize=6)
+        cifDic = MMCIF2Dict(cifFile)
+        self.assertEqual(cifDic['_atom_site.pdbx_PDB_model_num'], ['1'] * 16 + ['2'] * 16)
+        self.assertEqual(cifDic['_atom_site.pdbx_PDB_ins_code'], (['?'] * 8 + ['A'] * 4 + ['?'] * 4) * 2)
+        self.assertEqual(cifDic['_atom_site.label_seq_id'], [str(n) for n in np.repeat([1, 2, 3, 4], 4)] * 2)
+
+        atoms = readPdbAtoms(pdbFile)
+        residues = residueScores(atoms, np.ones(len(atoms)))
+        np.testing.assert_array_equal(residueSpecs(residues), ['A:51', 'A:52', 'A:52A', 'A:53'] * 2)
+        np.testing.assert_array_equal(residues['atoms'], 4)
+
+
+
+class TestScoredStructure(EngineTestCase):
+    numAtoms = 600
+    chainSize = 300
+
+    def test_attributes(self):
+        """ Only the attributes with rows are listed, e.g. no side chain score for backbone only models """
+        atoms = readPdbAtoms(self.getPath('full__Q__map.pdb'))
+        prot = newProtocol(self.getPath('scored'))
+        residues = residueScores(atoms, atoms.bFactor)
+        attributes = prot.getResidueAttributes(residues)
+        expected = ['MapQ_Score', 'MapQ_Residue_Score', 'MapQ_Backbone_Score']
+        outFile = self.getPath('scored.cif')
+        self.assertEqual(prot.writeScoredStructure(self.pdbFile, atoms, outFile, attributes), expected)
+        # Attributes merged with those already in the file
+        mergedFile = self.getPath('merged.cif')
+        self.assertEqual(sorted(prot.writeScoredStructure(outFile, atoms, mergedFile, attributes)),
+                         sorted(expected))
+        with open(mergedFile) as fh:
+            self.assertNotIn('MapQ_SideChain_Score', fh.read())
+
+
+
+class TestResidueTables(EngineTestCase):
+    numAtoms = 600
+    chainSize = 300
+
+    def test_tables(self):
+        """ Residue and chain tables against per residue loops, with side chains and hydrogens """
+        with open(self.pdbFile) as fh:
+            lines = fh.read().splitlines()[:-1]
+        # The O of every third residue becomes a side chain atom, and the C of every fifth a hydrogen
+        for i, line in enumerate(lines):
+            residue = int(line[22:26])
+            if line[12:16] == ' O  ' and residue % 3 == 0:
+                lines[i] = line[:12] + ' CB ' + line[16:]
+            elif line[12:16] == ' C  ' and residue % 5 == 0:
+                lines[i] = line[:12] + ' H  ' + line[16:76] + ' H'
+        pdbFile = self.getPath('sidechains.pdb')
+        with open(pdbFile, 'w') as fh:
+            fh.write('\n'.join(lines + ['END']) + '\n')
+        atoms = readPdbAtoms(pdbFile)
+        scores = self.scores
+        expected = np.linspace(0.3, 0.7, len(atoms))
+
+        residues = residueScores(atoms, scores, expected)
+        heavy = atoms.heavyAtoms()
+        keys = list(dict.fromkeys(zip(atoms.chain[heavy], atoms.resSeq[heavy])))
+        self.assertEqual(list(zip(residues['chain'], residues['resSeq'])), keys)
+        for row, (chain, resSeq) in enumerate(keys):
+            inResidue = heavy & (atoms.chain == chain) & (atoms.resSeq == resSeq)
+            sideChain = inResidue & (atoms.name == 'CB')
+            self.assertEqual(residues['atoms'][row], np.count_nonzero(inResidue))
+            self.assertAlmostEqual(residues['q'][row], np.mean(scores[inResidue]))
+            self.assertAlmostEqual(residues['qBackbone'][row], np.mean(scores[inResidue & ~sideChain]))
+            self.assertAlmostEqual(residues['expectedQ'][row], np.mean(expected[inResidue]))
+            if np.any(sideChain):
+                self.assertAlmostEqual(residues['qSideChain'][row], np.mean(scores[sideChain]))
+            else:
+                self.assertTrue(np.isnan(residues['qSideChain'][row]))
+
+        # Tables of batches that never split residues add up to the table of the whole structure
+        batches = [residueScores(batch, scores[batch.position - 1], expected[batch.position - 1])
+                   for batch in iterPdbAtoms(pdbFile, 50)]
+        for column, values in concatenateTables(batches).items():
+            np.testing.assert_array_equal(values, residues[column])
+
+        chains = chainScores(residues)
+        np.testing.assert_array_equal(chains['chain'], ['A', 'B'])
+        for row, chain in enumerate(['A', 'B']):
+            inChain = heavy & (atoms.chain == chain)
+            chainResidues = residues['chain'] == chain
+            self.assertEqual(chains['residues'][row], np.count_nonzero(chainResidues))
+            self.assertEqual(chains['atoms'][row], np.count_nonzero(inChain))
+            # Atom scores are averaged over the atoms, backbone and side chain scores over the residues
+            self.assertAlmostEqual(chains['q'][row], np.mean(scores[inChain]))
+            self.assertAlmostEqual(chains['expectedQ'][row], np.mean(expected[inChain]))
+            self.assertAlmostEqual(chains['qBackbone'][row], np.mean(residues['qBackbone'][chainResidues]))
+            self.assertAlmostEqual(chains['qSideChain'][row], np.nanmean(residues['qSideChain'][chainResidues]))
+
+
+class TestBatchProtocol(unittest.TestCase):
+    """ ProtMapQBatch steps on two different synthetic structures, centered like the converted ones, and their
+    maps """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp(prefix='mapq-test-')
+        cls.volumes = SetOfVolumes.create(cls.tmpDir)
+        cls.structures = SetOfAtomStructs.create(cls.tmpDir)
+        for seed, layout in ((1, 'helical'), (2, 'random')):
+            coords = syntheticAtoms(300, layout, seed=seed)
+            coords -= coords.mean(axis=0)
+            pdbFile, mapFile = (os.path.join(cls.tmpDir, 'input%d.%s' % (seed, ext)) for ext in ('pdb', 'mrc'))
+            writeSyntheticPdb(coords, pdbFile)
+            origin = Transform()
+            origin.setShifts(*writeSyntheticMap(coords, mapFile, seed=seed))
+            vol = Volume(location=mapFile)
+            vol.setSamplingRate(1.)
+            vol.setOrigin(origin)
+            vol.setObjLabel('pair%d' % seed)
+            cls.volumes.append(vol)
+            struct = AtomStruct(filename=pdbFile)
+            struct.setObjLabel('pair%d' % seed)
+            cls.structures.append(struct)
+        cls.volumes.write()
+        cls.structures.write()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    def newProtocol(self, name, **params):
+        return newProtocol(os.path.join(self.tmpDir, name), ProtMapQBatch, inputVolumes=self.volumes,
+                           inputStructures=self.structures, **params)
+
+    def test_pairing(self):
+        self.assertEqual(self.newProtocol('byId', pairing=PAIR_BY_ID).getPairs(), [(1, 1), (2, 2)])
+        self.assertEqual(self.newProtocol('all', pairing=PAIR_ALL).getPairs(), [(1, 1), (1, 2), (2, 1), (2, 2)])
+        prot = self.newProtocol('byAttribute', pairing=PAIR_BY_ATTRIBUTE, pairAttribute='_objLabel')
+        self.assertEqual(prot.getPairs(), [(1, 1), (2, 2)])
+        self.assertEqual(prot._validate(), [])
+        prot.pairAttribute.set('_missing')
+        self.assertEqual(len(prot._validate()), 1)
+
+    def test_scoring(self):
+        """ Every pair is scored as a single run would, and pairs that fail are recorded """
+        prot = self.newProtocol('scoring', pairing=PAIR_ALL)
+        prot.numberOfThreads.set(2)
+        prot.convertInputStep()
+        os.remove(prot._getVolumeFile(2))
+        prot.computeQScoresStep()
+        self.assertEqual(prot.getFailedNames(), [prot.getPairName(1, 2), prot.getPairName(2, 2)])
+        for structId in (1, 2):
+            qFile = prot._getQScoresFile(prot.getPairName(structId, 1))
+            reference = scoreStructure(prot._getVolumeFile(1), prot._getStructureFile(structId),
+                                       os.path.join(self.tmpDir, 'reference.pdb'))
+            np.testing.assert_allclose(readPdbAtoms(qFile).bFactor, reference, atol=0.005)
+        # Only the structure the map was made from fits it
+        self.assertGreater(np.mean(readPdbAtoms(prot._getQScoresFile(prot.getPairName(1, 1))).bFactor), 0.5)
+        self.assertLess(np.mean(readPdbAtoms(prot._getQScoresFile(prot.getPairName(2, 1))).bFactor), 0.3)
+
+
+class TestScoringServer(EngineTestCase):
+    numAtoms = 600
+    chainSize = 300
+
+    def test_map_cache(self):
+        """ Maps are loaded once, again when their file changes, and the least recently used are dropped """
+        otherMap = self.getPath('other.mrc')
+        shutil.copy(self.mapFile, otherMap)
+        cache = MapCache(maxMaps=1)
+        grid = cache.get(self.mapFile)
+        self.assertIs(cache.get(self.mapFile), grid)
+        cache.get(otherMap)
+        self.assertIsNot(cache.get(self.mapFile), grid)
+        grid = cache.get(self.mapFile)
+        os.utime(self.mapFile, (0, 0))
+        self.assertIsNot(cache.get(self.mapFile), grid)
+
+    def test_server(self):
+        """ Structures scored by a server process get the scores of a run within the client """
+        socketDir = self.getPath('server')
+        address = os.path.join(socketDir, 'server.sock')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(mapq.__file__)))] +
+            [path for path in [os.environ.get('PYTHONPATH')] if path]))
+        server = subprocess.Popen([sys.executable, '-m', 'mapq.engine.server', '--socket', address], env=env,
+                                  stdout=subprocess.DEVNULL)
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+        for _ in range(600):
+            if serverRunning(address) or server.poll() is not None:
+                break
+            time.sleep(0.1)
+        self.assertTrue(serverRunning(address))
+        self.assertTrue(isPrivate(socketDir))
+
+        for _ in range(2):
+            scores = scoreOnServer(address, 'scoreStructure', self.mapFile, self.pdbFile,
+                                   self.getPath('server__Q__map.pdb'), numberOfProcesses=2)
+            np.testing.assert_allclose(scores, self.scores, atol=1e-5)
+        streamed = scoreOnServer(address, 'streamScoreStructure', self.mapFile, self.pdbFile,
+                                 self.getPath('server_stream.pdb'), 100)
+        np.testing.assert_allclose(streamed, self.scores, atol=1e-5)
+        # Errors of the jobs are raised in the client, while the server keeps running
+        with self.assertRaises(Exception):
+            scoreOnServer(address, 'scoreStructure', self.getPath('missing.mrc'), self.pdbFile,
+                          self.getPath('missing.pdb'))
+        with self.assertRaises(Exception):
+            scoreOnServer(address, 'computeQScores', self.mapFile)
+        with self.assertRaises(RuntimeError):
+            ScoringServer(address).serve()
+
+        server.terminate()
+        server.wait()
+        self.assertFalse(os.path.exists(address))
+        with self.assertRaises(ConnectionError):
+            scoreOnServer(address, 'scoreStructure', self.mapFile, self.pdbFile, self.getPath('none.pdb'))
+
+    def test_private_directory(self):
+        """ Servers never listen, nor clients connect, in directories others can access """
+        socketDir = self.getPath('shared')
+        os.makedirs(socketDir)
+        os.chmod(socketDir, 0o755)
+        address = os.path.join(socketDir, 'server.sock')
+        with self.assertRaises(RuntimeError):
+            ScoringServer(address).serve()
+        with open(address + KEY_SUFFIX, 'wb') as fh:
+            fh.write(b'key')
+        with self.assertRaises(ConnectionError):
+            scoreOnServer(address, 'scoreStructure', self.mapFile, self.pdbFile, self.getPath('none.pdb'))
+
+
+class TestStageProfiler(unittest.TestCase):
+
+    def test_nested_stages(self):
+        """ Steps run concurrently get a profile each, holding their nested stages, which are only timed """
+        tmpDir = tempfile.mkdtemp(prefix='mapq-test-')
+        self.addCleanup(shutil.rmtree, tmpDir)
+        profiler = StageProfiler(os.path.join(tmpDir, 'stages.jsonl'), os.path.join(tmpDir, 'profiles'))
+
+        def step(structure):
+            with profiler.stage('qscores', structure):
+                with profiler.stage('native_scoring', structure):
+                    sum(i * i for i in range(10000))
+
+        threads = [threading.Thread(target=step, args=(name,)) for name in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(os.listdir(os.path.join(tmpDir, 'profiles'))), ['qscores_a.prof', 'qscores_b.prof'])
+        records = readStageRecords(os.path.join(tmpDir, 'stages.jsonl'))
+        self.assertEqual(sorted((r['stage'], r['structure']) for r in records),
+                         [('native_scoring', 'a'), ('native_scoring', 'b'), ('qscores', 'a'), ('qscores', 'b')])
+        self.assertTrue(all(r['error'] is None for r in records))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,6 +34,7 @@ from pwem.convert.atom_struct import AtomicStructHandler
 from pyworkflow.tests import BaseTest, setupTestProject
 
 from mapq.protocols import ProtMapQ
+from mapq.constants import NATIVE_ENGINE
 import mapq
 
 
@@ -62,18 +63,14 @@ class TestMapQ(BaseTest):
         cls.launchProtocol(protImport)
         return protImport.outputVolume
 
-    def runMapQ(self, pdb, volume):
-        prot = self.newProtocol(ProtMapQ, inputVol=volume, pdbs=[pdb])
+    def runMapQ(self, pdb, volume, **kwargs):
+        prot = self.newProtocol(ProtMapQ, inputVol=volume, pdbs=[pdb], **kwargs)
         self.launchProtocol(prot)
         self.assertIsNotNone(prot.scoredStructures,
                              "There was a problem with MapQ protocol output")
         return prot
 
-    def test_mapq(self):
-        pdb = self.runImportPDBs('PDB Struct')
-        volume = self.runImportVolumes(0.65, 'Map')
-        prot = self.runMapQ(pdb, volume)
-
+    def meanScore(self, prot):
         ASH = AtomicStructHandler()
         for struct in prot.scoredStructures:
             fileName = struct.getFileName()
@@ -83,6 +80,24 @@ class TestMapQ(BaseTest):
             mapq_scores = [float(value) for attribute, value in zip(attributes, values)
                            if attribute == prot._ATTRNAME]
             mean_score = sum(mapq_scores) / len(mapq_scores)
+        return mean_score
+
+    def test_mapq(self):
+        pdb = self.runImportPDBs('PDB Struct')
+        volume = self.runImportVolumes(0.65, 'Map')
+        prot = self.runMapQ(pdb, volume)
+
+        mean_score = self.meanScore(prot)
         self.assertEqual(round(mean_score, 4), -0.0052, "Unexpected score value: mean")
 
+        return prot
+
+    def test_mapq_native(self):
+        pdb = self.runImportPDBs('PDB Struct')
+        volume = self.runImportVolumes(0.65, 'Map')
+        prot = self.runMapQ(pdb, volume, engine=NATIVE_ENGINE)
+
+        mean_score = self.meanScore(prot)
+        self.assertAlmostEqual(mean_score, -0.0052, delta=0.01, msg="Unexpected score value: mean")
+
         return prot
\ No newline at end of file
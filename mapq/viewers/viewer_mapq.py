@@ -25,6 +25,10 @@
 # **************************************************************************
 
 from pwem.viewers import ChimeraAttributeViewer
+from pyworkflow.protocol import params
+from pyworkflow.viewer import MessageView
+import pyworkflow.utils as pwutils
+
 from ..protocols import ProtMapQ
 
 class MapQScoresViewer(ChimeraAttributeViewer):
@@ -43,3 +47,41 @@ class MapQScoresViewer(ChimeraAttributeViewer):
       group = form.addGroup('Color settings')
       ColorScaleWizardBase.defineColorScaleParams(group, defaultLowest=0, defaultHighest=2, defaultIntervals=21,
                                                   defaultColorMap='RdBu')
+      group = form.addGroup('Q-score statistics')
+      group.addParam('displayStats', params.LabelParam,
+                     label='Display Q-score statistics: ',
+                     help='Display the statistics of the Q-scores of every structure, stored when the protocol '
+                          'finished: mean, median, percentiles and mean of every chain.')
+
+    def _getVisualizeDict(self):
+      visualizeDict = super()._getVisualizeDict()
+      visualizeDict['displayStats'] = self._showStats
+      return visualizeDict
+
+    def _getStructureAttributes(self):
+      # Avoid parsing the whole output file just to list its attributes
+      stats = self.protocol.readScoreStats()
+      if stats is not None:
+          baseName = pwutils.removeBaseExt(self.getAtomStructObject().getFileName())
+          if 'attributes' in stats.get(baseName, {}):
+              return stats[baseName]['attributes']
+      return super()._getStructureAttributes()
+
+    def _showStats(self, paramName=None):
+      stats = self.protocol.readScoreStats()
+      if stats is None:
+          return [self.errorMessage('No Q-score statistics were stored by this run.',
+                                    title='Q-score statistics')]
+      lines = []
+      for baseName, structStats in stats.items():
+          lines.append('%s: %d atoms' % (baseName, structStats['atoms']))
+          if not structStats['atoms']:
+              continue
+          lines.append('    mean %.4f, std %.4f, median %.4f, range [%.4f, %.4f]' %
+                       (structStats['mean'], structStats['std'], structStats['median'],
+                        structStats['min'], structStats['max']))
+          lines.append('    percentiles: ' + ', '.join('%s%% %.4f' % item
+                                                     for item in structStats['percentiles'].items()))
+          for chain, chainStats in structStats['chains'].items():
+              lines.append('    chain %s: mean %.4f, %d atoms' % (chain, chainStats['mean'], chainStats['atoms']))
+      return [MessageView('\n'.join(lines), title='Q-score statistics', tkParent=self.getTkRoot())]